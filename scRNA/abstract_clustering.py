@@ -1,6 +1,13 @@
+import os
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
+import scipy.sparse as sp
+
+from diagnostics import data_summary, print_data_summary
+from gene_vocabulary import intern_gene_ids
+from preprocessing_cache import read_only
+from qc_stats import cached_nan_count, invalidate_qc_stats
 
 
 class AbstractClustering(object):
@@ -8,14 +15,22 @@ class AbstractClustering(object):
 
     cell_filter_list = None
     gene_filter_list = None
+    post_gene_filter_list = None
     data_transf = None
 
     data = None
     gene_ids = None
+    gene_codes = None
     num_cells = -1
     num_transcripts = -1
 
     pp_data = None
+    pp_diagnostics = None  # data summaries of the pre-processing stages
+    verbosity = 1  # 0: no diagnostics, 1: sample-based summaries, 2: exact summaries
+    pp_fname = None  # out-of-core mode: pre-processed (dense) data is written into this .npy memory-map
+    pp_chunk_size = 1000  # number of cells that are gathered and transformed at once
+    pp_cache = None  # (opt-in) shared pre-processing results, e.g. preprocessing_cache.PREPROCESSING_CACHE
+    pp_dtype = np.float64  # dtype of the pre-processed data (e.g. np.float32 halves the memory)
     cluster_labels = None
 
     remain_cell_inds = None
@@ -25,6 +40,7 @@ class AbstractClustering(object):
         # init lists
         self.cell_filter_list = list()
         self.gene_filter_list = list()
+        self.post_gene_filter_list = list()
         self.data_transf = lambda x: x
         self.gene_ids = gene_ids
         self.data = data
@@ -35,6 +51,20 @@ class AbstractClustering(object):
         self.cluster_labels = np.zeros((self.num_cells, 1))
         print('Number of cells = {0}, number of transcripts = {1}'.format(self.num_cells, self.num_transcripts))
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # objects pickled by older versions lack the post-transform gene filters
+        if self.post_gene_filter_list is None:
+            self.post_gene_filter_list = list()
+
+    def get_gene_codes(self):
+        """
+        :return: interned (int32) gene ids for fast alignment across datasets (interned on first use)
+        """
+        if self.gene_codes is None:
+            self.gene_codes = intern_gene_ids(self.gene_ids)
+        return self.gene_codes
+
     def set_data_transformation(self, data_transf):
         self.data_transf = data_transf
 
@@ -44,45 +74,196 @@ class AbstractClustering(object):
         else:
             self.cell_filter_list.append(cell_filter)
 
-    def add_gene_filter(self, gene_filter):
-        if self.gene_filter_list is None:
+    def add_gene_filter(self, gene_filter, post_transform=False):
+        """
+        :param gene_filter: function that returns the indices (or a boolean mask) of the remaining transcripts
+        :param post_transform: apply the filter to the filtered and transformed data (e.g. highly variable genes)
+        """
+        if post_transform:
+            if self.post_gene_filter_list is None:
+                self.post_gene_filter_list = list()
+            self.post_gene_filter_list.append(gene_filter)
+        elif self.gene_filter_list is None:
             self.gene_filter_list = list(gene_filter)
         else:
             self.gene_filter_list.append(gene_filter)
 
     def pre_processing(self):
+        # out-of-core results are backed by (re-writable) files and are not cached
+        key = None
+        if self.pp_cache is not None and self.pp_fname is None:
+            key = self.pp_cache.key(self.data, self.pp_config())
+        if key is not None:
+            res = self.pp_cache.get(key, self.data)
+            if res is not None:
+                print('Using cached pre-processing results.')
+                self.pp_data, self.remain_gene_inds, self.remain_cell_inds = res
+                return self.pp_data
         self.pp_data, self.remain_gene_inds, self.remain_cell_inds = self.pre_processing_impl(self.data)
+        if key is not None:
+            self.pp_cache.put(key, self.data, self.pp_data, self.remain_gene_inds, self.remain_cell_inds)
+            # shared results must not be changed
+            self.pp_data = read_only(self.pp_data)
+            self.remain_gene_inds = read_only(self.remain_gene_inds)
+            self.remain_cell_inds = read_only(self.remain_cell_inds)
         return self.pp_data
 
+    def invalidate_pre_processing(self):
+        """
+        Removes the cached pre-processing results of this configuration (e.g. after
+        the data was changed in-place).
+        """
+        if self.pp_cache is not None:
+            key = self.pp_cache.key(self.data, self.pp_config())
+            if key is not None:
+                self.pp_cache.invalidate(key)
+
+    def pp_config(self):
+        """
+        :return: list of everything (besides the data) the pre-processing depends on
+        """
+        config = ['cell_filter'] + self.cell_filter_list
+        config += ['gene_filter'] + self.gene_filter_list
+        config += ['post_gene_filter'] + self.post_gene_filter_list
+        config += ['transformation', self.data_transf, np.dtype(self.pp_dtype).str]
+        return config
+
     def pre_processing_impl(self, data):
         transcripts, cells = data.shape
+        self.pp_diagnostics = None
+        # filters share the QC statistics of one pass over the data (which
+        # might have been changed in-place since the last pre-processing)
+        invalidate_qc_stats(data)
         # 1. cell filter
-        remain_cell_inds = np.arange(0, cells)
+        remain_cells = np.ones(cells, dtype=np.bool)
         for c in self.cell_filter_list:
-            res = c(data)
-            remain_cell_inds = np.intersect1d(remain_cell_inds, res)
+            remain_cells &= self.filter_mask(c(data), cells)
+        remain_cell_inds = np.where(remain_cells)[0]
         print('1. Remaining number of cells after filtering: {0}/{1}'.format(remain_cell_inds.size, cells))
-        A = data[:, remain_cell_inds]
 
         # 2. gene filter
-        remain_gene_inds = np.arange(0, transcripts)
+        remain_genes = np.ones(transcripts, dtype=np.bool)
         for g in self.gene_filter_list:
-            res = g(data)
-            remain_gene_inds = np.intersect1d(remain_gene_inds, res)
+            remain_genes &= self.filter_mask(g(data), transcripts)
+        remain_gene_inds = np.where(remain_genes)[0]
         print('2. Remaining number of transcripts after filtering: {0}/{1}'.format(remain_gene_inds.size, transcripts))
 
         # 3. data transformation
-        B = A[remain_gene_inds, :]
+        B = self.gather(data, remain_gene_inds, remain_cell_inds, chunk_size=self.pp_chunk_size)
         print '3. Data transformation'
-        print 'Before data transformation: '
-        print '- Mean\median\max values: ', np.mean(B), np.median(B), np.max(B)
-        print '- Percentiles: ', np.percentile(B, [50, 75, 90, 99])
-        X = self.data_transf(B)
-        print 'After data transformation: '
-        print '- Mean\median\max values: ', np.mean(X), np.median(X), np.max(X)
-        print '- Percentiles: ', np.percentile(X, [50, 75, 90, 99])
+        self.diagnose('before_transformation', B, 'Before data transformation: ')
+        # B is a private buffer, i.e. transformations are allowed to work in-place
+        if isinstance(B, np.memmap):
+            X = self.transform_chunked(B, chunk_size=self.pp_chunk_size)
+        else:
+            X = self.data_transf(B)
+        self.diagnose('after_transformation', X, 'After data transformation: ')
+
+        # 4. gene filter (on the transformed data)
+        if self.post_gene_filter_list:
+            remain_genes = np.ones(X.shape[0], dtype=np.bool)
+            for g in self.post_gene_filter_list:
+                remain_genes &= self.filter_mask(g(X), X.shape[0])
+            if isinstance(X, np.memmap):
+                X = self.select_genes_out_of_core(X, np.where(remain_genes)[0])
+            else:
+                X = X[remain_genes, :]
+            remain_gene_inds = remain_gene_inds[remain_genes]
+            print('4. Remaining number of transcripts after filtering: {0}/{1}'.format(remain_gene_inds.size, transcripts))
         return X, remain_gene_inds, remain_cell_inds
 
+    def filter_mask(self, res, size):
+        """
+        :param res: result of a filter (indices or boolean mask)
+        :param size: number of cells/transcripts
+        :return: boolean mask
+        """
+        res = np.asarray(res)
+        if res.dtype == np.bool and res.size == size:
+            return res
+        mask = np.zeros(size, dtype=np.bool)
+        mask[res.astype(np.int)] = True
+        return mask
+
+    def gather(self, data, remain_gene_inds, remain_cell_inds, chunk_size=1000, fname=None, replace_nan=True):
+        """
+        :param data: transcripts x cells data matrix (dense or sparse), will not be changed
+        :param remain_gene_inds: indices of remaining transcripts
+        :param remain_cell_inds: indices of remaining cells
+        :param chunk_size: number of cells that are gathered at once
+        :param fname: [optional] dense results are written into this .npy memory-map (default: pp_fname)
+        :param replace_nan: replace NaNs by zeros
+        :return: filtered data (copy) of dtype pp_dtype
+        """
+        if fname is None:
+            fname = self.pp_fname
+        check_nan = replace_nan and data.dtype.kind == 'f' and not cached_nan_count(data) == 0
+        if sp.issparse(data):
+            B = data[:, remain_cell_inds][remain_gene_inds, :].astype(self.pp_dtype)
+            if check_nan:
+                B.data[np.isnan(B.data)] = 0.
+            return B
+        shape = (remain_gene_inds.size, remain_cell_inds.size)
+        if fname is not None:
+            print('Writing pre-processed data chunk-wise into \'{0}\'.'.format(fname))
+            B = np.lib.format.open_memmap(fname, mode='w+', dtype=self.pp_dtype, shape=shape, fortran_order=True)
+        else:
+            B = np.empty(shape, dtype=self.pp_dtype, order='F')
+        for i in range(0, remain_cell_inds.size, chunk_size):
+            chunk = B[:, i:i+chunk_size]
+            chunk[:] = data[np.ix_(remain_gene_inds, remain_cell_inds[i:i+chunk_size])]
+            if check_nan:
+                # NaNs count as zeros
+                chunk[np.isnan(chunk)] = 0.
+        return B
+
+    def select_genes_out_of_core(self, X, remain_gene_inds):
+        """
+        Out-of-core gene filter: the remaining transcripts are gathered chunk-wise into
+        a new memory-map, which then replaces pp_fname.
+        :param X: transcripts x cells memory-mapped (transformed) data
+        :param remain_gene_inds: indices of remaining transcripts
+        :return: memory-mapped X[remain_gene_inds, :] backed by pp_fname
+        """
+        tmp_fname = '{0}.tmp.npy'.format(self.pp_fname)
+        Y = self.gather(X, remain_gene_inds, np.arange(X.shape[1]), chunk_size=self.pp_chunk_size,
+                        fname=tmp_fname, replace_nan=False)
+        Y.flush()
+        del Y
+        # mappings of the replaced file stay valid
+        os.rename(tmp_fname, self.pp_fname)
+        return np.load(self.pp_fname, mmap_mode='r+')
+
+    def transform_chunked(self, B, chunk_size=1000):
+        """
+        Out-of-core data transformation: the transformation is applied to column chunks
+        of the (memory-mapped) data B and needs to be column-wise (e.g. log2, CPM).
+        :param B: transcripts x cells (memory-mapped) data matrix, will be changed
+        :param chunk_size: number of cells that are transformed at once
+        :return: transformed B
+        """
+        for i in range(0, B.shape[1], chunk_size):
+            chunk = B[:, i:i+chunk_size]
+            res = self.data_transf(chunk)
+            if res is not chunk:
+                chunk[:] = res
+        B.flush()
+        return B
+
+    def diagnose(self, key, X, header):
+        """
+        :param key: name of the pre-processing stage (e.g. 'before_transformation')
+        :param X: data matrix at this stage
+        :param header: printed before the summary
+        """
+        if self.verbosity <= 0:
+            return
+        print header
+        if self.pp_diagnostics is None:
+            self.pp_diagnostics = dict()
+        self.pp_diagnostics[key] = data_summary(X, exact=self.verbosity > 1)
+        print_data_summary(self.pp_diagnostics[key])
+
     @abstractmethod
     def apply(self):
         pass
@@ -0,0 +1,162 @@
+import gzip
+import os
+
+import numpy as np
+
+# A binary dataset is a directory holding a raw (Fortran-ordered) .npy block
+# with the transcripts x cells expression matrix and a small header with
+# gene ids, cell ids and (optional) labels. Fortran-order keeps every cell
+# (column) contiguous on disk, hence, memory-mapping is O(1) and column
+# selections (e.g. after cell filtering) only touch the pages they need.
+BINARY_DATASET_VERSION = 1
+DATA_FNAME = 'data.npy'
+DATA_GZ_FNAME = 'data.npy.gz'
+HEADER_FNAME = 'header.npz'
+
+
+def is_binary_dataset(fname):
+    """
+    :param fname: filename or directory
+    :return: True, if fname points to a binary dataset directory
+    """
+    return os.path.isdir(fname) and os.path.exists(os.path.join(fname, HEADER_FNAME))
+
+
+def save_binary_dataset_header(fname, gene_ids, cell_ids=None, labels=None, genes_ref=None):
+    """
+    :param fname: binary dataset directory
+    :param gene_ids: #transcripts vector with corresponding gene(transcript) ids (or None if genes_ref is given)
+    :param cell_ids: [optional] #cells vector with corresponding cell ids
+    :param labels: [optional] #cells vector with cluster labels
+    :param genes_ref: [optional] path of a shared gene ids *.npy file (relative to fname)
+    """
+    if not os.path.exists(fname):
+        os.makedirs(fname)
+    header = dict()
+    header['version'] = BINARY_DATASET_VERSION
+    if genes_ref is not None:
+        header['genes_ref'] = genes_ref
+    else:
+        header['gene_ids'] = np.asarray(gene_ids).astype(np.str)
+    if cell_ids is not None:
+        header['cell_ids'] = np.asarray(cell_ids).astype(np.str)
+    if labels is not None:
+        header['labels'] = np.asarray(labels)
+    np.savez(os.path.join(fname, HEADER_FNAME), **header)
+
+
+def create_binary_dataset(fname, shape, dtype, gene_ids, cell_ids=None, labels=None, genes_ref=None):
+    """
+    :param fname: binary dataset directory (will be created)
+    :param shape: (transcripts, cells) tuple
+    :param dtype: dtype of the expression matrix
+    :return: writable transcripts x cells memory-map of the (uninitialized) data
+    """
+    assert genes_ref is not None or len(gene_ids) == shape[0]
+    save_binary_dataset_header(fname, gene_ids, cell_ids=cell_ids, labels=labels, genes_ref=genes_ref)
+    return np.lib.format.open_memmap(os.path.join(fname, DATA_FNAME), mode='w+',
+                                     dtype=dtype, shape=shape, fortran_order=True)
+
+
+class BinaryDatasetWriter(object):
+    """ Streams a transcripts x cells matrix column chunk by column chunk
+        into a binary dataset directory, optionally gzip-compressed.
+    """
+    fname = None
+    shape = None
+    dtype = None
+    compress = False
+
+    num_written = 0
+    out = None
+
+    def __init__(self, fname, shape, dtype, gene_ids=None, cell_ids=None, labels=None,
+                 genes_ref=None, compress=False):
+        assert gene_ids is not None or genes_ref is not None
+        self.fname = fname
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+        self.num_written = 0
+        if compress:
+            save_binary_dataset_header(fname, gene_ids, cell_ids=cell_ids, labels=labels, genes_ref=genes_ref)
+            self.out = gzip.open(os.path.join(fname, DATA_GZ_FNAME), 'wb')
+            np.lib.format.write_array_header_1_0(self.out, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                            'fortran_order': True, 'shape': tuple(shape)})
+        else:
+            self.out = create_binary_dataset(fname, shape, self.dtype, gene_ids, cell_ids=cell_ids,
+                                             labels=labels, genes_ref=genes_ref)
+
+    def write(self, chunk):
+        """
+        :param chunk: transcripts x (chunk of) cells data matrix
+        """
+        assert chunk.shape[0] == self.shape[0]
+        assert self.num_written + chunk.shape[1] <= self.shape[1]
+        if self.compress:
+            # Fortran-ordered bytes of a column chunk are just the consecutive columns
+            self.out.write(np.asarray(chunk, dtype=self.dtype).tobytes(order='F'))
+        else:
+            self.out[:, self.num_written:self.num_written+chunk.shape[1]] = chunk
+        self.num_written += chunk.shape[1]
+
+    def close(self):
+        if not self.num_written == self.shape[1]:
+            raise StandardError('Binary dataset \'{0}\' is incomplete ({1} of {2} cells written).'.format(
+                self.fname, self.num_written, self.shape[1]))
+        if self.compress:
+            self.out.close()
+        else:
+            self.out.flush()
+        self.out = None
+
+
+def save_binary_dataset(fname, data, gene_ids=None, cell_ids=None, labels=None,
+                        genes_ref=None, compress=False, chunk_size=1000):
+    """
+    :param fname: binary dataset directory (will be created)
+    :param data: transcripts x cells data matrix
+    :param gene_ids: #transcripts vector with corresponding gene(transcript) ids
+    :param cell_ids: [optional] #cells vector with corresponding cell ids
+    :param labels: [optional] #cells vector with cluster labels
+    :param genes_ref: [optional] path of a shared gene ids *.npy file (relative to fname), replaces gene_ids
+    :param compress: gzip-compress the data block (can not be memory-mapped anymore)
+    :param chunk_size: number of cells that are written at once
+    """
+    print('Saving binary dataset ({0}x{1}) to \'{2}\'.'.format(data.shape[0], data.shape[1], fname))
+    writer = BinaryDatasetWriter(fname, data.shape, data.dtype, gene_ids=gene_ids, cell_ids=cell_ids,
+                                 labels=labels, genes_ref=genes_ref, compress=compress)
+    for i in range(0, data.shape[1], chunk_size):
+        writer.write(data[:, i:i+chunk_size])
+    writer.close()
+
+
+def load_binary_dataset(fname, mmap_mode='c'):
+    """
+    :param fname: binary dataset directory
+    :param mmap_mode: memory-map mode (default 'c' = copy-on-write, i.e. in-place changes
+                      stay in memory and never touch the file; None loads everything into RAM)
+    :return: transcripts x cells data (memory-map, unless compressed), gene ids, cell ids (or None), labels (or None)
+    """
+    if not is_binary_dataset(fname):
+        raise StandardError('Binary dataset \'{0}\' not found.'.format(fname))
+    header = np.load(os.path.join(fname, HEADER_FNAME))
+    if header['version'] > BINARY_DATASET_VERSION:
+        raise StandardError('Binary dataset \'{0}\' has unsupported version {1}.'.format(fname, header['version']))
+    if os.path.exists(os.path.join(fname, DATA_GZ_FNAME)):
+        with gzip.open(os.path.join(fname, DATA_GZ_FNAME), 'rb') as f:
+            data = np.lib.format.read_array(f)
+    else:
+        data = np.load(os.path.join(fname, DATA_FNAME), mmap_mode=mmap_mode)
+    if 'genes_ref' in header:
+        gene_ids = np.load(os.path.join(fname, str(header['genes_ref'])))
+    else:
+        gene_ids = header['gene_ids']
+    cell_ids = None
+    if 'cell_ids' in header:
+        cell_ids = header['cell_ids']
+    labels = None
+    if 'labels' in header:
+        labels = header['labels']
+    assert gene_ids.size == data.shape[0]
+    return data, gene_ids, cell_ids, labels
@@ -4,6 +4,8 @@ import ast
 import os
 
 from simulation import generate_toy_data, split_source_target
+from binary_dataset import BinaryDatasetWriter
+from data_transformations import transform_log2_cpm
 from utils import *
 
 # 0. PARSE ARGUMENTS
@@ -38,6 +40,39 @@ parser.add_argument(
     default = 'fout_source_labels.tsv',
     type = str
 )
+parser.add_argument(
+    "--fout_manifest",
+    help = "Output filename of the manifest listing all target/source splits",
+    default = 'fout_manifest.tsv',
+    type = str
+)
+
+parser.add_argument(
+    "--output_format",
+    help = "Output format: 'tsv' (text files) or 'binary' (binary dataset directories, labels included) (default tsv)",
+    default = 'tsv',
+    choices = ['tsv', 'binary'],
+    type = str
+)
+parser.add_argument(
+    "--compress",
+    help = "Gzip-compress binary outputs",
+    dest = "compress",
+    action = 'store_true'
+)
+parser.add_argument(
+    "--no-compress",
+    help = "Do not compress binary outputs",
+    dest = "compress",
+    action = 'store_false'
+)
+parser.set_defaults(compress = False)
+parser.add_argument(
+    "--chunk_size",
+    help = "Number of cells written at once to binary outputs (default 1000)",
+    default = 1000,
+    type = int
+)
 
 parser.add_argument(
     "--num_genes",
@@ -222,7 +257,7 @@ output_fmt = "%u"
 
 #Perform FPKM and log2 normalisation if required
 if args.normalise:
-    data = np.log2(data.astype(float) / (np.sum(data, 0) / 1e6) + 1)
+    data = transform_log2_cpm(data, inplace=False)
     output_fmt = "%f"
 
 # 2. SPLIT TOY DATA IN TARGET AND SOURCE DATA
@@ -239,6 +274,57 @@ if len(source_ncells_range) == 0:
 if len(target_ncells_range) == 0:
     target_ncells_range = [args.target_ncells]
 
+# 3. GENERATE GENE AND CELL NAMES
+gene_ids = np.arange(args.num_genes)
+
+# gene ids are the same for all splits, hence, save them only once
+fout_geneids = args.fout_geneids
+if args.output_format == 'binary':
+    fout_geneids = os.path.splitext(args.fout_geneids)[0] + '.npy'
+    np.save(fout_geneids, gene_ids.astype(np.str))
+else:
+    np.savetxt(
+        fout_geneids,
+        gene_ids,
+        fmt = '%u',
+        delimiter = '\t'
+    )
+
+
+def split_fname(fname, tidx, target_ncells, sidx, source_ncells):
+    ext = os.path.splitext(fname)[1]
+    if args.output_format == 'binary':
+        ext = ''
+    return os.path.splitext(fname)[0] + \
+        "_T" + str(tidx+1) + "_" + str(target_ncells) + \
+        "_S" + str(sidx+1) + "_" + str(source_ncells) + ext
+
+
+def save_split(fname, data, labels):
+    if args.output_format == 'binary':
+        # raw counts are stored in the smallest integer dtype
+        data = compact_counts(data)
+        writer = BinaryDatasetWriter(
+            fname,
+            data.shape,
+            data.dtype,
+            labels = labels,
+            genes_ref = os.path.relpath(fout_geneids, fname),
+            compress = args.compress
+        )
+        for i in range(0, data.shape[1], args.chunk_size):
+            writer.write(data[:, i:i+args.chunk_size])
+        writer.close()
+    else:
+        np.savetxt(
+            fname,
+            data,
+            fmt = output_fmt,
+            delimiter = '\t'
+        )
+
+
+manifest = list()
 for sidx, source_ncells in enumerate(source_ncells_range):
     for tidx, target_ncells in enumerate(target_ncells_range):
 
@@ -257,54 +343,49 @@ for sidx, source_ncells in enumerate(source_ncells_range):
         print 'Target data dimension: ', data_target.shape
         print 'Source data dimension: ', data_source.shape
 
-        # 3. GENERATE GENE AND CELL NAMES
-        gene_ids = np.arange(args.num_genes)
-
         # 4. SAVE RESULTS
-        print('Saving target data to \'{0}\'.'.format(args.fout_target_data))
-        np.savetxt(
-            os.path.splitext(args.fout_target_data)[0] + 
-            "_T" + str(tidx+1) + "_" + str(target_ncells) + 
-            "_S" + str(sidx+1) + "_" + str(source_ncells) +
-             os.path.splitext(args.fout_target_data)[1],
-            data_target,
-            fmt = output_fmt,
-            delimiter = '\t'
-        )
-        np.savetxt(
-            os.path.splitext(args.fout_target_labels)[0] + 
-            "_T" + str(tidx+1) + "_" + str(target_ncells) + 
-            "_S" + str(sidx+1) + "_" + str(source_ncells) +
-             os.path.splitext(args.fout_target_labels)[1],
-            true_labels_target,
-            fmt = '%u',
-            delimiter = '\t'
-        )
-        np.savetxt(
-            args.fout_geneids,
-            gene_ids,
-            fmt = '%u',
-            delimiter = '\t'
-        )
+        fout_target_data = split_fname(args.fout_target_data, tidx, target_ncells, sidx, source_ncells)
+        fout_source_data = split_fname(args.fout_source_data, tidx, target_ncells, sidx, source_ncells)
+        # binary datasets contain the labels already
+        fout_target_labels = fout_target_data
+        fout_source_labels = fout_source_data
 
-        print('Saving source data to \'{0}\'.'.format(args.fout_source_data))
-        np.savetxt(
-            os.path.splitext(args.fout_source_data)[0] + 
-            "_T" + str(tidx+1) + "_" + str(target_ncells) + 
-            "_S" + str(sidx+1) + "_" + str(source_ncells) +
-             os.path.splitext(args.fout_source_data)[1],
-            data_source, 
-            fmt = output_fmt, 
-            delimiter = '\t'
-        )
-        np.savetxt(
-            os.path.splitext(args.fout_source_labels)[0] + 
-            "_T" + str(tidx+1) + "_" + str(target_ncells) + 
-            "_S" + str(sidx+1) + "_" + str(source_ncells) +
-             os.path.splitext(args.fout_source_labels)[1],
-            true_labels_source,
-            fmt = '%u',
-            delimiter = '\t'
-        )
+        print('Saving target data to \'{0}\'.'.format(fout_target_data))
+        save_split(fout_target_data, data_target, true_labels_target)
+        if args.output_format == 'tsv':
+            fout_target_labels = split_fname(args.fout_target_labels, tidx, target_ncells, sidx, source_ncells)
+            np.savetxt(
+                fout_target_labels,
+                true_labels_target,
+                fmt = '%u',
+                delimiter = '\t'
+            )
+
+        print('Saving source data to \'{0}\'.'.format(fout_source_data))
+        save_split(fout_source_data, data_source, true_labels_source)
+        if args.output_format == 'tsv':
+            fout_source_labels = split_fname(args.fout_source_labels, tidx, target_ncells, sidx, source_ncells)
+            np.savetxt(
+                fout_source_labels,
+                true_labels_source,
+                fmt = '%u',
+                delimiter = '\t'
+            )
+
+        manifest.append([str(tidx+1), str(target_ncells), str(sidx+1), str(source_ncells),
+                         fout_target_data, fout_target_labels, fout_source_data, fout_source_labels])
+
+# 5. SAVE MANIFEST OF ALL TARGET/SOURCE SPLITS
+print('Saving manifest to \'{0}\'.'.format(args.fout_manifest))
+np.savetxt(
+    args.fout_manifest,
+    np.array(manifest, dtype=np.str).reshape((len(manifest), 8)),
+    fmt = '%s',
+    delimiter = '\t',
+    header = '\t'.join(['target_idx', 'target_ncells', 'source_idx', 'source_ncells',
+                        'target_data', 'target_labels', 'source_data', 'source_labels']),
+    comments = '# '
+)
+print('Gene ids saved to \'{0}\'.'.format(fout_geneids))
 
 print('Done.')
@@ -4,21 +4,26 @@ import argparse, sys
 from functools import partial
 from sklearn.manifold import TSNE
 
+from qc_index import get_qc_index, preview_filters
 from nmf_clustering import NmfClustering
+from preprocessing_cache import PREPROCESSING_CACHE
+from results_bundle import ResultsBundle
+from source_model import save_source_model
 from utils import *
 
 # --------------------------------------------------
 # PARSE COMMAND LINE ARGUMENTS
 # --------------------------------------------------
 parser = argparse.ArgumentParser()
-parser.add_argument("--fname", help="Source data (TSV file)", required=True, type=str, default=None)
-parser.add_argument("--fgene-ids", help="Source data gene ids (TSV file)", dest='fgene_ids', required=True, type=str, default=None)
+parser.add_argument("--fname", help="Source data (TSV file, binary dataset directory or sparse *.mtx/*.npz file)", required=True, type=str, default=None)
+parser.add_argument("--fgene-ids", help="Source data gene ids (TSV file, optional for binary datasets)", dest='fgene_ids', required=False, type=str, default=None)
 parser.add_argument("--fout", help="Result files will use this prefix.", default='src', type=str)
 parser.add_argument("--flabels", help="[optional] Cluster labels (TSV file)", required=False, type=str, default=None)
 
 parser.add_argument("--min_expr_genes", help="(Cell filter) Minimum number of expressed genes (default 2000)", default=2000, type=int)
 parser.add_argument("--non_zero_threshold", help="(Cell/gene filter) Threshold for zero expression per gene (default 1.0)", default=1.0, type=float)
 parser.add_argument("--perc_consensus_genes", help="(Gene filter) Filter genes that coincide across a percentage of cells (default 0.98)", default=0.98, type=float)
+parser.add_argument("--hvg_num_genes", help="(Gene filter) Keep only this number of highly variable genes after transformation (default 0 = all)", default=0, type=int)
 
 parser.add_argument("--cluster-range", help="Comma separated list of clusters (default 6,7,8,9)", dest='cluster_range', default='6,7,8,9', type=str)
 
@@ -75,14 +80,61 @@ parser.add_argument(
     action = 'store_false')
 parser.set_defaults(tsne=True)
 
+parser.add_argument(
+    "--results-bundle",
+    help = "Save all results into a single deduplicated binary bundle instead of TSV files.",
+    dest = "results_bundle",
+    action = 'store_true')
+parser.add_argument(
+    "--no-results-bundle",
+    help = "Save results as TSV files.",
+    dest = "results_bundle",
+    action = 'store_false')
+parser.set_defaults(results_bundle=False)
+
+parser.add_argument(
+    "--out-of-core",
+    help = "Write the pre-processed data chunk-wise into memory-mapped files (<fout>_*_pp.npy).",
+    dest = "out_of_core",
+    action = 'store_true')
+parser.add_argument(
+    "--no-out-of-core",
+    help = "Keep the pre-processed data in memory.",
+    dest = "out_of_core",
+    action = 'store_false')
+parser.set_defaults(out_of_core=False)
+
+parser.add_argument(
+    "--preview-filters",
+    help = "Only preview the number of remaining cells/genes for a grid of filter thresholds (uses a QC index).",
+    dest = "preview_filters",
+    action = 'store_true')
+parser.set_defaults(preview_filters=False)
+parser.add_argument("--preview-min-expr-genes", help="(Preview) Comma separated list of min_expr_genes (default 500,1000,2000,3000)", dest='preview_min_expr_genes', default='500,1000,2000,3000', type=str)
+parser.add_argument("--preview-non-zero-thresholds", help="(Preview) Comma separated list of non_zero_thresholds (default 1,2,3)", dest='preview_non_zero_thresholds', default='1,2,3', type=str)
+parser.add_argument("--preview-perc-consensus-genes", help="(Preview) Comma separated list of perc_consensus_genes (default 0.9,0.94,0.98)", dest='preview_perc_consensus_genes', default='0.9,0.94,0.98', type=str)
+
 arguments = parser.parse_args(sys.argv[1:])
 print('Command line arguments:')
 
+if arguments.preview_filters:
+    # the data is only loaded (parsed) if the QC index needs to be built
+    non_zero_thresholds = map(np.float, arguments.preview_non_zero_thresholds.split(","))
+    qc_index = get_qc_index(arguments.fname, lambda: load_dataset_file(arguments.fname, arguments.fgene_ids)[0],
+                            thresholds=non_zero_thresholds)
+    preview = preview_filters(qc_index,
+                              map(np.int, arguments.preview_min_expr_genes.split(",")),
+                              non_zero_thresholds,
+                              map(np.float, arguments.preview_perc_consensus_genes.split(",")))
+    np.savetxt('{0}_filter_preview.tsv'.format(arguments.fout), preview, fmt='%g', delimiter='\t',
+               header='min_expr_genes\tnon_zero_threshold\tperc_consensus_genes\tcells\ttranscripts')
+    sys.exit(0)
+
 # --------------------------------------------------
 # 1. LOAD DATA
 # --------------------------------------------------
 print("\nLoading  dataset (data={0} and gene_ids={1}).".format(arguments.fname, arguments.fgene_ids))
-data, gene_ids, labels = load_dataset_tsv(arguments.fname, arguments.fgene_ids, flabels=arguments.flabels)
+data, gene_ids, labels = load_dataset_file(arguments.fname, arguments.fgene_ids, flabels=arguments.flabels)
 print('Data  {1} cells and {0} genes/transcripts.'.format(data.shape[0], data.shape[1]))
 print np.unique(labels)
 
@@ -97,9 +149,13 @@ gene_filter_fun = lambda x: np.arange(x.shape[0]).tolist()
 if arguments.use_gene_filter:
     gene_filter_fun = partial(sc.gene_filter, perc_consensus_genes=arguments.perc_consensus_genes, non_zero_threshold=arguments.non_zero_threshold)
 
+hvg_filter_fun = None
+if arguments.hvg_num_genes > 0:
+    hvg_filter_fun = partial(sc.hvg_filter, num_genes=arguments.hvg_num_genes)
+
 data_transf_fun = lambda x: x
 if arguments.transform:
-    data_transf_fun = sc.data_transformation_log2
+    data_transf_fun = partial(sc.data_transformation_log2, inplace=True)
 
 # --------------------------------------------------
 # 3. CLUSTERING
@@ -109,6 +165,10 @@ num_cluster = map(np.int, arguments.cluster_range.split(","))
 accs_names = ['KTA (linear)', 'Silhouette (euc)', 'Silhouette (pearson)', 'Silhouette (spearman)', 'ARI']
 accs = np.zeros((5, len(num_cluster)))
 
+results = None
+if arguments.results_bundle:
+    results = ResultsBundle('{0}.results.npz'.format(arguments.fout))
+
 for i in range(len(num_cluster)):
     k = num_cluster[i]
     print('Iteration {0}, num-cluster={0}'.format(i, k))
@@ -120,7 +180,13 @@ for i in range(len(num_cluster)):
     nmf = NmfClustering(data, gene_ids, num_cluster=k)
     nmf.add_cell_filter(cell_filter_fun)
     nmf.add_gene_filter(gene_filter_fun)
+    if hvg_filter_fun is not None:
+        nmf.add_gene_filter(hvg_filter_fun, post_transform=True)
     nmf.set_data_transformation(data_transf_fun)
+    # all k share the same pre-processing
+    nmf.pp_cache = PREPROCESSING_CACHE
+    if arguments.out_of_core:
+        nmf.pp_fname = '{0}_c{1}_pp.npy'.format(arguments.fout, k)
     nmf.apply(k=k, alpha=arguments.nmf_alpha, l1=arguments.nmf_l1, max_iter=arguments.nmf_max_iter, rel_err=arguments.nmf_rel_err)
 
     # --------------------------------------------------
@@ -144,13 +210,15 @@ for i in range(len(num_cluster)):
     # --------------------------------------------------
     # 3.3. SAVE RESULTS
     # --------------------------------------------------
-    nmf.cell_filter_list = None
-    nmf.gene_filter_list = None
-    nmf.data_transf = None
-    print('\nSaving data structures and results to file with prefix \'{0}_c{1}\'.'.format(arguments.fout, k))
-    np.savez('{0}_c{1}.npz'.format(arguments.fout, k), src=nmf, args=arguments)
-    np.savetxt('{0}_c{1}_labels.tsv'.format(arguments.fout, k),
-               (nmf.cluster_labels, nmf.remain_cell_inds), fmt='%u', delimiter='\t')
+    print('\nSaving source model and results to files with prefix \'{0}_c{1}\'.'.format(arguments.fout, k))
+    save_source_model('{0}_c{1}.model'.format(arguments.fout, k), nmf, config=vars(arguments))
+    if results is not None:
+        results.add('c{0}.labels'.format(k), nmf.cluster_labels)
+        results.add('c{0}.remain_cell_inds'.format(k), nmf.remain_cell_inds)
+        results.add('c{0}.remain_gene_inds'.format(k), nmf.remain_gene_inds)
+    else:
+        np.savetxt('{0}_c{1}_labels.tsv'.format(arguments.fout, k),
+                   (nmf.cluster_labels, nmf.remain_cell_inds), fmt='%u', delimiter='\t')
 
     # --------------------------------------------------
     # 3.4. T-SNE PLOT
@@ -175,6 +243,12 @@ print 'Accuracy measures: ', accs_names
 print 'Accuracies:'
 print accs
 
+if results is not None:
+    results.add('accs', accs)
+    results.add('accs_names', accs_names)
+    results.add('cluster_range', num_cluster)
+    results.close()
+
 plt.figure(0)
 for i in range(accs.shape[0]):
     plt.subplot(1, accs.shape[0], i+1)
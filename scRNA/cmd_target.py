@@ -5,7 +5,11 @@ from functools import partial
 from sklearn.manifold import TSNE
 
 from sc3_clustering import SC3Clustering
+from qc_index import get_qc_index, preview_filters
 from nmf_clustering import DaNmfClustering, NmfClustering
+from preprocessing_cache import PREPROCESSING_CACHE
+from results_bundle import ResultsBundle
+from source_model import is_source_model, load_source_model
 from utils import *
 
 
@@ -13,15 +17,16 @@ from utils import *
 # PARSE COMMAND LINE ARGUMENTS
 # --------------------------------------------------
 parser = argparse.ArgumentParser()
-parser.add_argument("--src-fname", help="Source *.npz result filename", dest='src_fname', required=False, type=str, default=None)
-parser.add_argument("--fname", help="Target data (TSV file)", required=True, type=str, default=None)
-parser.add_argument("--fgene-ids", help="Target gene ids (TSV file)", dest='fgene_ids', required=True, type=str, default=None)
+parser.add_argument("--src-fname", help="Source model directory (*.model, or legacy *.npz result filename)", dest='src_fname', required=False, type=str, default=None)
+parser.add_argument("--fname", help="Target data (TSV file, binary dataset directory or sparse *.mtx/*.npz file)", required=True, type=str, default=None)
+parser.add_argument("--fgene-ids", help="Target gene ids (TSV file, optional for binary datasets)", dest='fgene_ids', required=False, type=str, default=None)
 parser.add_argument("--fout", help="Result files will use this prefix.", default='trg', type=str)
 parser.add_argument("--flabels", help="[optional] Target cluster labels (TSV file)", required=False, type=str, default=None)
 
 parser.add_argument("--min_expr_genes", help="(Cell filter) Minimum number of expressed genes (default 2000)", default=2000, type=int)
 parser.add_argument("--non_zero_threshold", help="(Cell/gene filter) Threshold for zero expression per gene (default 1.0)", default=1.0, type=float)
 parser.add_argument("--perc_consensus_genes", help="(Gene filter) Filter genes that coincide across a percentage of cells (default 0.98)", default=0.98, type=float)
+parser.add_argument("--hvg_num_genes", help="(Gene filter) Keep only this number of highly variable genes after transformation (default 0 = all)", default=0, type=int)
 
 parser.add_argument("--cluster-range", help="Comma separated list of clusters (default 6,7,8)", dest='cluster_range', default='5,6,7,8,9', type=str)
 parser.add_argument("--mixtures", help="Comma separated list of convex combination src-trg mixture coefficient (0.=no transfer, default 0.1)", default="0.0,0.1,0.4,0.8", type = str)
@@ -77,14 +82,61 @@ parser.add_argument(
     action = 'store_false')
 parser.set_defaults(tsne=True)
 
+parser.add_argument(
+    "--results-bundle",
+    help = "Save all results into a single deduplicated binary bundle instead of TSV files.",
+    dest = "results_bundle",
+    action = 'store_true')
+parser.add_argument(
+    "--no-results-bundle",
+    help = "Save results as TSV files.",
+    dest = "results_bundle",
+    action = 'store_false')
+parser.set_defaults(results_bundle=False)
+
+parser.add_argument(
+    "--out-of-core",
+    help = "Write the pre-processed data chunk-wise into memory-mapped files (<fout>_*_pp.npy).",
+    dest = "out_of_core",
+    action = 'store_true')
+parser.add_argument(
+    "--no-out-of-core",
+    help = "Keep the pre-processed data in memory.",
+    dest = "out_of_core",
+    action = 'store_false')
+parser.set_defaults(out_of_core=False)
+
+parser.add_argument(
+    "--preview-filters",
+    help = "Only preview the number of remaining cells/genes for a grid of filter thresholds (uses a QC index).",
+    dest = "preview_filters",
+    action = 'store_true')
+parser.set_defaults(preview_filters=False)
+parser.add_argument("--preview-min-expr-genes", help="(Preview) Comma separated list of min_expr_genes (default 500,1000,2000,3000)", dest='preview_min_expr_genes', default='500,1000,2000,3000', type=str)
+parser.add_argument("--preview-non-zero-thresholds", help="(Preview) Comma separated list of non_zero_thresholds (default 1,2,3)", dest='preview_non_zero_thresholds', default='1,2,3', type=str)
+parser.add_argument("--preview-perc-consensus-genes", help="(Preview) Comma separated list of perc_consensus_genes (default 0.9,0.94,0.98)", dest='preview_perc_consensus_genes', default='0.9,0.94,0.98', type=str)
+
 arguments = parser.parse_args(sys.argv[1:])
 print('Command line arguments:')
 
+if arguments.preview_filters:
+    # the data is only loaded (parsed) if the QC index needs to be built
+    non_zero_thresholds = map(np.float, arguments.preview_non_zero_thresholds.split(","))
+    qc_index = get_qc_index(arguments.fname, lambda: load_dataset_file(arguments.fname, arguments.fgene_ids)[0],
+                            thresholds=non_zero_thresholds)
+    preview = preview_filters(qc_index,
+                              map(np.int, arguments.preview_min_expr_genes.split(",")),
+                              non_zero_thresholds,
+                              map(np.float, arguments.preview_perc_consensus_genes.split(",")))
+    np.savetxt('{0}_filter_preview.tsv'.format(arguments.fout), preview, fmt='%g', delimiter='\t',
+               header='min_expr_genes\tnon_zero_threshold\tperc_consensus_genes\tcells\ttranscripts')
+    sys.exit(0)
+
 # --------------------------------------------------
 # 1. LOAD DATA
 # --------------------------------------------------
 print("\nLoading target dataset (data={0} and gene_ids={1}).".format(arguments.fname, arguments.fgene_ids))
-data, gene_ids, labels = load_dataset_tsv(arguments.fname, arguments.fgene_ids, flabels=arguments.flabels)
+data, gene_ids, labels = load_dataset_file(arguments.fname, arguments.fgene_ids, flabels=arguments.flabels)
 
 # inds = np.random.permutation(data.shape[1])[:80]
 # data = data[:, inds]
@@ -105,9 +157,13 @@ gene_filter_fun = lambda x: np.arange(x.shape[0]).tolist()
 if arguments.use_gene_filter:
     gene_filter_fun = partial(sc.gene_filter, perc_consensus_genes=arguments.perc_consensus_genes, non_zero_threshold=arguments.non_zero_threshold)
 
+hvg_filter_fun = None
+if arguments.hvg_num_genes > 0:
+    hvg_filter_fun = partial(sc.hvg_filter, num_genes=arguments.hvg_num_genes)
+
 data_transf_fun = lambda x: x
 if arguments.transform:
-    data_transf_fun = sc.data_transformation_log2
+    data_transf_fun = partial(sc.data_transformation_log2, inplace=True)
 
 # --------------------------------------------------
 # 3. CLUSTERING
@@ -121,6 +177,10 @@ accs_dist = np.zeros((len(accs_names), len(mixtures), len(num_cluster)))
 accs_mix = np.zeros((len(accs_names), len(mixtures), len(num_cluster)))
 accs_trans = np.zeros((len(mixtures), len(num_cluster)))
 
+results = None
+if arguments.results_bundle:
+    results = ResultsBundle('{0}.results.npz'.format(arguments.fout))
+
 for i in range(len(num_cluster)):
     for j in range(len(mixtures)):
         k = num_cluster[i]
@@ -130,28 +190,42 @@ for i in range(len(num_cluster)):
         # --------------------------------------------------
         # 3.1. MIX TARGET & SOURCE DATE
         # --------------------------------------------------
-        src_data = np.load(arguments.src_fname)  # src data gets while applying da_nmf...
-        src_nmf = src_data['src'][()]
-        print type(src_nmf)
-        src_nmf.cell_filter_list = list()
-        src_nmf.gene_filter_list = list()
-
-        src_nmf.add_cell_filter(lambda x: np.arange(x.shape[1]).tolist())
-        src_nmf.add_gene_filter(lambda x: np.arange(x.shape[0]).tolist())
-        src_nmf.set_data_transformation(lambda x: x)
-
-        da_nmf = DaNmfClustering(src_nmf, data, gene_ids, k)
-        da_nmf.add_cell_filter(cell_filter_fun)
-        da_nmf.add_gene_filter(gene_filter_fun)
-        da_nmf.set_data_transformation(data_transf_fun)
-        calc_transf = False
-        if i == 0 and j == 0:
-            calc_transf = True
-        mix_data, _, _ = da_nmf.get_mixed_data(k=k, mix=mix, reject_ratio=0.,
-                                               calc_transferability=calc_transf, max_iter=2000)
-        mix_gene_ids = da_nmf.common_ids
-        if calc_transf:
-            _, accs_trans[j, i] = da_nmf.reject[-1]
+        # The da-nmf model does not depend on the mixture, i.e. it is fit once per number of
+        # clusters and shared by all mixtures (mixed data and transfer learning distances).
+        if j == 0:
+            # src data gets changed while applying da_nmf, hence, (re-)load it for every model
+            if is_source_model(arguments.src_fname):
+                # memory-mapped, no unpickling
+                src_nmf, _ = load_source_model(arguments.src_fname)
+            else:
+                src_data = np.load(arguments.src_fname)
+                src_nmf = src_data['src'][()]
+                print type(src_nmf)
+                src_nmf.cell_filter_list = list()
+                src_nmf.gene_filter_list = list()
+
+                src_nmf.add_cell_filter(lambda x: np.arange(x.shape[1]).tolist())
+                src_nmf.add_gene_filter(lambda x: np.arange(x.shape[0]).tolist())
+                src_nmf.set_data_transformation(lambda x: x)
+
+            da_nmf = DaNmfClustering(src_nmf, data, gene_ids, k)
+            da_nmf.add_cell_filter(cell_filter_fun)
+            da_nmf.add_gene_filter(gene_filter_fun)
+            if hvg_filter_fun is not None:
+                da_nmf.add_gene_filter(hvg_filter_fun, post_transform=True)
+            da_nmf.set_data_transformation(data_transf_fun)
+            # the target data is pre-processed the same way for every number of clusters
+            da_nmf.pp_cache = PREPROCESSING_CACHE
+            if arguments.out_of_core:
+                da_nmf.pp_fname = '{0}_k{1}_da_nmf_pp.npy'.format(arguments.fout, k)
+            calc_transf = i == 0
+            _, rec_data, trg_data = da_nmf.get_mixed_data(k=k, mix=0.0, reject_ratio=0.,
+                                                          calc_transferability=calc_transf, max_iter=2000)
+            mix_gene_ids = da_nmf.common_ids
+            if calc_transf:
+                _, accs_trans[j, i] = da_nmf.reject[-1]
+        # same as get_mixed_data(mix=mix) of the shared model
+        mix_data = mix*rec_data + (1.-mix)*trg_data
 
         # --------------------------------------------------
         # 3.2. TARGET DATA CLUSTERING
@@ -161,15 +235,23 @@ for i in range(len(num_cluster)):
         max_pca_comp = np.ceil(num_cells*0.07).astype(np.int)
         min_pca_comp = np.floor(num_cells*0.04).astype(np.int)
         print('(Max/Min) PCA components: ({0}/{1})'.format(max_pca_comp, min_pca_comp))
-        sc3_dist = SC3Clustering(data, gene_ids,
-                                pc_range=[min_pca_comp, max_pca_comp], sub_sample=True, consensus_mode=0)
+        if j == 0:
+            # transfer learning distances for all mixtures are computed (and clustered) at once
+            # with the shared da-nmf model
+            sc3_dist = SC3Clustering(data, gene_ids,
+                                     pc_range=[min_pca_comp, max_pca_comp], sub_sample=True, consensus_mode=0)
+            sc3_dist.add_cell_filter(cell_filter_fun)
+            sc3_dist.add_gene_filter(gene_filter_fun)
+            if hvg_filter_fun is not None:
+                sc3_dist.add_gene_filter(hvg_filter_fun, post_transform=True)
+            sc3_dist.set_data_transformation(data_transf_fun)
+            sc3_dist.pp_cache = PREPROCESSING_CACHE
+            if arguments.out_of_core:
+                sc3_dist.pp_fname = '{0}_k{1}_sc3_dist_pp.npy'.format(arguments.fout, k)
+
         sc3_mix = SC3Clustering(mix_data, mix_gene_ids,
                                 pc_range=[min_pca_comp, max_pca_comp], sub_sample=True, consensus_mode=0)
 
-        sc3_dist.add_cell_filter(cell_filter_fun)
-        sc3_dist.add_gene_filter(gene_filter_fun)
-        sc3_dist.set_data_transformation(data_transf_fun)
-
         sc3_mix.add_cell_filter(cell_filter_fun)
         sc3_mix.add_gene_filter(gene_filter_fun)
         sc3_mix.set_data_transformation(data_transf_fun)
@@ -177,12 +259,13 @@ for i in range(len(num_cluster)):
         dist_list = arguments.sc3_dists.split(",")
         print('\nThere are {0} distances given.'.format(len(dist_list)))
         for ds in dist_list:
-            print('- Adding transfer learning distance {0}'.format(ds))
-            sc3_dist.add_distance_calculation(partial(sc.da_nmf_distances,
-                                                            da_model=da_nmf.intermediate_model,
-                                                            reject_ratio=0.,
-                                                            metric=ds,
-                                                            mixture=mix))
+            if j == 0:
+                print('- Adding transfer learning distance {0} (mixtures {1})'.format(ds, mixtures))
+                sc3_dist.add_distance_sweep(partial(sc.da_nmf_distances_sweep,
+                                                    da_model=da_nmf.intermediate_model,
+                                                    mixtures=mixtures,
+                                                    reject_ratio=0.,
+                                                    metric=ds))
             print('- Adding distance {0}'.format(ds))
             sc3_mix.add_distance_calculation(partial(sc.distances, metric=ds))
 
@@ -190,13 +273,16 @@ for i in range(len(num_cluster)):
         print('\nThere are {0} transformations given.'.format(len(transf_list)))
         for ts in transf_list:
             print('- Adding transformation {0}'.format(ts))
-            sc3_dist.add_dimred_calculation(partial(sc.transformations, components=max_pca_comp, method=ts))
+            if j == 0:
+                sc3_dist.add_dimred_calculation(partial(sc.transformations, components=max_pca_comp, method=ts))
             sc3_mix.add_dimred_calculation(partial(sc.transformations, components=max_pca_comp, method=ts))
 
-        sc3_dist.add_intermediate_clustering(partial(sc.intermediate_kmeans_clustering, k=k))
-        sc3_dist.set_build_consensus_matrix(sc.build_consensus_matrix)
-        sc3_dist.set_consensus_clustering(partial(sc.consensus_clustering, n_components=k))
-        sc3_dist.apply()
+        if j == 0:
+            sc3_dist.add_intermediate_clustering(partial(sc.intermediate_kmeans_clustering, k=k))
+            sc3_dist.set_build_consensus_matrix(sc.build_consensus_matrix)
+            sc3_dist.set_consensus_clustering(partial(sc.consensus_clustering, n_components=k))
+            sc3_dist_labels = [lbls for _, lbls, _ in sc3_dist.apply_sweep()]
+        sc3_dist.cluster_labels = sc3_dist_labels[j]
 
         sc3_mix.add_intermediate_clustering(partial(sc.intermediate_kmeans_clustering, k=k))
         sc3_mix.set_build_consensus_matrix(sc.build_consensus_matrix)
@@ -226,15 +312,26 @@ for i in range(len(num_cluster)):
         # --------------------------------------------------
         # 3.4. SAVE RESULTS
         # --------------------------------------------------
-        print('\nSaving data structures and results to file with prefix \'{0}_m{1}_c{2}\'.'.format(arguments.fout, mix, k))
-        np.savetxt('{0}_m{1}_c{2}.labels.sc3_dist.tsv'.format(arguments.fout, mix, k),
-                   (sc3_dist.cluster_labels, sc3_dist.remain_cell_inds), fmt='%u', delimiter='\t')
-        np.savetxt('{0}_m{1}_c{2}.labels.sc3_mix.tsv'.format(arguments.fout, mix, k),
-                   (sc3_mix.cluster_labels, sc3_mix.remain_cell_inds), fmt='%u', delimiter='\t')
-        np.savetxt('{0}_m{1}_c{2}.data.tsv'.format(arguments.fout, mix, k),
-                   (sc3_mix.pp_data), fmt='%u', delimiter='\t')
-        np.savetxt('{0}_m{1}_c{2}.geneids.tsv'.format(arguments.fout, mix, k),
-                   (mix_gene_ids), fmt='%s', delimiter='\t')
+        if results is not None:
+            # repeated arrays (e.g. pre-processed data for the same mixture) are stored only once
+            print('\nAdding results for mix={0} and k={1} to the results bundle.'.format(mix, k))
+            key = 'm{0}_c{1}'.format(mix, k)
+            results.add('{0}.labels.sc3_dist'.format(key), sc3_dist.cluster_labels)
+            results.add('{0}.remain_cell_inds.sc3_dist'.format(key), sc3_dist.remain_cell_inds)
+            results.add('{0}.labels.sc3_mix'.format(key), sc3_mix.cluster_labels)
+            results.add('{0}.remain_cell_inds.sc3_mix'.format(key), sc3_mix.remain_cell_inds)
+            results.add('{0}.data'.format(key), sc3_mix.pp_data)
+            results.add('{0}.geneids'.format(key), mix_gene_ids)
+        else:
+            print('\nSaving data structures and results to file with prefix \'{0}_m{1}_c{2}\'.'.format(arguments.fout, mix, k))
+            np.savetxt('{0}_m{1}_c{2}.labels.sc3_dist.tsv'.format(arguments.fout, mix, k),
+                       (sc3_dist.cluster_labels, sc3_dist.remain_cell_inds), fmt='%u', delimiter='\t')
+            np.savetxt('{0}_m{1}_c{2}.labels.sc3_mix.tsv'.format(arguments.fout, mix, k),
+                       (sc3_mix.cluster_labels, sc3_mix.remain_cell_inds), fmt='%u', delimiter='\t')
+            np.savetxt('{0}_m{1}_c{2}.data.tsv'.format(arguments.fout, mix, k),
+                       (sc3_mix.pp_data), fmt='%u', delimiter='\t')
+            np.savetxt('{0}_m{1}_c{2}.geneids.tsv'.format(arguments.fout, mix, k),
+                       (mix_gene_ids), fmt='%s', delimiter='\t')
 
         # --------------------------------------------------
         # 3.5. T-SNE PLOT
@@ -265,10 +362,21 @@ for i in range(len(num_cluster)):
 # --------------------------------------------------
 print 'Mixtures:', mixtures
 print 'Cluster:', num_cluster
+print 'DA-NMF model: one per number of clusters, shared by all mixtures (sc3-dist and sc3-mix).'
 
 print 'ACCS MIX:', accs_mix
 print 'ACCS DIST:', accs_dist
 
+if results is not None:
+    results.add('accs_mix', accs_mix)
+    results.add('accs_dist', accs_dist)
+    results.add('accs_trans', accs_trans)
+    results.add('accs_names', accs_names)
+    results.add('mixtures', mixtures)
+    results.add('cluster_range', num_cluster)
+    results.add('da_model', 'shared by all mixtures')
+    results.close()
+
 plt.figure(0)
 for i in range(accs_mix.shape[0]):
     print('\n{0} (mixtures x cluster) [sc3-dist, sc3-mix]:'.format(accs_names[i]))
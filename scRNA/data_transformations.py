@@ -0,0 +1,145 @@
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.sparse as sp
+
+# Data transformations (log2(x+1), CPM/RPM and combinations) for transcripts x cells
+# data matrices. Floating point data is transformed in-place (if allowed) in chunks
+# of rows or columns (whatever is contiguous) on a thread pool (numpy releases the GIL),
+# all other data is transformed in a single (float) copy.
+
+
+def chunk_slices(num_cells, chunk_size):
+    return [slice(i, min(i+chunk_size, num_cells)) for i in range(0, num_cells, chunk_size)]
+
+
+def run_chunked(fun, num_cells, chunk_size=1000, num_threads=None):
+    """
+    :param fun: function that is applied to every slice of columns
+    :param num_cells: number of columns
+    :param chunk_size: number of columns per chunk
+    :param num_threads: number of threads (default: number of cpus, at most 4)
+    """
+    if num_threads is None:
+        num_threads = min(4, cpu_count())
+    slices = chunk_slices(num_cells, chunk_size)
+    if num_threads <= 1 or len(slices) <= 1:
+        map(fun, slices)
+        return
+    pool = ThreadPool(processes=num_threads)
+    try:
+        pool.map(fun, slices)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def float_copy(data, dtype):
+    if sp.issparse(data):
+        return data.astype(dtype)
+    # keep the memory layout (C or Fortran) of the data
+    return np.array(data, dtype=dtype, order='K')
+
+
+def chunk_axis(X):
+    """
+    :return: axis along which chunks of X are contiguous in memory (0 = rows, 1 = columns)
+    """
+    if X.flags.c_contiguous and not X.flags.f_contiguous:
+        return 0
+    return 1
+
+
+def chunk_view(X, axis, s):
+    if axis == 0:
+        return X[s, :]
+    return X[:, s]
+
+
+def transform_log2p1(data, inplace=True, dtype=np.float64, chunk_size=1000, num_threads=None):
+    """
+    :param data: transcripts x cells data matrix (dense or sparse)
+    :param inplace: transform floating point data in-place
+    :param dtype: float dtype of the result if a new array is needed (integer data or inplace=False)
+    :param chunk_size: number of cells (or transcripts for C-ordered data) per chunk
+    :param num_threads: number of threads
+    :return: log2(data+1) (sparse data stays sparse)
+    """
+    if sp.issparse(data):
+        # log2(0+1) = 0, hence, only stored values need to be transformed
+        X = data
+        values = data.data.reshape((1, data.data.size))
+        if not (inplace and data.dtype.kind == 'f'):
+            X = data.copy()
+            X.data = transform_log2p1(values, inplace=False, dtype=dtype,
+                                      chunk_size=chunk_size*1000, num_threads=num_threads).ravel()
+            return X
+        transform_log2p1(values, inplace=True, chunk_size=chunk_size*1000, num_threads=num_threads)
+        return X
+
+    X = data
+    if not (inplace and data.dtype.kind == 'f'):
+        X = float_copy(data, dtype)
+    axis = chunk_axis(X)
+
+    def log2p1(s):
+        chunk = chunk_view(X, axis, s)
+        np.add(chunk, 1., out=chunk)
+        np.log2(chunk, out=chunk)
+    run_chunked(log2p1, X.shape[axis], chunk_size, num_threads)
+    return X
+
+
+def transform_cpm(data, scale=1e6, inplace=True, dtype=np.float64, chunk_size=1000, num_threads=None):
+    """
+    Counts per million: every cell (column) is scaled to a total of 'scale'.
+    Cells without any counts stay zero.
+    :param data: transcripts x cells data matrix (dense or sparse)
+    :param scale: target library size (1e6 = per million)
+    :param inplace: transform floating point data in-place
+    :param dtype: float dtype of the result if a new array is needed (integer data or inplace=False)
+    :param chunk_size: number of cells (or transcripts for C-ordered data) per chunk
+    :param num_threads: number of threads
+    :return: scaled data
+    """
+    X = data
+    if not (inplace and data.dtype.kind == 'f'):
+        X = float_copy(data, dtype)
+    lib_sizes = np.asarray(X.sum(axis=0), dtype=np.float64).ravel()
+    factors = np.zeros(lib_sizes.size)
+    factors[lib_sizes > 0] = scale / lib_sizes[lib_sizes > 0]
+    factors = factors.astype(X.dtype)
+
+    if sp.issparse(X):
+        if X.format not in ['csc', 'csr']:
+            X = X.tocsc()
+        if X.format == 'csc':
+            X.data *= np.repeat(factors, np.diff(X.indptr))
+        else:
+            X.data *= factors[X.indices]
+        return X
+
+    axis = chunk_axis(X)
+
+    def scale_cells(s):
+        chunk = chunk_view(X, axis, s)
+        if axis == 0:
+            np.multiply(chunk, factors[np.newaxis, :], out=chunk)
+        else:
+            np.multiply(chunk, factors[s], out=chunk)
+    run_chunked(scale_cells, X.shape[axis], chunk_size, num_threads)
+    return X
+
+
+# reads per million (RPM) is the same scaling applied to read counts
+transform_rpm = transform_cpm
+
+
+def transform_log2_cpm(data, scale=1e6, inplace=True, dtype=np.float64, chunk_size=1000, num_threads=None):
+    """
+    :return: log2(CPM+1) transformed data, see transform_cpm and transform_log2p1
+    """
+    X = transform_cpm(data, scale=scale, inplace=inplace, dtype=dtype, chunk_size=chunk_size, num_threads=num_threads)
+    # X is either the (in-place transformed) data or a private copy
+    return transform_log2p1(X, inplace=True, dtype=dtype, chunk_size=chunk_size, num_threads=num_threads)
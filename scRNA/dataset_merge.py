@@ -0,0 +1,77 @@
+import numpy as np
+
+from binary_dataset import create_binary_dataset
+
+
+def map_gene_ids(gene_ids, lookup_ids, lookup_names):
+    """
+    :param gene_ids: #transcripts vector of gene ids (e.g. Ensembl ids)
+    :param lookup_ids: lookup table ids (e.g. Ensembl ids)
+    :param lookup_names: corresponding lookup table names (e.g. gene names)
+    :return: names of the mapped gene ids, indices of the mapped gene ids (unmapped ids are dropped)
+    """
+    gene_ids = np.asarray(gene_ids).astype(np.str)
+    lookup_ids = np.asarray(lookup_ids).astype(np.str)
+    # stable sort and left-sided search: the first occurrence in the lookup table wins
+    order = np.argsort(lookup_ids, kind='mergesort')
+    sorted_ids = lookup_ids[order]
+    pos = np.searchsorted(sorted_ids, gene_ids, side='left')
+    pos[pos >= sorted_ids.size] = 0
+    inds = np.where(sorted_ids[pos] == gene_ids)[0]
+    print('{0} of {1} gene ids could be mapped.'.format(inds.size, gene_ids.size))
+    return np.asarray(lookup_names)[order[pos[inds]]], inds
+
+
+def align_gene_ids(gene_ids_list):
+    """
+    :param gene_ids_list: list of #transcripts vectors with gene ids (one for each dataset)
+    :return: sorted common gene ids, list of corresponding row indices (first occurrence) for each dataset
+    """
+    uniques = list()
+    common_ids = None
+    for gene_ids in gene_ids_list:
+        ids, first_inds = np.unique(np.asarray(gene_ids).astype(np.str), return_index=True)
+        if not ids.size == len(gene_ids):
+            print('Warning! Gene ids are supposed to be unique. '
+                  'Only {0} of {1} entries are unique, first occurrence will be used.'.format(ids.size, len(gene_ids)))
+        uniques.append((ids, first_inds))
+        if common_ids is None:
+            common_ids = ids
+        else:
+            common_ids = np.intersect1d(common_ids, ids, assume_unique=True)
+    inds_list = list()
+    for ids, first_inds in uniques:
+        inds_list.append(first_inds[np.searchsorted(ids, common_ids)])
+    return common_ids, inds_list
+
+
+def merge_datasets(datasets, gene_ids_list, fout=None, dtype=None, chunk_size=1000):
+    """
+    :param datasets: list of transcripts x cells data matrices
+    :param gene_ids_list: list of corresponding #transcripts vectors with gene ids
+    :param fout: [optional] binary dataset directory, if given the merged data is written into a memory-map
+    :param dtype: [optional] dtype of the merged data (default: common dtype of all datasets)
+    :param chunk_size: number of cells that are copied at once
+    :return: common genes x (all) cells merged data matrix, sorted common gene ids
+    """
+    assert len(datasets) == len(gene_ids_list)
+    common_ids, inds_list = align_gene_ids(gene_ids_list)
+    num_cells = np.sum([data.shape[1] for data in datasets])
+    print('Merging {0} datasets: {1} genes in common, {2} cells in total.'.format(
+        len(datasets), common_ids.size, num_cells))
+    if dtype is None:
+        dtype = np.result_type(*[data.dtype for data in datasets])
+    if fout is not None:
+        merged = create_binary_dataset(fout, (common_ids.size, num_cells), dtype, common_ids)
+    else:
+        merged = np.empty((common_ids.size, num_cells), dtype=dtype, order='F')
+
+    offset = 0
+    for data, inds in zip(datasets, inds_list):
+        for i in range(0, data.shape[1], chunk_size):
+            chunk = data[inds, i:i+chunk_size]
+            merged[:, offset+i:offset+i+chunk.shape[1]] = chunk
+        offset += data.shape[1]
+    if fout is not None:
+        merged.flush()
+    return merged, common_ids
@@ -0,0 +1,87 @@
+import numpy as np
+import scipy.sparse as sp
+
+# Data summaries (mean, median, max, percentiles) for diagnostic output. Mean and
+# max are exact (single pass, no sorting), median and percentiles are estimated
+# from a fixed-size random sample of the entries. For sparse data, only stored
+# values are sampled and implicit zeros are accounted for exactly.
+DEFAULT_SAMPLE_SIZE = 100000
+PERCENTILES = [50, 75, 90, 99]
+
+
+def weighted_percentiles(values, zeros_weight, percentiles):
+    """
+    :param values: sample of (stored) values
+    :param zeros_weight: fraction of (implicit) zeros in the full data
+    :param percentiles: list of percentiles in [0, 100]
+    :return: percentiles of the mixture of the sample and the implicit zeros
+    """
+    values = np.sort(np.asarray(values, dtype=np.float64))
+    # empirical cdf of the sample, scaled to the fraction of stored values
+    cdf = (np.arange(values.size) + 1.) / np.float(max(1, values.size)) * (1. - zeros_weight)
+    # implicit zeros are inserted behind the negative values
+    num_neg = np.searchsorted(values, 0., side='left')
+    cdf[num_neg:] += zeros_weight
+    neg_cdf = np.float(num_neg) / np.float(max(1, values.size)) * (1. - zeros_weight)
+    res = np.zeros(len(percentiles))
+    for i in range(len(percentiles)):
+        q = percentiles[i] / 100.
+        if values.size == 0 or (neg_cdf < q <= neg_cdf + zeros_weight):
+            res[i] = 0.
+        else:
+            res[i] = values[min(values.size - 1, np.searchsorted(cdf, q, side='left'))]
+    return res
+
+
+def data_summary(X, sample_size=DEFAULT_SAMPLE_SIZE, exact=False, seed=0):
+    """
+    :param X: data matrix (dense or sparse)
+    :param sample_size: number of sampled entries for median and percentiles
+    :param exact: compute median and percentiles on all entries (full sort)
+    :param seed: seed of the (private) random state, the global random state is not used
+    :return: dictionary with mean, median, max, percentiles, density, sample_size and exact
+    """
+    summary = dict()
+    num_entries = X.shape[0] * X.shape[1]
+    summary['exact'] = exact
+    if num_entries == 0:
+        summary.update(mean=np.nan, median=np.nan, max=np.nan, density=0.,
+                       percentiles=np.nan*np.ones(len(PERCENTILES)), sample_size=0)
+        return summary
+    rs = np.random.RandomState(seed)
+    if sp.issparse(X):
+        X = X.tocsc() if X.format not in ['csc', 'csr'] else X
+        values = X.data
+        zeros_weight = 1. - np.float(values.size) / np.float(num_entries)
+        summary['mean'] = np.sum(values) / np.float(num_entries)
+        summary['max'] = np.max(values) if values.size > 0 else 0.
+        if values.size < num_entries:
+            # implicit zeros
+            summary['max'] = max(0., summary['max'])
+        summary['density'] = 1. - zeros_weight
+        if not exact and values.size > sample_size:
+            values = values[rs.randint(0, values.size, sample_size)]
+        else:
+            summary['exact'] = True
+        summary['sample_size'] = values.size
+        percs = weighted_percentiles(values, zeros_weight, [50] + PERCENTILES)
+    else:
+        summary['mean'] = np.mean(X)
+        summary['max'] = np.max(X)
+        summary['density'] = np.float(np.count_nonzero(X)) / np.float(num_entries)
+        if exact or num_entries <= sample_size:
+            values = np.asarray(X).ravel()
+            summary['exact'] = True
+        else:
+            values = X[rs.randint(0, X.shape[0], sample_size), rs.randint(0, X.shape[1], sample_size)]
+        summary['sample_size'] = values.size
+        percs = np.percentile(values, [50] + PERCENTILES)
+    summary['median'] = percs[0]
+    summary['percentiles'] = percs[1:]
+    return summary
+
+
+def print_data_summary(summary):
+    estimate = '' if summary['exact'] else ' (estimated from {0} entries)'.format(summary['sample_size'])
+    print '- Mean\\median\\max values: ', summary['mean'], summary['median'], summary['max']
+    print '- Percentiles{0}: '.format(estimate), summary['percentiles']
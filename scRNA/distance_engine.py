@@ -0,0 +1,384 @@
+import hashlib
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.spatial.distance as dist
+
+from results_bundle import array_sha1
+
+# Pairwise (cell x cell) distances written into a single preallocated symmetric
+# output. Euclidean distances use the Gram matrix identity
+#   ||x - y||^2 = ||x||^2 + ||y||^2 - 2 x'y
+# and Pearson distances the Gram matrix of standardized columns, i.e. both are a
+# single (multi-threaded) BLAS matrix product. All other metrics are computed in
+# tiles of the upper triangle (scipy cdist) on a thread pool. Spearman distances
+# are Pearson distances of the (cached) cell-wise ranks. Sparse data is never
+# densified as a whole: Gram matrices are built from sparse-dense block products
+# and Pearson correlations use mean corrections instead of centering. Distances of
+# low-rank products W H (e.g. NMF reconstructions) are computed from the small
+# factors only.
+DEFAULT_BLOCK_SIZE = 512
+RANK_CACHE_SIZE = 2
+RANK_CACHE = OrderedDict()
+
+
+def get_output(n, dtype, out=None):
+    """
+    :param n: number of samples
+    :param dtype: float dtype of the distances
+    :param out: [optional] preallocated (C-contiguous) n x n output
+    :return: n x n output array
+    """
+    if out is None:
+        return np.empty((n, n), dtype=dtype)
+    if not out.shape == (n, n) or not out.dtype == np.dtype(dtype) or not out.flags.c_contiguous:
+        raise Exception('Distance output needs to be a C-contiguous {0}x{0} array of dtype {1}.'.format(
+            n, np.dtype(dtype).name))
+    return out
+
+
+def block_slices(n, block_size):
+    return [slice(i, min(i+block_size, n)) for i in range(0, n, block_size)]
+
+
+def mirror_upper(out, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Copies the upper triangle of the square matrix out into its lower triangle (block-wise, in-place).
+    """
+    for s in block_slices(out.shape[0], block_size):
+        out[s, :s.start] = out[:s.start, s].T
+        blk = out[s, s]
+        blk[:] = np.triu(blk) + np.triu(blk, 1).T
+
+
+def samples_matrix(data, dtype, copy=False):
+    """
+    :param data: features x samples (i.e. transcripts x cells) data matrix
+    :param copy: always return a copy (otherwise, Fortran-ordered data of matching dtype is not copied)
+    :return: samples x features C-contiguous array of dtype
+    """
+    return np.array(np.asarray(data).T, dtype=dtype, order='C', copy=copy)
+
+
+def gram(Xt, out):
+    """
+    :param Xt: samples x features
+    :param out: samples x samples output
+    :return: Xt Xt' (written into out)
+    """
+    np.dot(Xt, Xt.T, out=out)
+    return out
+
+
+def sparse_gram(data, out, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    :param data: features x samples sparse data matrix
+    :param out: samples x samples output
+    :return: upper (block) triangle of data' data (written into out), squared norms of the samples
+    """
+    X = data.tocsc().astype(out.dtype)
+    Xt = X.T.tocsr()
+    for s in block_slices(X.shape[1], block_size):
+        # only a features x block_size slice is dense at any time
+        block = X[:, s].toarray()
+        out[s, s.start:] = Xt[s.start:, :].dot(block).T
+    sq = np.asarray(X.multiply(X).sum(axis=0)).ravel()
+    return out, sq.astype(out.dtype)
+
+
+def euclidean_distances(data, squared=False, dtype=np.float64, out=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    :param data: features x samples data matrix
+    :param squared: return squared Euclidean distances
+    :param dtype: float dtype of the computation (np.float32 halves memory and doubles the speed)
+    :param out: [optional] preallocated samples x samples output
+    :return: samples x samples Euclidean distance matrix
+    """
+    n = data.shape[1]
+    if sp.issparse(data):
+        out, sq = sparse_gram(data, get_output(n, dtype, out), block_size)
+    else:
+        Xt = samples_matrix(data, dtype)
+        out = gram(Xt, get_output(n, dtype, out))
+        sq = np.einsum('ij,ij->i', Xt, Xt)
+        del Xt
+    for s in block_slices(n, block_size):
+        blk = out[s, s.start:]
+        blk *= -2.
+        blk += sq[s, np.newaxis]
+        blk += sq[np.newaxis, s.start:]
+        # rounding errors might lead to (small) negative values
+        np.maximum(blk, 0., out=blk)
+        if not squared:
+            np.sqrt(blk, out=blk)
+    mirror_upper(out, block_size)
+    out.flat[::n+1] = 0.
+    return out
+
+
+def pearson_distances(data, dtype=np.float64, out=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    :param data: features x samples data matrix
+    :param dtype: float dtype of the computation
+    :param out: [optional] preallocated samples x samples output
+    :return: samples x samples Pearson distance matrix (1 - correlation)
+    """
+    if sp.issparse(data):
+        return sparse_pearson_distances(data, dtype=dtype, out=out, block_size=block_size)
+    # Xt is changed in-place
+    Xt = samples_matrix(data, dtype, copy=True)
+    Xt -= np.mean(Xt, axis=1)[:, np.newaxis]
+    return cosine_distances(Xt, dtype=dtype, out=out, block_size=block_size)
+
+
+def cosine_distances(Xt, dtype=np.float64, out=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    :param Xt: samples x features C-contiguous array (changed in-place)
+    :param dtype: float dtype of the computation
+    :param out: [optional] preallocated samples x samples output
+    :return: samples x samples cosine distance matrix (1 - cosine similarity)
+    """
+    n = Xt.shape[0]
+    norms = np.sqrt(np.einsum('ij,ij->i', Xt, Xt))
+    # zero (for Pearson: constant) samples get NaN distances (like np.corrcoef)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Xt /= norms[:, np.newaxis]
+    out = gram(Xt, get_output(n, dtype, out))
+    del Xt
+    for s in block_slices(n, block_size):
+        blk = out[s, s.start:]
+        np.subtract(1., blk, out=blk)
+    mirror_upper(out, block_size)
+    out.flat[::n+1] = np.where(norms > 0., 0., np.nan)
+    return out
+
+
+def data_sha1(data):
+    """
+    :param data: numpy array or scipy sparse matrix
+    :return: sha1 hex digest of the content (without copying C- or Fortran-ordered data)
+    """
+    if sp.issparse(data):
+        data = data.tocsr() if data.format not in ['csc', 'csr'] else data
+        return hashlib.sha1('{0}{1}{2}{3}{4}'.format(data.format, data.shape, array_sha1(data.data),
+                                                  array_sha1(data.indices), array_sha1(data.indptr))).hexdigest()
+    return array_sha1(data)
+
+
+def run_threaded(fun, items, num_threads=None):
+    if num_threads is None:
+        num_threads = min(4, cpu_count())
+    if num_threads <= 1 or len(items) <= 1:
+        map(fun, items)
+        return
+    pool = ThreadPool(processes=num_threads)
+    try:
+        pool.map(fun, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def rank_columns(block):
+    """
+    :param block: features x samples data matrix
+    :return: average ranks (1-based, ties get the mean of their ranks) of every column
+    """
+    n, c = block.shape
+    order = np.argsort(block, axis=0, kind='mergesort')
+    cols = np.arange(c)[np.newaxis, :]
+    values = block[order, cols]
+    pos = np.arange(n)[:, np.newaxis]
+    # tie groups start (end) where the sorted value differs from the previous (next) one
+    starts = np.ones((n, c), dtype=np.bool)
+    starts[1:, :] = values[1:, :] != values[:-1, :]
+    ends = np.ones((n, c), dtype=np.bool)
+    ends[:-1, :] = starts[1:, :]
+    first = np.maximum.accumulate(np.where(starts, pos, 0), axis=0)
+    last = np.minimum.accumulate(np.where(ends, pos, n - 1)[::-1, :], axis=0)[::-1, :]
+    ranks = np.empty((n, c), dtype=np.float64)
+    ranks[order, cols] = (first + last) / 2. + 1.
+    return ranks
+
+
+def rank_data(data, dtype=np.float64, block_size=DEFAULT_BLOCK_SIZE, num_threads=None):
+    """
+    :param data: features x samples data matrix
+    :param dtype: float dtype of the ranks
+    :param block_size: number of samples ranked at once
+    :param num_threads: number of threads
+    :return: features x samples (read-only) average ranks of every sample (cached)
+    """
+    # hashed in its own memory layout, i.e. without copying (or densifying) the data
+    key = (data_sha1(data), np.dtype(dtype).str)
+    ranks = RANK_CACHE.pop(key, None)
+    if ranks is None:
+        if sp.issparse(data):
+            # ranks are dense anyway
+            data = data.toarray()
+        data = np.asarray(data)
+        ranks = np.empty(data.shape, dtype=dtype, order='F')
+
+        def rank_block(s):
+            ranks[:, s] = rank_columns(data[:, s])
+        run_threaded(rank_block, block_slices(data.shape[1], block_size), num_threads)
+        ranks.flags.writeable = False
+    RANK_CACHE[key] = ranks
+    while len(RANK_CACHE) > RANK_CACHE_SIZE:
+        RANK_CACHE.popitem(last=False)
+    return ranks
+
+
+def clear_rank_cache():
+    RANK_CACHE.clear()
+
+
+def sparse_pearson_distances(data, dtype=np.float64, out=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Pearson distances of sparse data without centering (which would densify it):
+      cov(x, y) = x'y - d mean(x) mean(y)
+    :param data: features x samples sparse data matrix
+    :return: samples x samples Pearson distance matrix (1 - correlation)
+    """
+    d, n = data.shape
+    out, sq = sparse_gram(data, get_output(n, dtype, out), block_size)
+    means = (np.asarray(data.sum(axis=0), dtype=np.float64).ravel() / np.float(d)).astype(dtype)
+    var = sq - d*means*means
+    # constant samples (up to cancellation) get NaN distances like in the dense case
+    var[var <= np.finfo(dtype).eps * sq] = 0.
+    norms = np.sqrt(var)
+    safe_norms = np.where(norms > 0., norms, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for s in block_slices(n, block_size):
+            blk = out[s, s.start:]
+            blk -= d * means[s, np.newaxis] * means[np.newaxis, s.start:]
+            blk /= safe_norms[s, np.newaxis]
+            blk /= safe_norms[np.newaxis, s.start:]
+            np.subtract(1., blk, out=blk)
+    mirror_upper(out, block_size)
+    out.flat[::n+1] = np.where(norms > 0., 0., np.nan)
+    return out
+
+
+def spearman_distances(data, dtype=np.float64, out=None, block_size=DEFAULT_BLOCK_SIZE, num_threads=None):
+    """
+    :param data: features x samples data matrix
+    :param dtype: float dtype of the computation
+    :param out: [optional] preallocated samples x samples output
+    :return: samples x samples Spearman distance matrix (1 - rank correlation)
+    """
+    ranks = rank_data(data, dtype=dtype, block_size=block_size, num_threads=num_threads)
+    return pearson_distances(ranks, dtype=dtype, out=out, block_size=block_size)
+
+
+def tiled_distances(data, metric, dtype=np.float64, out=None, block_size=DEFAULT_BLOCK_SIZE, num_threads=None):
+    """
+    :param data: features x samples data matrix
+    :param metric: any scipy.spatial.distance metric name (e.g. 'cityblock', 'chebyshev')
+    :param dtype: float dtype of the output
+    :param out: [optional] preallocated samples x samples output
+    :param block_size: number of samples per tile
+    :param num_threads: number of threads (default: number of cpus, at most 4)
+    :return: samples x samples distance matrix
+    """
+    n = data.shape[1]
+    out = get_output(n, dtype, out)
+    if num_threads is None:
+        num_threads = min(4, cpu_count())
+    if sp.issparse(data):
+        # densify only the rows of a tile
+        Xt = data.T.tocsr().astype(np.float64)
+        rows = lambda s: Xt[s, :].toarray()
+    else:
+        # scipy computes in double precision anyway
+        Xt = samples_matrix(data, np.float64)
+        rows = lambda s: Xt[s, :]
+    slices = block_slices(n, block_size)
+    tiles = [(slices[i], slices[j]) for i in range(len(slices)) for j in range(i, len(slices))]
+
+    def compute_tile(tile):
+        s1, s2 = tile
+        if s1 == s2:
+            # diagonal tiles: pdist computes every pair exactly once
+            out[s1, s2] = dist.squareform(dist.pdist(rows(s1), metric=metric))
+        else:
+            out[s1, s2] = dist.cdist(rows(s1), rows(s2), metric=metric)
+
+    run_threaded(compute_tile, tiles, num_threads)
+    mirror_upper(out, block_size)
+    return out
+
+
+def one_hot_labels(H):
+    """
+    :param H: components x samples matrix
+    :return: component index of every sample if H is a one-hot (0/1) assignment matrix, None otherwise
+    """
+    if sp.issparse(H):
+        return None
+    H = np.asarray(H)
+    labels = np.argmax(H, axis=0)
+    if H.size == 0 or not np.all(H[labels, np.arange(H.shape[1])] == 1.):
+        return None
+    if not np.count_nonzero(H) == H.shape[1]:
+        return None
+    return labels
+
+
+def low_rank_distances(W, H, metric='euclidean', dtype=np.float64, out=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Pairwise distances between the columns of W H without forming the (features x samples)
+    product. For one-hot H (e.g. cluster assignments) distances are gathered from the
+    components x components table of distances between the columns of W. Otherwise,
+    with W = QR, Euclidean and Pearson distances of W H are the Euclidean and cosine
+    distances of the components x samples matrix R H (of the centered W for Pearson).
+    :param W: features x components dictionary
+    :param H: components x samples coefficients
+    :param metric: see pairwise_distances (metrics other than Euclidean and Pearson
+                   need the product W H, unless H is one-hot)
+    :param dtype: float dtype of the output
+    :param out: [optional] preallocated C-contiguous samples x samples output
+    :return: samples x samples distance matrix
+    """
+    n = H.shape[1]
+    labels = one_hot_labels(H)
+    if labels is not None:
+        table = pairwise_distances(W, metric=metric, dtype=dtype)
+        out = get_output(n, dtype, out)
+        for s in block_slices(n, block_size):
+            out[s, :] = table[labels[s], :][:, labels]
+        return out
+    W = np.asarray(W, dtype=np.float64)
+    if metric in ['euclidean', 'sqeuclidean']:
+        R = np.linalg.qr(W, mode='r')
+        return euclidean_distances(R.dot(H), squared=metric == 'sqeuclidean', dtype=dtype, out=out,
+                                   block_size=block_size)
+    if metric in ['pearson', 'correlation']:
+        # column means of W H are the means of W times H
+        R = np.linalg.qr(W - np.mean(W, axis=0), mode='r')
+        return cosine_distances(samples_matrix(R.dot(H), dtype), dtype=dtype, out=out, block_size=block_size)
+    return pairwise_distances(W.dot(H), metric=metric, dtype=dtype, out=out, block_size=block_size)
+
+
+def pairwise_distances(data, metric='euclidean', dtype=np.float64, out=None,
+                       block_size=DEFAULT_BLOCK_SIZE, num_threads=None):
+    """
+    :param data: features x samples (i.e. transcripts x cells) data matrix
+    :param metric: 'euclidean', 'sqeuclidean', 'pearson' (or 'correlation'), 'spearman'
+                   or any scipy.spatial.distance metric
+    :param dtype: float dtype of the output
+    :param out: [optional] preallocated C-contiguous samples x samples output
+    :param block_size: number of samples per block/tile
+    :param num_threads: number of threads for tiled metrics
+    :return: samples x samples distance matrix
+    """
+    if metric in ['euclidean', 'sqeuclidean']:
+        return euclidean_distances(data, squared=metric == 'sqeuclidean', dtype=dtype, out=out, block_size=block_size)
+    if metric in ['pearson', 'correlation']:
+        return pearson_distances(data, dtype=dtype, out=out, block_size=block_size)
+    if metric == 'spearman':
+        return spearman_distances(data, dtype=dtype, out=out, block_size=block_size, num_threads=num_threads)
+    return tiled_distances(data, metric, dtype=dtype, out=out, block_size=block_size, num_threads=num_threads)
@@ -0,0 +1,97 @@
+import threading
+import weakref
+
+import numpy as np
+
+
+class GeneVocabulary(object):
+    """ Interns gene ids (strings) into int32 codes, i.e. identical gene ids of
+        different datasets share the same code and alignment becomes integer arithmetic.
+    """
+    codes = None
+    names = None
+    names_array = None
+    interned = None  # id(gene id array) -> (weak reference, codes)
+    lock = None
+
+    def __init__(self):
+        self.codes = dict()
+        self.names = list()
+        self.names_array = None
+        self.interned = dict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, gene_ids):
+        """
+        Codes of numpy arrays are remembered as long as the array lives, i.e. the gene ids
+        returned by a loader are interned only once, no matter how many clustering objects
+        use them (gene id arrays are never changed in-place).
+        :param gene_ids: vector of gene ids
+        :return: int32 vector of corresponding codes (read-only for numpy arrays)
+        """
+        if not isinstance(gene_ids, np.ndarray):
+            return self.intern_ids(gene_ids)
+        key = id(gene_ids)
+        entry = self.interned.get(key)
+        if entry is not None and entry[0]() is gene_ids:
+            return entry[1]
+        codes = self.intern_ids(gene_ids)
+        codes.flags.writeable = False
+        interned = self.interned
+        self.interned[key] = (weakref.ref(gene_ids, lambda _: interned.pop(key, None)), codes)
+        return codes
+
+    def intern_ids(self, gene_ids):
+        gene_ids = np.asarray(gene_ids).astype(np.str)
+        if gene_ids.size == 0:
+            return np.zeros(0, dtype=np.int32)
+        uniq_ids, inverse = np.unique(gene_ids, return_inverse=True)
+        uniq_codes = np.zeros(uniq_ids.size, dtype=np.int32)
+        with self.lock:
+            for i in range(uniq_ids.size):
+                code = self.codes.get(uniq_ids[i])
+                if code is None:
+                    code = len(self.names)
+                    self.codes[uniq_ids[i]] = code
+                    self.names.append(uniq_ids[i])
+                    self.names_array = None
+                uniq_codes[i] = code
+        return uniq_codes[inverse]
+
+    def lookup(self, codes):
+        """
+        :param codes: vector of codes
+        :return: vector of corresponding gene ids
+        """
+        with self.lock:
+            if self.names_array is None:
+                self.names_array = np.array(self.names, dtype=np.str)
+            names = self.names_array
+        return names[np.asarray(codes, dtype=np.int32)]
+
+
+# process-wide vocabulary shared by all datasets
+GENE_VOCABULARY = GeneVocabulary()
+
+
+def intern_gene_ids(gene_ids):
+    return GENE_VOCABULARY.intern(gene_ids)
+
+
+def lookup_gene_ids(codes):
+    return GENE_VOCABULARY.lookup(codes)
+
+
+def align_gene_codes(codes1, codes2):
+    """
+    :param codes1: vector of gene codes (1st dataset)
+    :param codes2: vector of gene codes (2nd dataset)
+    :return: sorted common codes, indices (first occurrence) in codes1, indices (first occurrence) in codes2
+    """
+    uniq1, inds1 = np.unique(codes1, return_index=True)
+    uniq2, inds2 = np.unique(codes2, return_index=True)
+    common_codes = np.intersect1d(uniq1, uniq2, assume_unique=True)
+    return common_codes, inds1[np.searchsorted(uniq1, common_codes)], inds2[np.searchsorted(uniq2, common_codes)]
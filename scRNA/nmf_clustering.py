@@ -1,8 +1,10 @@
 import numpy as np
+import scipy.sparse as sp
 import scipy.stats as stats
 from sklearn import decomposition as decomp
 
 from abstract_clustering import AbstractClustering
+from gene_vocabulary import align_gene_codes, lookup_gene_ids
 from utils import center_kernel, normalize_kernel, kta_align_binary
 
 class NmfClustering(AbstractClustering):
@@ -38,9 +40,10 @@ class NmfClustering(AbstractClustering):
         self.data_matrix = H
 
     def print_reconstruction_error(self, X, W, H):
-        print '  Elementwise absolute reconstruction error   : ', np.sum(np.abs(X - W.dot(H))) / np.float(X.size)
-        print '  Fro-norm reconstruction error               : ', np.sqrt(np.sum((X - W.dot(H))*(X - W.dot(H)))) \
-                                                                    / np.float(X.size)
+        # (sparse - dense) is a dense np.matrix, hence, make sure to have an array
+        R = np.asarray(X - W.dot(H))
+        print '  Elementwise absolute reconstruction error   : ', np.sum(np.abs(R)) / np.float(R.size)
+        print '  Fro-norm reconstruction error               : ', np.sqrt(np.sum(R*R)) / np.float(R.size)
 
 
 class DaNmfClustering(NmfClustering):
@@ -49,6 +52,7 @@ class DaNmfClustering(NmfClustering):
 
     src = None
     common_ids = None
+    common_codes = None
 
     src_common_gene_inds = None
     trg_common_gene_inds = None
@@ -66,37 +70,33 @@ class DaNmfClustering(NmfClustering):
         # src_data = self.src.pre_processing()
         src_data = self.src.pp_data
 
-        trg_gene_ids = self.gene_ids[self.remain_gene_inds]
-        src_gene_ids = self.src.gene_ids[self.src.remain_gene_inds]
+        # gene alignment is done on the interned (integer) gene codes
+        trg_gene_codes = self.get_gene_codes()[self.remain_gene_inds]
+        src_gene_codes = self.src.get_gene_codes()[self.src.remain_gene_inds]
 
-        if not np.unique(src_gene_ids).size == src_gene_ids.size:
+        if not np.unique(src_gene_codes).size == src_gene_codes.size:
             # raise Exception('(MTL) Gene ids are supposed to be unique.')
             print('\nWarning! (MTL gene ids) Gene ids are supposed to be unique. '
-                  'Only {0} of {1}  entries are unique.'.format(np.unique(src_gene_ids).shape[0], src_gene_ids.shape[0]))
+                  'Only {0} of {1}  entries are unique.'.format(np.unique(src_gene_codes).shape[0], src_gene_codes.shape[0]))
             print('Only first occurance will be used.\n')
-        if not np.unique(trg_gene_ids).size == trg_gene_ids.size:
+        if not np.unique(trg_gene_codes).size == trg_gene_codes.size:
             # raise Exception('(Target) Gene ids are supposed to be unique.')
             print('\nWarning! (Target gene ids) Gene ids are supposed to be unique. '
-                  'Only {0} of {1}  entries are unique.'.format(np.unique(trg_gene_ids).shape[0], trg_gene_ids.shape[0]))
+                  'Only {0} of {1}  entries are unique.'.format(np.unique(trg_gene_codes).shape[0], trg_gene_codes.shape[0]))
             print('Only first occurance will be used.\n')
 
-        common_ids = np.intersect1d(trg_gene_ids, src_gene_ids)
+        # find indices of common gene codes in target and source gene codes
+        common_codes, inds1, inds2 = align_gene_codes(trg_gene_codes, src_gene_codes)
         print('Both datasets have (after processing) {0} (src={1}%,trg={2}%) gene ids in common.'.format(
-            common_ids.shape[0],
-            np.int(np.float(common_ids.size)/np.float(src_gene_ids.size)*100.0),
-            np.int(np.float(common_ids.size)/np.float(trg_gene_ids.size)*100.0) ))
+            common_codes.shape[0],
+            np.int(np.float(common_codes.size)/np.float(src_gene_codes.size)*100.0),
+            np.int(np.float(common_codes.size)/np.float(trg_gene_codes.size)*100.0) ))
 
-        # find indices of common_ids in pgene_ids and gene_ids
-        inds1 = np.zeros(common_ids.shape[0], dtype=np.int)
-        inds2 = np.zeros(common_ids.shape[0], dtype=np.int)
-        for i in range(common_ids.shape[0]):
-            inds1[i] = np.where(common_ids[i] == trg_gene_ids)[0][0]
-            inds2[i] = np.where(common_ids[i] == src_gene_ids)[0][0]
+        print 'MTL source {0} genes -> {1} genes.'.format(src_gene_codes.size, inds2.size)
+        print 'MTL target {0} genes -> {1} genes.'.format(trg_gene_codes.size, inds1.size)
 
-        print 'MTL source {0} genes -> {1} genes.'.format(src_gene_ids.size, inds2.size)
-        print 'MTL target {0} genes -> {1} genes.'.format(trg_gene_ids.size, inds1.size)
-
-        self.common_ids = common_ids
+        self.common_codes = common_codes
+        self.common_ids = lookup_gene_ids(common_codes)
         self.src_common_gene_inds = inds2
         self.trg_common_gene_inds = inds1
 
@@ -105,7 +105,11 @@ class DaNmfClustering(NmfClustering):
         self.src.data = src_data[inds2, :]
         self.src.pp_data = src_data[inds2, :]
         self.src.gene_ids = self.src.gene_ids[inds2]
+        self.src.gene_codes = self.src.get_gene_codes()[inds2]
         trg_data = trg_data[inds1, :]
+        if sp.issparse(trg_data):
+            # multiplicative updates and rejection scores need dense target data
+            trg_data = trg_data.toarray()
         self.src.apply()
 
         W = self.src.dictionary
@@ -0,0 +1,158 @@
+import hashlib
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import scipy.sparse as sp
+
+from utils import array_fingerprint
+
+# Clustering objects that are built on the same data with the same filters and
+# transformation (e.g. the target clusterings of every (k, mix) iteration of
+# cmd_target) can share their pre-processing results (opt-in, see
+# AbstractClustering.pp_cache). Keys combine a fingerprint of the data with a
+# description of the filter/transformation configuration, entries are evicted in
+# least-recently-used order under an entry and byte budget. Entries keep their
+# input data alive and only match the very same data object. Configurations that
+# cannot be described by value (closures, bound methods, callable objects, array
+# arguments) are not cached at all. Cached results are handed out as read-only views.
+DEFAULT_MAX_ENTRIES = 8
+DEFAULT_MAX_BYTES = 1 << 30
+SCALAR_TYPES = (type(None), bool, int, long, float, str, unicode, np.generic)
+
+
+def value_config(value):
+    """
+    :param value: configuration value (e.g. argument of a partial)
+    :return: string description or None (if the value cannot be described by value)
+    """
+    if isinstance(value, SCALAR_TYPES):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        desc = [value_config(v) for v in value]
+        if None in desc:
+            return None
+        return '{0}({1})'.format(type(value).__name__, ', '.join(desc))
+    if isinstance(value, dict):
+        return value_config(sorted(value.items()))
+    if callable(value):
+        return callable_config(value)
+    return None
+
+
+def callable_config(fun):
+    """
+    :param fun: filter or transformation function
+    :return: string description (partials are described by their function and arguments)
+             or None for closures, bound methods and callable objects
+    """
+    if isinstance(fun, partial):
+        desc = [callable_config(fun.func), value_config(fun.args), value_config(fun.keywords or dict())]
+        if None in desc:
+            return None
+        return 'partial({0}, {1}, {2})'.format(*desc)
+    code = getattr(fun, '__code__', None)
+    if code is not None and getattr(fun, '__closure__', None) is None:
+        # plain functions (and lambdas without closures) are identified by their code
+        defaults = value_config(getattr(fun, '__defaults__', None))
+        if defaults is None:
+            return None
+        return '{0}.{1}@{2}:{3}{4}'.format(fun.__module__, fun.__name__, code.co_filename, code.co_firstlineno,
+                                           defaults)
+    # anything else (closures, bound methods, callable objects) might change its
+    # behavior (or get its id reused) without notice
+    return None
+
+
+def read_only(array):
+    """
+    :param array: numpy array or scipy sparse matrix
+    :return: read-only view (sparse matrices share index arrays and a read-only data view)
+    """
+    if sp.issparse(array):
+        if array.format not in ['csc', 'csr']:
+            array = array.tocsc()
+        data = array.data.view()
+        data.flags.writeable = False
+        return type(array)((data, array.indices, array.indptr), shape=array.shape, copy=False)
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def nbytes(array):
+    if sp.issparse(array):
+        return array.data.nbytes + array.indices.nbytes + array.indptr.nbytes
+    return array.nbytes
+
+
+class PreprocessingCache(object):
+    max_entries = DEFAULT_MAX_ENTRIES
+    max_bytes = DEFAULT_MAX_BYTES
+
+    entries = None
+    num_bytes = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, data, config):
+        """
+        :param data: transcripts x cells data matrix
+        :param config: list of filter/transformation functions and settings
+        :return: cache key or None (if the configuration cannot be cached)
+        """
+        desc = [array_fingerprint(data)]
+        for c in config:
+            desc.append(value_config(c))
+            if desc[-1] is None:
+                return None
+        return hashlib.sha1('|'.join(desc)).hexdigest()
+
+    def get(self, key, data):
+        """
+        :param data: transcripts x cells data matrix the key was built from
+        :return: (pp_data, remain_gene_inds, remain_cell_inds) read-only views or None
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[2] is not data:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return tuple(read_only(x) for x in entry[0])
+
+    def put(self, key, data, pp_data, remain_gene_inds, remain_cell_inds):
+        size = nbytes(pp_data) + remain_gene_inds.nbytes + remain_cell_inds.nbytes
+        if size > self.max_bytes:
+            return
+        self.invalidate(key)
+        # the (strong) reference to the data keeps its fingerprint valid
+        self.entries[key] = ((pp_data, remain_gene_inds, remain_cell_inds), size, data)
+        self.num_bytes += size
+        while len(self.entries) > self.max_entries or self.num_bytes > self.max_bytes:
+            _, (_, evicted, _) = self.entries.popitem(last=False)
+            self.num_bytes -= evicted
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# shared by all clustering objects that opt in
+PREPROCESSING_CACHE = PreprocessingCache()
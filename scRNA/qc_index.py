@@ -0,0 +1,228 @@
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+from binary_dataset import DATA_FNAME, DATA_GZ_FNAME, is_binary_dataset
+
+# A QC index stores per-cell and per-gene cumulative expression-count histograms,
+# i.e. for every threshold edge t the number of genes (cells) with expression >= t.
+# Any combination of SC3 cell/gene filter parameters (with a threshold on the
+# edges) is resolved in O(cells + genes) without touching the data again.
+QC_INDEX_VERSION = 1
+QC_INDEX_FNAME = 'qc_index.npz'
+DEFAULT_EDGES = np.arange(0., 21.)
+
+
+def qc_index_fname(fname):
+    """
+    :param fname: dataset filename (or binary dataset directory)
+    :return: filename of the corresponding QC index (stored next to the dataset)
+    """
+    if is_binary_dataset(fname):
+        return os.path.join(fname, QC_INDEX_FNAME)
+    return '{0}.{1}'.format(fname, QC_INDEX_FNAME)
+
+
+def dataset_mtime(fname):
+    """
+    :param fname: dataset filename (or binary dataset directory)
+    :return: modification time of the data (the directory itself changes with the QC index)
+    """
+    if is_binary_dataset(fname):
+        for name in [DATA_FNAME, DATA_GZ_FNAME]:
+            if os.path.exists(os.path.join(fname, name)):
+                return os.path.getmtime(os.path.join(fname, name))
+    return os.path.getmtime(fname)
+
+
+class QcIndex(object):
+    edges = None        # sorted expression thresholds
+    cell_counts = None  # cells x edges, number of genes with expression >= edge
+    gene_counts = None  # genes x edges, number of cells with expression >= edge
+    cell_nnz = None     # number of genes with expression > 0 (for each cell)
+    gene_nnz = None     # number of cells with expression > 0 (for each gene)
+    is_integer = False  # integer data: any threshold maps onto the next integer edge
+    mtime = None        # modification time of the indexed dataset
+
+    def __init__(self, edges, cell_counts, gene_counts, cell_nnz, gene_nnz, is_integer=False, mtime=None):
+        self.edges = edges
+        self.cell_counts = cell_counts
+        self.gene_counts = gene_counts
+        self.cell_nnz = cell_nnz
+        self.gene_nnz = gene_nnz
+        self.is_integer = is_integer
+        self.mtime = mtime
+
+    @property
+    def num_cells(self):
+        return self.cell_counts.shape[0]
+
+    @property
+    def num_transcripts(self):
+        return self.gene_counts.shape[0]
+
+    def edge_index(self, threshold):
+        if self.is_integer:
+            threshold = np.ceil(threshold)
+        if threshold <= self.edges[0]:
+            # every (non-negative) entry passes
+            return 0
+        ind = np.searchsorted(self.edges, threshold)
+        if ind >= self.edges.size or not self.edges[ind] == threshold:
+            raise Exception('Threshold {0} is not covered by the QC index (edges={1}).'.format(
+                threshold, self.edges.tolist()))
+        return ind
+
+    def covers(self, thresholds):
+        """
+        :param thresholds: list of non_zero_thresholds
+        :return: True, if all thresholds can be resolved with this index
+        """
+        for threshold in thresholds:
+            if self.is_integer:
+                threshold = np.ceil(threshold)
+            if threshold > self.edges[0] and not np.any(self.edges == threshold):
+                return False
+        return True
+
+    def resolve(self, min_expr_genes, non_zero_threshold, perc_consensus_genes):
+        """
+        Same semantics as sc3_clustering_impl.cell_filter and gene_filter.
+        :return: indices of remaining cells, indices of remaining transcripts
+        """
+        ind = self.edge_index(non_zero_threshold)
+        remain_cell_inds = np.where(self.cell_counts[:, ind] >= min_expr_genes)[0]
+        lower_bound = np.float(self.num_cells)*(1.-perc_consensus_genes)
+        upper_bound = np.float(self.num_cells)*perc_consensus_genes
+        remain_gene_inds = np.where((self.gene_counts[:, ind] >= lower_bound) & (self.gene_nnz <= upper_bound))[0]
+        return remain_cell_inds, remain_gene_inds
+
+    def save(self, fname):
+        # np.savez appends '.npz' to filenames without it
+        with open(fname, 'wb') as f:
+            np.savez(f, version=QC_INDEX_VERSION, edges=self.edges,
+                     cell_counts=self.cell_counts, gene_counts=self.gene_counts,
+                     cell_nnz=self.cell_nnz, gene_nnz=self.gene_nnz,
+                     is_integer=self.is_integer, mtime=self.mtime)
+
+
+def build_qc_index(data, edges=None, mtime=None, chunk_size=1000):
+    """
+    :param data: transcripts x cells data matrix (dense or sparse), NaNs are treated as zeros
+    :param edges: [optional] sorted expression thresholds (default 0,1,..,20)
+    :param mtime: [optional] modification time of the dataset file
+    :param chunk_size: number of cells that are processed at once
+    :return: QcIndex
+    """
+    if edges is None:
+        edges = DEFAULT_EDGES
+    edges = np.sort(np.asarray(edges, dtype=np.float64))
+    num_transcripts, num_cells = data.shape
+    num_bins = edges.size + 1
+    cell_hist = np.zeros((num_cells, num_bins), dtype=np.int64)
+    gene_hist = np.zeros((num_transcripts, num_bins), dtype=np.int64)
+    cell_nnz = np.zeros(num_cells, dtype=np.int64)
+    gene_nnz = np.zeros(num_transcripts, dtype=np.int64)
+    if sp.issparse(data):
+        data = data.tocsc()
+    gene_offsets = np.arange(num_transcripts)[:, np.newaxis] * num_bins
+    for i in range(0, num_cells, chunk_size):
+        block = data[:, i:i+chunk_size]
+        if sp.issparse(block):
+            block = block.toarray()
+        if block.dtype.kind == 'f':
+            block = np.where(np.isnan(block), 0, block)
+        n = block.shape[1]
+        # bins[j] = number of edges <= entry, i.e. entry >= edges[k] for all k < bins[j]
+        bins = np.searchsorted(edges, block, side='right')
+        cell_offsets = np.arange(n)[np.newaxis, :] * num_bins
+        cell_hist[i:i+n, :] = np.bincount((bins + cell_offsets).ravel(), minlength=n*num_bins).reshape((n, num_bins))
+        gene_hist += np.bincount((bins + gene_offsets).ravel(),
+                                 minlength=num_transcripts*num_bins).reshape((num_transcripts, num_bins))
+        nnz = block > 0
+        cell_nnz[i:i+n] = np.sum(nnz, axis=0)
+        gene_nnz += np.sum(nnz, axis=1)
+    # cumulative counts from the top: counts[:, k] = number of entries >= edges[k]
+    cell_counts = np.cumsum(cell_hist[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    gene_counts = np.cumsum(gene_hist[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    is_integer = not data.dtype.kind == 'f'
+    return QcIndex(edges, cell_counts.astype(np.int32), gene_counts.astype(np.int32),
+                   cell_nnz.astype(np.int32), gene_nnz.astype(np.int32), is_integer=is_integer, mtime=mtime)
+
+
+def load_qc_index(fname):
+    """
+    :param fname: QC index filename
+    :return: QcIndex
+    """
+    foo = np.load(fname)
+    if foo['version'] > QC_INDEX_VERSION:
+        raise Exception('QC index \'{0}\' has unsupported version {1}.'.format(fname, foo['version']))
+    mtime = foo['mtime']
+    if mtime.ndim == 0 and mtime.dtype == np.object:
+        mtime = None
+    return QcIndex(foo['edges'], foo['cell_counts'], foo['gene_counts'], foo['cell_nnz'], foo['gene_nnz'],
+                   is_integer=bool(foo['is_integer']), mtime=mtime)
+
+
+def index_edges(thresholds=None):
+    """
+    :param thresholds: [optional] list of non_zero_thresholds that need to be resolved
+    :return: default edges together with the thresholds (and the thresholds of integer data)
+    """
+    if thresholds is None or len(thresholds) == 0:
+        return DEFAULT_EDGES
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    return np.union1d(DEFAULT_EDGES, np.union1d(thresholds, np.ceil(thresholds)))
+
+
+def get_qc_index(fname, data, thresholds=None):
+    """
+    Loads the QC index of a dataset, or builds (and saves) it if missing, outdated or
+    if it does not cover all thresholds.
+    :param fname: dataset filename (or binary dataset directory)
+    :param data: corresponding transcripts x cells data matrix or a function that loads it,
+                 i.e. the data is only loaded if the index needs to be built
+    :param thresholds: [optional] list of non_zero_thresholds that need to be resolved
+    :return: QcIndex
+    """
+    findex = qc_index_fname(fname)
+    mtime = dataset_mtime(fname)
+    edges = index_edges(thresholds)
+    if os.path.exists(findex):
+        qc_index = load_qc_index(findex)
+        if qc_index.mtime == mtime and (thresholds is None or qc_index.covers(thresholds)):
+            print('Using QC index \'{0}\'.'.format(findex))
+            return qc_index
+        if qc_index.mtime == mtime:
+            # keep the edges of the existing index
+            edges = np.union1d(edges, qc_index.edges)
+    print('Building QC index \'{0}\'.'.format(findex))
+    if callable(data):
+        data = data()
+    qc_index = build_qc_index(data, edges=edges, mtime=mtime)
+    try:
+        qc_index.save(findex)
+    except IOError as e:
+        print('Warning! QC index could not be saved: {0}'.format(e))
+    return qc_index
+
+
+def preview_filters(qc_index, min_expr_genes_list, non_zero_thresholds, perc_consensus_genes_list):
+    """
+    :return: grid x 5 array (min_expr_genes, non_zero_threshold, perc_consensus_genes, #cells, #transcripts)
+    """
+    res = list()
+    print('min_expr_genes  non_zero_threshold  perc_consensus_genes  cells  transcripts')
+    for min_expr_genes in min_expr_genes_list:
+        for non_zero_threshold in non_zero_thresholds:
+            for perc_consensus_genes in perc_consensus_genes_list:
+                remain_cell_inds, remain_gene_inds = qc_index.resolve(
+                    min_expr_genes, non_zero_threshold, perc_consensus_genes)
+                print('{0:14d}  {1:18.2f}  {2:20.3f}  {3:5d}  {4:11d}'.format(
+                    min_expr_genes, non_zero_threshold, perc_consensus_genes,
+                    remain_cell_inds.size, remain_gene_inds.size))
+                res.append([min_expr_genes, non_zero_threshold, perc_consensus_genes,
+                            remain_cell_inds.size, remain_gene_inds.size])
+    return np.array(res, dtype=np.float64).reshape((len(res), 5))
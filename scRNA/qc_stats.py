@@ -0,0 +1,143 @@
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+
+# QC statistics of a dataset are computed in a single (blocked) pass and are cached,
+# i.e. all registered cell and gene filters with the same expression threshold share
+# one read of the data matrix. Entries are bound to the data object itself (weakref)
+# and must be invalidated if the data is changed in place.
+QC_STATS_CACHE_SIZE = 8
+
+
+def count_stored(data, mask, axis=0):
+    """
+    :param data: transcripts x cells sparse data matrix (CSC or CSR)
+    :param mask: boolean vector, one entry for each stored value in data.data
+    :param axis: 0 = count per column (cell), 1 = count per row (transcript)
+    :return: number of stored values per column/row where mask is True
+    """
+    num_major = data.indptr.size - 1
+    if (data.format == 'csc' and axis == 0) or (data.format == 'csr' and axis == 1):
+        major_inds = np.repeat(np.arange(num_major), np.diff(data.indptr))
+        return np.bincount(major_inds[mask], minlength=num_major)
+    return np.bincount(data.indices[mask], minlength=data.shape[1 - axis])
+
+
+def sparse_count_ge(data, threshold, axis=0):
+    """
+    :param data: transcripts x cells sparse data matrix
+    :param threshold: NaNs count as zeros, i.e. implicit and explicit zeros count only for threshold <= 0
+    :return: number of entries >= threshold per column (axis=0) or row (axis=1)
+    """
+    if data.format not in ['csc', 'csr']:
+        data = data.tocsc()
+    values = data.data
+    mask = values >= threshold
+    if threshold <= 0.:
+        mask |= np.isnan(values)
+    res = count_stored(data, mask, axis=axis)
+    if threshold <= 0.:
+        # implicit zeros
+        res += data.shape[axis] - count_stored(data, np.ones(values.size, dtype=np.bool), axis=axis)
+    return res
+
+
+class QcStats(object):
+    """ Per-cell and per-gene counts of a transcripts x cells data matrix.
+        NaNs are treated as zeros.
+    """
+    threshold = None
+    cell_expr = None   # number of genes with expression >= threshold (for each cell)
+    cell_nnz = None    # number of genes with expression > 0 (for each cell)
+    cell_nan = None    # number of NaN entries (for each cell)
+    gene_expr = None   # number of cells with expression >= threshold (for each gene)
+    gene_nnz = None    # number of cells with expression > 0 (for each gene)
+    gene_nan = None    # number of NaN entries (for each gene)
+
+    def __init__(self, data, threshold, chunk_size=1000):
+        self.threshold = threshold
+        with np.errstate(invalid='ignore'):
+            if sp.issparse(data):
+                self.compute_sparse(data)
+            else:
+                self.compute_dense(data, chunk_size)
+
+    def compute_dense(self, data, chunk_size):
+        num_transcripts, num_cells = data.shape
+        check_nan = data.dtype.kind == 'f'
+        self.cell_expr = np.zeros(num_cells, dtype=np.int64)
+        self.cell_nnz = np.zeros(num_cells, dtype=np.int64)
+        self.cell_nan = np.zeros(num_cells, dtype=np.int64)
+        self.gene_expr = np.zeros(num_transcripts, dtype=np.int64)
+        self.gene_nnz = np.zeros(num_transcripts, dtype=np.int64)
+        self.gene_nan = np.zeros(num_transcripts, dtype=np.int64)
+        for i in range(0, num_cells, chunk_size):
+            block = data[:, i:i+chunk_size]
+            # comparisons with NaNs are always False
+            expr = block >= self.threshold
+            nnz = block > 0
+            if check_nan:
+                nan = np.isnan(block)
+                if self.threshold <= 0.:
+                    expr |= nan
+                self.cell_nan[i:i+block.shape[1]] = np.sum(nan, axis=0)
+                self.gene_nan += np.sum(nan, axis=1)
+            self.cell_expr[i:i+block.shape[1]] = np.sum(expr, axis=0)
+            self.cell_nnz[i:i+block.shape[1]] = np.sum(nnz, axis=0)
+            self.gene_expr += np.sum(expr, axis=1)
+            self.gene_nnz += np.sum(nnz, axis=1)
+
+    def compute_sparse(self, data):
+        if data.format not in ['csc', 'csr']:
+            data = data.tocsc()
+        nnz = data.data > 0
+        nan = np.isnan(data.data)
+        self.cell_expr = sparse_count_ge(data, self.threshold, axis=0)
+        self.cell_nnz = count_stored(data, nnz, axis=0)
+        self.cell_nan = count_stored(data, nan, axis=0)
+        self.gene_expr = sparse_count_ge(data, self.threshold, axis=1)
+        self.gene_nnz = count_stored(data, nnz, axis=1)
+        self.gene_nan = count_stored(data, nan, axis=1)
+
+
+QC_STATS_CACHE = OrderedDict()
+
+
+def get_qc_stats(data, threshold):
+    """
+    :param data: transcripts x cells data matrix (dense or sparse), will not be changed
+    :param threshold: expression threshold
+    :return: (cached) QcStats of data
+    """
+    key = (id(data), threshold)
+    entry = QC_STATS_CACHE.pop(key, None)
+    if entry is not None and entry[0]() is data:
+        QC_STATS_CACHE[key] = entry
+        return entry[1]
+    stats = QcStats(data, threshold)
+    QC_STATS_CACHE[key] = (weakref.ref(data), stats)
+    while len(QC_STATS_CACHE) > QC_STATS_CACHE_SIZE:
+        QC_STATS_CACHE.popitem(last=False)
+    return stats
+
+
+def cached_nan_count(data):
+    """
+    :param data: transcripts x cells data matrix
+    :return: number of NaN entries in data, or None if no QC statistics of data are cached
+    """
+    for key, (ref, stats) in QC_STATS_CACHE.items():
+        if key[0] == id(data) and ref() is data:
+            return np.sum(stats.cell_nan)
+    return None
+
+
+def invalidate_qc_stats(data=None):
+    """
+    :param data: [optional] data matrix, whose QC statistics are removed (default: all)
+    """
+    for key in QC_STATS_CACHE.keys():
+        if data is None or key[0] == id(data):
+            del QC_STATS_CACHE[key]
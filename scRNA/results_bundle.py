@@ -0,0 +1,129 @@
+import hashlib
+import threading
+import zipfile
+from io import BytesIO
+from Queue import Queue
+
+import numpy as np
+
+# A results bundle is a single (npz-compatible) zip file. Every distinct array is
+# stored exactly once as 'blob_<sha1>.npy' and an 'index.npy' (written on close)
+# maps the result keys to their blobs, i.e. arrays that are repeated across keys
+# (pre-processed data, gene ids, remaining cell indices, ...) cost nothing extra.
+INDEX_NAME = 'index'
+
+
+def array_sha1(array, chunk_bytes=1 << 24):
+    """
+    :param array: numpy array
+    :param chunk_bytes: non-contiguous arrays are hashed in contiguous chunks of (about) this size
+    :return: sha1 hex digest of dtype, shape, memory order and content (C- and F-contiguous
+             arrays are hashed without any copy)
+    """
+    array = np.asarray(array)
+    order = 'C'
+    if array.flags.f_contiguous and not array.flags.c_contiguous:
+        # the transpose of a Fortran-ordered array is C-contiguous
+        order, array = 'F', array.T
+    sha1 = hashlib.sha1('{0}{1}{2}'.format(array.dtype.str, array.shape, order))
+    if array.size == 0:
+        return sha1.hexdigest()
+    if array.flags.c_contiguous:
+        sha1.update(array.reshape(-1).view(np.uint8))
+        return sha1.hexdigest()
+    rows = max(1, chunk_bytes // max(1, array[0].nbytes))
+    for i in range(0, array.shape[0], rows):
+        sha1.update(np.ascontiguousarray(array[i:i+rows]).reshape(-1).view(np.uint8))
+    return sha1.hexdigest()
+
+
+class ResultsBundle(object):
+    """ Collects keyed result arrays and writes them on a background thread
+        into a single deduplicated results file.
+        Arrays must not be changed after they were added.
+    """
+    fname = None
+    compress = False
+
+    index = None
+    blobs = None
+    queue = None
+    writer = None
+    error = None
+
+    def __init__(self, fname, compress=False):
+        self.fname = fname
+        self.compress = compress
+        self.index = list()
+        self.blobs = set()
+        self.error = None
+        self.queue = Queue()
+        self.writer = threading.Thread(target=self._write_blobs)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def add(self, key, array):
+        """
+        :param key: string identifier of the result
+        :param array: numpy array (or anything convertible into one)
+        """
+        array = np.asarray(array)
+        blob = 'blob_{0}'.format(array_sha1(array))
+        if blob not in self.blobs:
+            self.blobs.add(blob)
+            self.queue.put((blob, array))
+        self.index.append((key, blob))
+
+    def close(self):
+        self.queue.put((INDEX_NAME, np.array(self.index, dtype=np.str).reshape((len(self.index), 2))))
+        self.queue.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+        print('Results bundle \'{0}\' saved ({1} keys, {2} distinct arrays).'.format(
+            self.fname, len(self.index), len(self.blobs)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_blobs(self):
+        compression = zipfile.ZIP_STORED
+        if self.compress:
+            compression = zipfile.ZIP_DEFLATED
+        item = True
+        try:
+            with zipfile.ZipFile(self.fname, mode='w', compression=compression, allowZip64=True) as zf:
+                item = self.queue.get()
+                while item is not None:
+                    name, array = item
+                    buf = BytesIO()
+                    np.lib.format.write_array(buf, array, allow_pickle=False)
+                    zf.writestr('{0}.npy'.format(name), buf.getvalue())
+                    item = self.queue.get()
+        except Exception as e:
+            self.error = e
+            # drain the queue, otherwise close() would wait forever
+            while item is not None:
+                item = self.queue.get()
+
+
+def load_results_bundle(fname, keys=None):
+    """
+    :param fname: results bundle filename
+    :param keys: [optional] list of keys to load (default: all)
+    :return: dictionary key -> array (repeated arrays are loaded only once and shared)
+    """
+    bundle = np.load(fname)
+    index = bundle[INDEX_NAME]
+    res = dict()
+    blobs = dict()
+    for key, blob in index:
+        if keys is not None and key not in keys:
+            continue
+        if blob not in blobs:
+            blobs[blob] = bundle[blob]
+        res[key] = blobs[blob]
+    return res
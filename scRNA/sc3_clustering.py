@@ -1,6 +1,9 @@
+from itertools import izip
+
 import numpy as np
 
 from abstract_clustering import AbstractClustering
+from sc3_clustering_impl import DISTANCE_CACHE
 
 
 class SC3Clustering(AbstractClustering):
@@ -8,6 +11,7 @@ class SC3Clustering(AbstractClustering):
         Nico Goernitz, TU Berlin, 2016
     """
     dists_list  = None
+    dist_sweeps_list = None
     dimred_list = None
     intermediate_clustering_list = None
     build_consensus_matrix = None
@@ -23,6 +27,7 @@ class SC3Clustering(AbstractClustering):
         super(SC3Clustering, self).__init__(data, gene_ids=gene_ids)
         # init lists
         self.dists_list = list()
+        self.dist_sweeps_list = list()
         self.dimred_list = list()
         self.intermediate_clustering_list = list()
         self.consensus_clustering = lambda X: np.zeros(X.shape[0])
@@ -42,6 +47,13 @@ class SC3Clustering(AbstractClustering):
         else:
             self.dists_list.append(dist_calculation)
 
+    def add_distance_sweep(self, dist_sweep):
+        """
+        :param dist_sweep: function (data, gene_ids) -> iterator of (parameter, distance matrix),
+                           e.g. partial(da_nmf_distances_sweep, da_model=..., mixtures=...)
+        """
+        self.dist_sweeps_list.append(dist_sweep)
+
     def add_dimred_calculation(self, dimred_computation):
         if self.dimred_list is None:
             self.dimred_list = list(dimred_computation)
@@ -64,12 +76,55 @@ class SC3Clustering(AbstractClustering):
         # 4. distance calculations
         print '4. Distance calculations ({0} methods).'.format(len(self.dists_list))
         dists = list()
-        for d in self.dists_list:
-            dists.append(d(X, self.gene_ids[self.remain_gene_inds]))
+        # the pre-processed data is hashed (for the distance cache) only once
+        with DISTANCE_CACHE.pinned_data(X):
+            for d in self.dists_list:
+                dists.append(d(X, self.gene_ids[self.remain_gene_inds]))
+
+        self.cluster_labels, self.dists = self.cluster_distances(dists)
+
+    def apply_sweep(self):
+        """
+        Runs the SC3 pipeline once for every step of the distance sweeps (e.g. one step
+        per mixture of da_nmf_distances_sweep). Pre-processing and the (fixed) distance
+        calculations are done only once.
+        :return: list of (sweep parameter, cluster labels, consensus distances) tuples
+        """
+        # check range
+        assert self.pc_range[0] > 0
+        assert self.pc_range[1] < self.num_cells
 
+        X = self.pre_processing()
+        gene_ids = self.gene_ids[self.remain_gene_inds]
+
+        # 4. distance calculations
+        print '4. Distance calculations ({0} methods, {1} sweeps).'.format(
+            len(self.dists_list), len(self.dist_sweeps_list))
+        dists = list()
+        res = list()
+        # the pre-processed data is hashed (for the distance cache) only once
+        with DISTANCE_CACHE.pinned_data(X):
+            for d in self.dists_list:
+                dists.append(d(X, gene_ids))
+
+            sweeps = [s(X, gene_ids) for s in self.dist_sweeps_list]
+            # (lazy) izip, every sweep overwrites its distance buffer in the next step
+            for steps in izip(*sweeps):
+                param = steps[0][0]
+                print('Sweep step {0}.'.format(param))
+                # the distances of a sweep step are only valid until the next step
+                self.cluster_labels, self.dists = self.cluster_distances(dists + [d for _, d in steps])
+                res.append((param, self.cluster_labels, self.dists))
+        return res
+
+    def cluster_distances(self, dists):
+        """
+        :param dists: list of cells x cells distance matrices
+        :return: cluster labels, consensus distances
+        """
         # 5. transformations (dimension reduction)
         print '5. Distance transformations ({0} transformations * {1} distances = {2} in total).'.format(
-            len(self.dimred_list), len(self.dists_list), len(self.dists_list)*len(self.dimred_list))
+            len(self.dimred_list), len(dists), len(dists)*len(self.dimred_list))
         transf = list()
         for d in dists:
             for t in self.dimred_list:
@@ -105,4 +160,4 @@ class SC3Clustering(AbstractClustering):
 
         # 7. consensus clustering
         print '7. Consensus clustering.'
-        self.cluster_labels, self.dists = self.consensus_clustering(consensus2)
+        return self.consensus_clustering(consensus2)
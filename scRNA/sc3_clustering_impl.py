@@ -1,9 +1,16 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import scipy.cluster.hierarchy as spc
 import scipy.spatial.distance as dist
 import scipy.stats as stats
 import scipy.linalg as sl
+import scipy.sparse as sp
 import sklearn.cluster as cluster
 
+from data_transformations import transform_log2p1
+from distance_engine import data_sha1, low_rank_distances, pairwise_distances
+from qc_stats import get_qc_stats
 from utils import *
 
 # These are the SC3 labels for Ting with 7 clusters, PCA, Euclidean distances
@@ -31,73 +38,281 @@ def get_sc3_Ting_labels():
 
 def cell_filter(data, num_expr_genes=2000, non_zero_threshold=2):
     """
-    :param data: transcripts x cells data matrix
+    :param data: transcripts x cells data matrix (dense or sparse), will not be changed
     :return: indices of valid cells
     """
     print('SC3 cell filter with num_expr_genes={0} and non_zero_threshold={1}'.format(num_expr_genes, non_zero_threshold))
-    ai, bi = np.where(np.isnan(data))
-    data[ai, bi] = 0
-    num_transcripts, num_cells = data.shape
-    res = np.sum(data >= non_zero_threshold , axis=0)
-    return np.where(np.isfinite(res) & (res >= num_expr_genes))[0]
+    qc = get_qc_stats(data, non_zero_threshold)
+    return np.where(qc.cell_expr >= num_expr_genes)[0]
 
 
 def gene_filter(data, perc_consensus_genes=0.94, non_zero_threshold=2):
     """
-    :param data: transcripts x cells data matrix
+    :param data: transcripts x cells data matrix (dense or sparse), will not be changed
     :return: indices of valid transcripts
     """
     print('SC3 gene filter with perc_consensus_genes={0} and non_zero_threshold={1}'.format(perc_consensus_genes, non_zero_threshold))
-    ai, bi = np.where(np.isnan(data))
-    data[ai, bi] = 0
     num_transcripts, num_cells = data.shape
-    res_l = np.sum(data >= non_zero_threshold , axis=1)
-    res_h = np.sum(data > 0 , axis=1)
+    qc = get_qc_stats(data, non_zero_threshold)
     lower_bound = np.float(num_cells)*(1.-perc_consensus_genes)
     upper_bound = np.float(num_cells)*perc_consensus_genes
-    return np.where((res_l >= lower_bound) & (res_h <= upper_bound))[0]
+    return np.where((qc.gene_expr >= lower_bound) & (qc.gene_nnz <= upper_bound))[0]
 
 
-def data_transformation_log2(data):
+def gene_mean_var(data, chunk_size=1000):
     """
-    :param data: transcripts x cells data matrix
-    :return: log2 transformed data
+    :param data: transcripts x cells data matrix (dense or sparse)
+    :param chunk_size: number of cells that are processed at once
+    :return: mean and variance of each transcript (single pass)
+    """
+    num_transcripts, num_cells = data.shape
+    if sp.issparse(data):
+        if data.format == 'csr':
+            rows = np.repeat(np.arange(num_transcripts), np.diff(data.indptr))
+        else:
+            data = data.tocsc()
+            rows = data.indices
+        values = data.data.astype(np.float64)
+        sums = np.bincount(rows, weights=values, minlength=num_transcripts)
+        sqsums = np.bincount(rows, weights=values*values, minlength=num_transcripts)
+    else:
+        sums = np.zeros(num_transcripts)
+        sqsums = np.zeros(num_transcripts)
+        for i in range(0, num_cells, chunk_size):
+            block = np.asarray(data[:, i:i+chunk_size], dtype=np.float64)
+            sums += np.sum(block, axis=1)
+            sqsums += np.sum(block*block, axis=1)
+    mean = sums / np.float(num_cells)
+    var = np.maximum(sqsums / np.float(num_cells) - mean*mean, 0.)
+    return mean, var
+
+
+def hvg_filter(data, num_genes=2000, num_bins=20):
+    """
+    Highly variable genes: transcripts are binned by their mean expression and
+    the top transcripts w.r.t. their (within bin) z-scored dispersion are kept.
+    Intended for filtered and transformed data (see add_gene_filter(post_transform=True)).
+    :param data: transcripts x cells data matrix (dense or sparse)
+    :param num_genes: number of highly variable transcripts
+    :param num_bins: number of (equally spaced) mean expression bins
+    :return: indices of highly variable transcripts
+    """
+    print('SC3 highly variable gene filter with num_genes={0} and num_bins={1}'.format(num_genes, num_bins))
+    num_transcripts = data.shape[0]
+    if num_genes >= num_transcripts:
+        return np.arange(num_transcripts)
+    mean, var = gene_mean_var(data)
+    dispersion = np.zeros(num_transcripts)
+    expressed = mean > 0.
+    dispersion[expressed] = np.log(var[expressed] / mean[expressed] + 1e-12)
+    dispersion[~expressed] = -np.inf
+    # z-score the dispersion within each mean expression bin
+    edges = np.linspace(np.min(mean), np.max(mean), num_bins + 1)
+    bins = np.clip(np.searchsorted(edges, mean, side='right') - 1, 0, num_bins - 1)
+    bins[~expressed] = num_bins
+    counts = np.bincount(bins[expressed], minlength=num_bins + 1).astype(np.float64)
+    bin_mean = np.bincount(bins[expressed], weights=dispersion[expressed], minlength=num_bins + 1) / np.maximum(counts, 1.)
+    bin_sqmean = np.bincount(bins[expressed], weights=dispersion[expressed]**2, minlength=num_bins + 1) / np.maximum(counts, 1.)
+    bin_std = np.sqrt(np.maximum(bin_sqmean - bin_mean*bin_mean, 0.))
+    bin_std[bin_std <= 0.] = 1.
+    score = np.zeros(num_transcripts) - np.inf
+    score[expressed] = (dispersion[expressed] - bin_mean[bins[expressed]]) / bin_std[bins[expressed]]
+    inds = np.argsort(-score, kind='mergesort')[:num_genes]
+    return np.sort(inds)
+
+
+def data_transformation_log2(data, inplace=False):
+    """
+    :param data: transcripts x cells data matrix (dense or sparse)
+    :param inplace: transform (floating point) data in-place
+    :return: log2 transformed data (sparse data stays sparse)
     """
     print('SC3 log2 data transformation.')
-    return np.log2(data + 1.)
+    return transform_log2p1(data, inplace=inplace)
+
+
+class DistanceCache(object):
+    """ Least-recently-used cache of (read-only) cells x cells distance matrices
+        under a byte budget. Keys are content hashes of the data, i.e. equal data
+        in different arrays shares its distances.
+    """
+    max_bytes = 0
+    entries = None
+    num_bytes = 0
+    hits = 0
+    misses = 0
+    pinned = None  # list of [data, content hash (or None)] of data that does not change
+
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.pinned = list()
+
+    def key(self, data, metric, dtype):
+        """
+        :param data: data matrix or tuple of matrices (e.g. factors of a product)
+        """
+        if isinstance(data, tuple):
+            return tuple(map(self.data_key, data)), metric, np.dtype(dtype).str
+        return self.data_key(data), metric, np.dtype(dtype).str
+
+    def data_key(self, data):
+        """
+        :return: content hash of data (computed only once for pinned data)
+        """
+        for entry in self.pinned:
+            if entry[0] is data:
+                if entry[1] is None:
+                    entry[1] = data_sha1(data)
+                return entry[1]
+        return data_sha1(data)
+
+    @contextmanager
+    def pinned_data(self, data):
+        """
+        Within this context, the content hash of data is computed at most once (e.g. for all
+        distance metrics of the same pre-processed data), i.e. data must not be changed.
+        """
+        entry = [data, None]
+        self.pinned.append(entry)
+        try:
+            yield
+        finally:
+            self.pinned = [e for e in self.pinned if e is not entry]
+
+    def get(self, key):
+        X = self.entries.pop(key, None)
+        if X is None:
+            self.misses += 1
+            return None
+        self.entries[key] = X
+        self.hits += 1
+        return X
+
+    def put(self, key, X):
+        """
+        :return: X (read-only from now on, if it was stored)
+        """
+        if X.nbytes > self.max_bytes:
+            return X
+        X.flags.writeable = False
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.num_bytes -= old.nbytes
+        self.entries[key] = X
+        self.num_bytes += X.nbytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+        return X
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# all distance calculations (SC3, mixed distances, silhouette scores) share this cache
+DISTANCE_CACHE = DistanceCache()
 
 
 def da_nmf_distances(data, gene_ids, da_model, reject_ratio=0., metric='euclidean', mixture=0.5):
     if mixture == 0.0:
         return distances(data, [], metric=metric)
+    _, dists = next(da_nmf_distances_sweep(data, gene_ids, da_model, [mixture],
+                                           reject_ratio=reject_ratio, metric=metric))
+    return dists
+
 
+def da_nmf_distances_sweep(data, gene_ids, da_model, mixtures, reject_ratio=0., metric='euclidean', out=None):
+    """
+    Convex combinations of the vanilla distances and the (normalized) nmf distances
+    for a list of mixtures. Both base distance matrices are computed only once.
+    :param data: transcripts x cells data matrix
+    :param gene_ids: #transcripts vector with corresponding gene(transcript) ids
+    :param da_model: (W, H, H2) intermediate model of the domain adaptation nmf
+    :param mixtures: list of mixture parameters in [0, 1]
+    :param metric: string with distance metric name (ie. 'euclidean','pearson','spearman')
+    :param out: [optional] preallocated cells x cells output buffer
+    :return: generator of (mixture, cells x cells distance matrix) tuples; the same
+             (out-)buffer is overwritten for every mixture, copy it if it is needed later
+    """
     W, H, H2 = da_model
 
-    # convex combination of vanilla distance and nmf distance
     dist1 = distances(data, [], metric=metric)
-    dist2 = distances(W.dot(H2), [], metric=metric)
+    if out is None:
+        out = np.empty(dist1.shape, dtype=dist1.dtype)
+    diff = None
+    if np.any(np.array(mixtures) != 0.0):
+        # convex combination of vanilla distance and nmf distance
+        dist2 = nmf_distances(W, H2, metric=metric)
 
-    # normalize distance
-    if np.max(dist2) < 1e-10:
-        if mixture == 1.0:
-            raise Exception('Distances are all zero and mixture=1.0. Seems that source and target'
-                            ' data do not go well together.')
+        # normalize distance
+        if np.max(dist2) < 1e-10:
+            if 1.0 in mixtures:
+                raise Exception('Distances are all zero and mixture=1.0. Seems that source and target'
+                                ' data do not go well together.')
+            else:
+                print 'Warning! Max distance is 0.0.'
+            diff = dist2 - dist1
         else:
-            print 'Warning! Max distance is 0.0.'
-    else:
-        print 'Max dists before normalization: ', np.max(dist1), np.max(dist2)
-        dist2 *= np.max(dist1) / np.max(dist2)
-    return mixture*dist2 + (1.-mixture)*dist1
+            print 'Max dists before normalization: ', np.max(dist1), np.max(dist2)
+            # (cached) distances are read-only
+            diff = dist2 * (np.max(dist1) / np.max(dist2))
+            diff -= dist1
+
+    for mixture in mixtures:
+        # mixture*dist2 + (1-mixture)*dist1
+        if mixture == 0.0:
+            out[:] = dist1
+        else:
+            np.multiply(diff, mixture, out=out)
+            out += dist1
+        yield mixture, out
 
 
-def distances(data, gene_ids, metric='euclidean'):
+def nmf_distances(W, H, metric='euclidean', dtype=np.float64, use_cache=True):
     """
-    :param data: transcripts x cells data matrix
+    :param W: transcripts x k dictionary
+    :param H: k x cells coefficients (e.g. one-hot cluster assignments)
+    :param metric: string with distance metric name (ie. 'euclidean','pearson','spearman')
+    :param dtype: float dtype of the distances
+    :param use_cache: look up (and store) the distances in DISTANCE_CACHE
+    :return: cells x cells distance matrix of the reconstruction W H (never formed explicitly)
+    """
+    print('SC3 pairwise distance computations of NMF reconstructions (metric={0}).'.format(metric))
+    if not use_cache:
+        return low_rank_distances(W, H, metric=metric, dtype=dtype)
+    key = DISTANCE_CACHE.key((W, H), metric, dtype)
+    X = DISTANCE_CACHE.get(key)
+    if X is None:
+        X = DISTANCE_CACHE.put(key, low_rank_distances(W, H, metric=metric, dtype=dtype))
+    return X
+
+
+def distances(data, gene_ids, metric='euclidean', dtype=np.float64, out=None, use_cache=True):
+    """
+    :param data: transcripts x cells data matrix (dense or sparse)
     :param gene_ids: #transcripts vector with corresponding gene(transcript) ids
     :param metric: string with distance metric name (ie. 'euclidean','pearson','spearman')
-    :return: cells x cells distance matrix
+    :param dtype: float dtype of the distances (e.g. np.float32)
+    :param out: [optional] preallocated (C-contiguous) cells x cells output (bypasses the cache)
+    :param use_cache: look up (and store) the distances in DISTANCE_CACHE
+    :return: cells x cells distance matrix (read-only, if cached), see DistanceCache.pinned_data
+             for computing the distances of the same data for several metrics
     """
     print('SC3 pairwise distance computations (metric={0}).'.format(metric))
+    if use_cache and out is None:
+        key = DISTANCE_CACHE.key(data, metric, dtype)
+        X = DISTANCE_CACHE.get(key)
+        if X is None:
+            X = DISTANCE_CACHE.put(key, pairwise_distances(data, metric=metric, dtype=dtype))
+        return X
 
     # Euclidean: Use the standard Euclidean (as-the-crow-flies) distance.
     # Euclidean Squared: Use the Euclidean squared distance in cases where you would use regular Euclidean distance in Jarvis-Patrick or K-Means clustering.
@@ -107,16 +322,7 @@ def distances(data, gene_ids, metric='euclidean'):
     # Chebychev: Use Chebychev distance to cluster together genes that do not show dramatic expression differences in any samples; genes with a large expression difference in at least one sample are assigned to different clusters.
     # Spearman: Use Spearman Correlation to cluster together genes whose expression profiles have similar shapes or show similar general trends (e.g. increasing expression with time), but whose expression levels may be very different.
 
-    if metric == 'pearson':
-        X = 1. - np.corrcoef(data.T)
-    elif metric == 'spearman':
-        X, _ = stats.spearmanr(data, axis=0)
-        X = 1.-X
-    else:
-        X = dist.pdist(data.T, metric=metric)
-        X = dist.squareform(X)
-        # print X.shape
-    return X
+    return pairwise_distances(data, metric=metric, dtype=dtype, out=out)
 
 
 def transformations(dm, components=5, method='pca'):
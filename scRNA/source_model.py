@@ -0,0 +1,82 @@
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+from gene_vocabulary import lookup_gene_ids
+from nmf_clustering import NmfClustering
+
+# A source model is a directory with everything transfer learning needs from the
+# source NMF clustering: the dictionary W, the processed data and gene ids, the
+# cluster labels and the pre-processing config. Arrays are stored as plain
+# (uncompressed) .npy files and get memory-mapped when loading the model. Gene ids
+# are stored as int32 codes into a (sorted, unique) gene vocabulary of the model.
+SOURCE_MODEL_VERSION = 2
+MODEL_FNAME = 'model.json'
+ARRAY_NAMES = ['dictionary', 'pp_data', 'gene_vocabulary', 'gene_codes', 'cluster_labels', 'remain_cell_inds']
+
+
+def is_source_model(fname):
+    return os.path.isdir(fname) and os.path.exists(os.path.join(fname, MODEL_FNAME))
+
+
+def save_source_model(fname, nmf, config=None):
+    """
+    :param fname: source model directory (will be created)
+    :param nmf: applied NmfClustering
+    :param config: [optional] dictionary with the pre-processing configuration (JSON serializable)
+    """
+    assert isinstance(nmf, NmfClustering)
+    assert nmf.dictionary is not None
+    if not os.path.exists(fname):
+        os.makedirs(fname)
+    arrays = dict()
+    arrays['dictionary'] = nmf.dictionary
+    arrays['pp_data'] = nmf.pp_data
+    if sp.issparse(nmf.pp_data):
+        # dense arrays can be memory-mapped
+        arrays['pp_data'] = nmf.pp_data.toarray()
+    vocabulary_codes, gene_codes = np.unique(nmf.get_gene_codes()[nmf.remain_gene_inds], return_inverse=True)
+    arrays['gene_vocabulary'] = lookup_gene_ids(vocabulary_codes)
+    arrays['gene_codes'] = gene_codes.astype(np.int32)
+    arrays['cluster_labels'] = nmf.cluster_labels
+    arrays['remain_cell_inds'] = nmf.remain_cell_inds
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(fname, '{0}.npy'.format(name)), np.asarray(arrays[name]), allow_pickle=False)
+    model = dict()
+    model['version'] = SOURCE_MODEL_VERSION
+    model['num_cluster'] = int(nmf.num_cluster)
+    model['config'] = config
+    with open(os.path.join(fname, MODEL_FNAME), 'w') as f:
+        json.dump(model, f, indent=2, sort_keys=True)
+
+
+def load_source_model(fname, mmap_mode='r'):
+    """
+    :param fname: source model directory
+    :param mmap_mode: memory-map mode of the arrays (None loads them into RAM)
+    :return: NmfClustering (already processed, without any further filtering or transformation), config
+    """
+    if not is_source_model(fname):
+        raise StandardError('Source model \'{0}\' not found.'.format(fname))
+    with open(os.path.join(fname, MODEL_FNAME), 'r') as f:
+        model = json.load(f)
+    if not model['version'] == SOURCE_MODEL_VERSION:
+        raise StandardError('Source model \'{0}\' has unsupported version {1}.'.format(fname, model['version']))
+    arrays = dict()
+    for name in ARRAY_NAMES:
+        arrays[name] = np.load(os.path.join(fname, '{0}.npy'.format(name)), mmap_mode=mmap_mode, allow_pickle=False)
+    arrays['gene_ids'] = arrays['gene_vocabulary'][arrays['gene_codes']]
+
+    # the processed data is the data of the source model
+    nmf = NmfClustering(arrays['pp_data'], arrays['gene_ids'], num_cluster=model['num_cluster'])
+    nmf.add_cell_filter(lambda x: np.arange(x.shape[1]).tolist())
+    nmf.add_gene_filter(lambda x: np.arange(x.shape[0]).tolist())
+    nmf.set_data_transformation(lambda x: x)
+    nmf.pp_data = arrays['pp_data']
+    nmf.remain_gene_inds = np.arange(arrays['gene_ids'].size)
+    nmf.remain_cell_inds = arrays['remain_cell_inds']
+    nmf.cluster_labels = arrays['cluster_labels']
+    nmf.dictionary = arrays['dictionary']
+    return nmf, model['config']
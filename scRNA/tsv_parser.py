@@ -0,0 +1,184 @@
+import collections
+import gzip
+import hashlib
+import itertools
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+# Parsed TSV files are cached in a binary sidecar file next to the original. The
+# cache is keyed on file size and modification time. If only the modification
+# time differs (e.g. the file was copied or touched), the content hash decides.
+CACHE_SUFFIX = '.cache.npz'
+CACHE_VERSION = 2  # 2: sha1 of the (decompressed) content instead of the file
+
+
+def cache_fname(fname):
+    return '{0}{1}'.format(fname, CACHE_SUFFIX)
+
+
+def file_sha1(fname, block_size=1 << 20):
+    """
+    :return: sha1 hex digest of the (decompressed) content, i.e. the same as hashing
+             the lines streamed by the parser
+    """
+    sha1 = hashlib.sha1()
+    with _open(fname) as f:
+        block = f.read(block_size)
+        while block:
+            sha1.update(block)
+            block = f.read(block_size)
+    return sha1.hexdigest()
+
+
+def read_tsv(fname, dtype=np.float64, chunk_lines=2000, num_processes=4, use_cache=True):
+    """
+    Chunks of lines are parsed by a pool of worker processes (the parsing is
+    pure Python, i.e. threads would be serialized by the GIL). Files of a single
+    chunk and num_processes <= 1 are parsed in the calling process.
+    :param fname: tab-separated values file (may be gzipped, i.e. '*.gz')
+    :param dtype: numpy dtype of the entries (numeric or np.str)
+    :param chunk_lines: number of lines per parser chunk
+    :param num_processes: number of parser processes
+    :param use_cache: load from (and write to) the binary sidecar cache
+    :return: rows x columns array (squeezed to 1d for single rows/columns like np.loadtxt)
+    """
+    if not os.path.exists(fname):
+        raise StandardError('File \'{0}\' not found.'.format(fname))
+    dtype = np.dtype(dtype)
+    if use_cache:
+        data = load_tsv_cache(fname, dtype)
+        if data is not None:
+            print('Using cached binary sidecar \'{0}\'.'.format(cache_fname(fname)))
+            return data
+
+    parse_fun = _parse_numeric_chunk
+    if dtype.kind in 'SUa':
+        parse_fun = _parse_string_chunk
+    # the content is hashed (for the cache) while it is streamed to the parser
+    sha1 = hashlib.sha1()
+    chunks = _read_chunks(fname, chunk_lines, sha1)
+    head = list(itertools.islice(chunks, 2))
+    if num_processes > 1 and len(head) > 1:
+        blocks = _parse_parallel(parse_fun, itertools.chain(head, chunks), num_processes, dtype)
+    else:
+        blocks = [parse_fun(lines).astype(dtype, copy=False) for lines in itertools.chain(head, chunks)]
+    # chunks of blank lines only are skipped, all other chunks are validated by the parser
+    blocks = [b for b in blocks if b.shape[0] > 0]
+
+    if len(blocks) == 0:
+        data = np.zeros(0, dtype=dtype)
+    else:
+        num_cols = blocks[0].shape[1]
+        for b in blocks:
+            if not b.shape[1] == num_cols:
+                raise StandardError('Inconsistent number of columns in \'{0}\'.'.format(fname))
+        data = np.concatenate(blocks, axis=0)
+        del blocks
+        if data.shape[0] == 1 or data.shape[1] == 1:
+            data = data.ravel()
+
+    if use_cache:
+        save_tsv_cache(fname, dtype, data, sha1.hexdigest())
+    return data
+
+
+def load_tsv_cache(fname, dtype):
+    """
+    :return: cached array or None (if there is no valid cache for fname)
+    """
+    cname = cache_fname(fname)
+    if not os.path.exists(cname):
+        return None
+    try:
+        cache = np.load(cname)
+        if not cache['version'] == CACHE_VERSION or not str(cache['dtype']) == dtype.str:
+            return None
+        stat = os.stat(fname)
+        if not cache['size'] == stat.st_size:
+            return None
+        if not cache['mtime'] == stat.st_mtime and not str(cache['sha1']) == file_sha1(fname):
+            return None
+        return cache['data']
+    except (IOError, KeyError, ValueError):
+        print('Warning! Could not read cache file \'{0}\'.'.format(cname))
+    return None
+
+
+def save_tsv_cache(fname, dtype, data, sha1):
+    cname = cache_fname(fname)
+    stat = os.stat(fname)
+    try:
+        # np.savez would append '.npz' to the filename otherwise
+        with open(cname, 'wb') as f:
+            np.savez(f, version=CACHE_VERSION, dtype=dtype.str, data=data,
+                     size=stat.st_size, mtime=stat.st_mtime, sha1=sha1)
+    except IOError:
+        print('Warning! Could not write cache file \'{0}\'.'.format(cname))
+
+
+def _open(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def _read_chunks(fname, chunk_lines, sha1):
+    with _open(fname) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_lines))
+            if len(lines) == 0:
+                break
+            for l in lines:
+                sha1.update(l)
+            yield lines
+
+
+def _parse_parallel(parse_fun, chunks, num_processes, dtype):
+    """
+    :return: parsed chunks (in order), at most two chunks per process are in flight
+    """
+    pool = Pool(processes=num_processes)
+    pending = collections.deque()
+    blocks = list()
+    try:
+        for lines in chunks:
+            pending.append(pool.apply_async(parse_fun, (lines, )))
+            if len(pending) >= 2 * num_processes:
+                blocks.append(pending.popleft().get().astype(dtype, copy=False))
+        while pending:
+            blocks.append(pending.popleft().get().astype(dtype, copy=False))
+    finally:
+        pool.terminate()
+        pool.join()
+    return blocks
+
+
+def _parse_numeric_chunk(lines):
+    rows = _split_chunk(lines)
+    if len(rows) == 0:
+        return np.zeros((0, 0))
+    try:
+        values = np.array(list(itertools.chain.from_iterable(rows)), dtype=np.float64)
+    except ValueError as e:
+        raise StandardError('Could not parse numeric values ({0}).'.format(e))
+    return values.reshape((len(rows), len(rows[0])))
+
+
+def _parse_string_chunk(lines):
+    rows = _split_chunk(lines)
+    if len(rows) == 0:
+        return np.zeros((0, 0), dtype=np.str)
+    return np.array(rows, dtype=np.str)
+
+
+def _split_chunk(lines):
+    """
+    :param lines: list of lines (blank lines are skipped)
+    :return: list of rows (lists of tab-separated fields), all with the same number of fields
+    """
+    rows = [l.rstrip('\r\n').split('\t') for l in lines if l.strip()]
+    if not all(len(r) == len(rows[0]) for r in rows):
+        raise StandardError('Inconsistent number of columns in chunk.')
+    return rows
@@ -1,15 +1,82 @@
+import hashlib
 import os
 import numpy as np
+import scipy.io as sio
+import scipy.sparse as sp
 import sklearn.metrics as metrics
 import sc3_clustering_impl as sc
+from binary_dataset import is_binary_dataset, load_binary_dataset
+from gene_vocabulary import intern_gene_ids
+from tsv_parser import read_tsv
 
-def load_dataset_tsv(fname, fgenes=None, flabels=None):
+def compact_counts(data, chunk_size=1000):
+    """
+    :param data: transcripts x cells (dense or sparse) data matrix
+    :param chunk_size: number of cells that are checked at once
+    :return: data in the smallest unsigned integer dtype that holds it,
+             if all entries are non-negative integers (e.g. raw counts), unchanged data otherwise
+    """
+    values = data
+    if sp.issparse(data):
+        values = data.data
+    if values.ndim < 2:
+        # single row/column files are loaded as 1d arrays
+        values = values.reshape((values.size, 1))
+    if values.dtype.kind not in 'fiu' or values.size == 0:
+        return data
+    max_value = 0
+    for i in range(0, values.shape[1], chunk_size):
+        block = values[:, i:i+chunk_size]
+        if values.dtype.kind == 'f' and not np.all(np.floor(block) == block):
+            return data
+        if np.min(block) < 0:
+            return data
+        max_value = np.max([max_value, np.max(block)])
+    if not np.isfinite(max_value):
+        return data
+    for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+        if max_value <= np.iinfo(dtype).max:
+            break
+    if data.dtype == dtype:
+        return data
+    print('Compact count storage: {0} -> {1}.'.format(data.dtype, np.dtype(dtype)))
+    return data.astype(dtype)
+
+
+def array_fingerprint(data, num_samples=4096):
+    """
+    Cheap fingerprint of a (dense or sparse) array: dtype, shape, memory layout and
+    address and a fixed sample of entries (no full pass over the data).
+    :param data: numpy array or scipy sparse matrix
+    :param num_samples: number of sampled entries
+    :return: sha1 hex digest
+    """
+    if sp.issparse(data):
+        parts = [data.format, data.shape, data.nnz]
+        for name in ['data', 'indices', 'indptr', 'row', 'col', 'offsets']:
+            if hasattr(data, name):
+                parts.append(array_fingerprint(getattr(data, name), num_samples=num_samples))
+        return hashlib.sha1(str(parts)).hexdigest()
+    data = np.asanyarray(data)
+    sha1 = hashlib.sha1('{0}{1}{2}{3}'.format(
+        data.dtype.str, data.shape, data.strides, data.__array_interface__['data'][0]))
+    if data.size > 0:
+        inds = np.unique(np.linspace(0, data.size - 1, min(num_samples, data.size)).astype(np.int64))
+        sample = np.ascontiguousarray(data[np.unravel_index(inds, data.shape)])
+        sha1.update(sample.view(np.uint8))
+    return sha1.hexdigest()
+
+
+def load_dataset_tsv(fname, fgenes=None, flabels=None, use_cache=True):
     # check data filename
     if not os.path.exists(fname):
         raise StandardError('File \'{0}\' not found.'.format(fname))
 
+    # (gzipped) TSV files are parsed in parallel chunks and cached as binary sidecars
     print('Loading TSV data file from {0}.'.format(fname))
-    data = np.loadtxt(fname, delimiter='\t')
+    data = read_tsv(fname, use_cache=use_cache)
+    # raw counts are kept as (small) integers until they are processed
+    data = compact_counts(data)
     print data.shape
 
     gene_ids = np.arange(0, data.shape[0]).astype(np.str)
@@ -18,16 +85,17 @@ def load_dataset_tsv(fname, fgenes=None, flabels=None):
     if fgenes is None:
         print('Warning! Gene identifier file is not specified. Gene ids are now generated.')
     else:
-        gene_ids = np.loadtxt(fgenes, delimiter='\t', dtype=np.str)
+        gene_ids = read_tsv(fgenes, dtype=np.str, use_cache=use_cache)
         print('Gene ids loaded for {0} genes.'.format(gene_ids.shape[0]))
-        if not np.unique(gene_ids).shape[0] == gene_ids.shape[0]:
+        num_unique = np.unique(intern_gene_ids(gene_ids)).size
+        if not num_unique == gene_ids.shape[0]:
             print('Warning! Gene ids are supposed to be unique. '
-                  'Only {0} of {1}  entries are unique.'.format(np.unique(gene_ids).shape[0], gene_ids.shape[0]))
+                  'Only {0} of {1}  entries are unique.'.format(num_unique, gene_ids.shape[0]))
 
     labels = None
     if flabels is not None:
         print('Loading labels from \'{0}\'.'.format(flabels))
-        labels = np.loadtxt(flabels, delimiter='\t')
+        labels = read_tsv(flabels, use_cache=use_cache)
         assert labels.size == data.shape[1]
 
     return data, gene_ids, labels
@@ -36,6 +104,10 @@ def load_dataset_tsv(fname, fgenes=None, flabels=None):
 def load_dataset(fname):
     if not os.path.exists(fname):
         raise StandardError('File \'{0}\' not found.'.format(fname))
+    if is_binary_dataset(fname):
+        # memory-mapped, nothing is read until it is actually accessed
+        data, gene_ids, _, labels = load_binary_dataset(fname)
+        return data, gene_ids, labels
     foo = np.load(fname)
     data  = foo['data']
     gene_ids = foo['transcripts']
@@ -46,6 +118,90 @@ def load_dataset(fname):
     return data, gene_ids, labels
 
 
+def load_dataset_sparse(fname, fgenes=None, fbarcodes=None, flabels=None, gene_column=0):
+    """
+    :param fname: MatrixMarket file ('*.mtx', '*.mtx.gz') or scipy sparse matrix file ('*.npz')
+    :param fgenes: [optional] gene ids (TSV file, e.g. 10x 'genes.tsv')
+    :param fbarcodes: [optional] cell barcodes (TSV file, e.g. 10x 'barcodes.tsv')
+    :param flabels: [optional] labels (TSV file)
+    :param gene_column: column of the gene ids file that holds the ids
+    :return: transcripts x cells sparse (CSC) data matrix, gene ids, cell ids (or None), labels (or None)
+    """
+    if not os.path.exists(fname):
+        raise StandardError('File \'{0}\' not found.'.format(fname))
+
+    print('Loading sparse data file from {0}.'.format(fname))
+    if fname.endswith('.npz'):
+        data = sp.load_npz(fname).tocsc()
+    else:
+        data = sio.mmread(fname).tocsc()
+    data = compact_counts(data)
+    print('{0} with {1} non-zeros ({2:.2f}% density).'.format(
+        data.shape, data.nnz, 100. * data.nnz / np.float(max(1, data.shape[0] * data.shape[1]))))
+
+    gene_ids = np.arange(0, data.shape[0]).astype(np.str)
+    if fgenes is None:
+        print('Warning! Gene identifier file is not specified. Gene ids are now generated.')
+    else:
+        gene_ids = read_tsv(fgenes, dtype=np.str)
+        if gene_ids.ndim > 1:
+            gene_ids = gene_ids[:, gene_column]
+        assert gene_ids.size == data.shape[0]
+        print('Gene ids loaded for {0} genes.'.format(gene_ids.shape[0]))
+
+    cell_ids = None
+    if fbarcodes is not None:
+        cell_ids = read_tsv(fbarcodes, dtype=np.str)
+        if cell_ids.ndim > 1:
+            cell_ids = cell_ids[:, 0]
+        assert cell_ids.size == data.shape[1]
+
+    labels = None
+    if flabels is not None:
+        print('Loading labels from \'{0}\'.'.format(flabels))
+        labels = read_tsv(flabels)
+        assert labels.size == data.shape[1]
+    return data, gene_ids, cell_ids, labels
+
+
+def is_sparse_dataset(fname):
+    """
+    :param fname: filename
+    :return: True, if fname is a MatrixMarket file or scipy sparse matrix file
+    """
+    if fname.endswith('.mtx') or fname.endswith('.mtx.gz'):
+        return True
+    if fname.endswith('.npz') and os.path.isfile(fname):
+        with np.load(fname) as foo:
+            return 'indptr' in foo
+    return False
+
+
+def load_dataset_file(fname, fgenes=None, flabels=None):
+    """
+    :param fname: TSV data file, binary dataset directory or sparse (MatrixMarket, scipy *.npz) file
+    :param fgenes: [optional] gene ids (TSV file), overrides binary dataset gene ids
+    :param flabels: [optional] labels (TSV file), overrides binary dataset labels
+    :return: transcripts x cells data matrix, gene ids, labels (or None)
+    """
+    if is_sparse_dataset(fname):
+        data, gene_ids, _, labels = load_dataset_sparse(fname, fgenes=fgenes, flabels=flabels)
+        return data, gene_ids, labels
+    if not is_binary_dataset(fname):
+        return load_dataset_tsv(fname, fgenes=fgenes, flabels=flabels)
+    print('Loading binary dataset from {0}.'.format(fname))
+    data, gene_ids, labels = load_dataset(fname)
+    print data.shape
+    if fgenes is not None:
+        gene_ids = read_tsv(fgenes, dtype=np.str)
+        assert gene_ids.size == data.shape[0]
+    if flabels is not None:
+        print('Loading labels from \'{0}\'.'.format(flabels))
+        labels = read_tsv(flabels)
+        assert labels.size == data.shape[1]
+    return data, gene_ids, labels
+
+
 def normalize_kernel(K):
     # A kernel K is normalized, iff K_ii = 1 \forall i
     N = K.shape[0]
@@ -118,6 +274,8 @@ def unsupervised_acc_kta(X, labels, kernel='linear', param=1.0):
     Ky = np.zeros((labels.size, np.max(labels) + 1))
     for i in range(len(labels)):
         Ky[i, labels[i]] = 1.
+    if sp.issparse(X):
+        X = X.toarray()
 
     if kernel == 'rbf':
         Kx = get_kernel(X, X, type='rbf', param=param)
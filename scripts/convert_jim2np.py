@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 
+from scRNA.binary_dataset import create_binary_dataset
+
 
 def load_excel_description(fname):
     frame = pd.read_excel(fname)
@@ -41,14 +43,46 @@ def filter_low_coverage_cells(X, threshold=100000):
 
 def readcounts_to_rpm(X):
     # Assume X \in N^{Transcripts x Cells}
-    transcripts, cells = X.shape
     per_mio = np.array(np.sum(X, axis=0), dtype=np.float) / 1000000.
-    # print per_mio
-    # print np.min(per_mio)
-    # print np.sort(np.sum(X, axis=0))
-    # print np.where(np.sum(X, axis=0) <= 1e-20)[0]
-    div = np.repeat(per_mio[np.newaxis, :], transcripts, axis=0)
-    return np.array(X, dtype=np.float) / div
+    # broadcasting, i.e. no divisor matrix of the size of the data
+    return np.array(X, dtype=np.float) / per_mio[np.newaxis, :]
+
+
+def count_library_sizes(fname, chunksize=5000):
+    # First pass: stream the counts file in chunks of transcripts and
+    # accumulate the per-cell library sizes (total number of reads).
+    lib_sizes = None
+    transcripts = list()
+    for frame in pd.read_csv(fname, sep='\t', skiprows=1, chunksize=chunksize):
+        counts = frame.iloc[:, 6:].values
+        if lib_sizes is None:
+            lib_sizes = np.zeros(counts.shape[1], dtype=np.int64)
+            transcripts_header = frame.columns.values[:6]
+            cells = frame.columns.values[6:]
+        lib_sizes += np.sum(counts, axis=0, dtype=np.int64)
+        transcripts.append(frame.iloc[:, :6].values)
+    transcripts = np.concatenate(transcripts, axis=0)
+    print 'Transcripts x cells: ', transcripts.shape[0], cells.size
+    return lib_sizes, transcripts, transcripts_header, cells
+
+
+def convert_counts_to_rpm(fname, fout, chunksize=5000, dtype=np.float32):
+    # Two passes over the counts file, only a few chunks are in memory at any time:
+    # 1. per-cell library sizes, 2. RPM-normalize chunks and write them into a
+    # binary dataset (gene ids are the first column of the transcript description).
+    lib_sizes, transcripts, transcripts_header, cells = count_library_sizes(fname, chunksize=chunksize)
+    per_mio = np.array(lib_sizes, dtype=dtype) / dtype(1000000.)
+    rpm_data = create_binary_dataset(fout, (transcripts.shape[0], cells.size), dtype,
+                                     transcripts[:, 0], cell_ids=cells)
+    offset = 0
+    for frame in pd.read_csv(fname, sep='\t', skiprows=1, chunksize=chunksize):
+        block = np.array(frame.iloc[:, 6:].values, dtype=dtype)
+        block /= per_mio[np.newaxis, :]
+        rpm_data[offset:offset+block.shape[0], :] = block
+        offset += block.shape[0]
+    rpm_data.flush()
+    print 'RPM data written to: ', fout
+    return rpm_data, lib_sizes, transcripts, transcripts_header
 
 
 if __name__ == "__main__":
@@ -56,14 +90,18 @@ if __name__ == "__main__":
     XSL_FILE = '{0}Single-cellRNAseqMetaData_All.xlsx'.format(PATH)
     CNT_FILE = '{0}counts.txt'.format(PATH)
 
-    xlsx_data, xlsx_header = load_excel_description(XSL_FILE)
-    data, transcripts, transcripts_header = load_counts(CNT_FILE)
+    RPM_DIR = '{0}pfizer_rpm'.format(PATH)
 
-    filtered_inds = filter_low_coverage_cells(data)
-    rpm_data = readcounts_to_rpm(data)
+    xlsx_data, xlsx_header = load_excel_description(XSL_FILE)
+    # streaming conversion: RPM data is stored as (float32) binary dataset
+    rpm_data, lib_sizes, transcripts, transcripts_header = convert_counts_to_rpm(CNT_FILE, RPM_DIR)
     print rpm_data[:4,:8]
 
-    np.savez_compressed('pfizer_data.npz', filtered_inds=filtered_inds, data=data, rpm_data=rpm_data,
+    # same as filter_low_coverage_cells but based on the library sizes of the first pass
+    filtered_inds = np.where(lib_sizes > 100000)[0]
+    print 'Filtered {0}/{1} cells.'.format(lib_sizes.size-filtered_inds.size, lib_sizes.size)
+
+    np.savez_compressed('pfizer_data.npz', filtered_inds=filtered_inds, lib_sizes=lib_sizes, rpm_dir=RPM_DIR,
                         transcripts=transcripts, transcripts_header=transcripts_header,
                         xlsx_data=xlsx_data, xlsx_header=xlsx_header)
 
@@ -1,16 +1,16 @@
 import numpy as np
-import pdb
 import pandas as pd
 
-def intersect(a, b):
-    return list(set(a) & set(b))
+from scRNA.binary_dataset import load_binary_dataset
+from scRNA.dataset_merge import map_gene_ids, merge_datasets
 
 # Load Pfizer data
 data_pfizer = np.load('C:\Users\Bettina\ml\scRNAseq\Data\Pfizer data\pfizer_data.npz')
 cell_names_pfizer = data_pfizer['filtered_inds']
-gene_IDs_pfizer = tuple(x[0] for x in data_pfizer['transcripts'])
-data_array_pfizer_raw = data_pfizer['rpm_data']
-pdb.set_trace()
+gene_IDs_pfizer = np.array([x[0] for x in data_pfizer['transcripts']])
+# RPM data is stored as memory-mapped binary dataset (see convert_jim2np.py)
+data_array_pfizer_raw, _, _, _ = load_binary_dataset(str(data_pfizer['rpm_dir']))
+
 # Load Usoskin data
 data_uso = np.load('C:\Users\Bettina\ml\scRNAseq\data\Usoskin.npz')
 cell_names_uso = data_uso['cells']
@@ -20,33 +20,15 @@ data_array_uso = data_uso['data']
 # Convert gene IDs to gene names
 raw_gene_names = pd.read_table('C:\Users\Bettina\ml\scRNAseq\Data\Pfizer data\gene_names.txt')
 gene_names = raw_gene_names.as_matrix()
-gene_IDs_ensembl_order = tuple(x[1] for x in gene_names)
-
-# Select the right genes in Pfizer data
-transcript_names_pfizer_temp=[]
-data_array_pfizer_temp=[]
-for x in gene_IDs_pfizer:
-    if x in gene_IDs_ensembl_order:
-        transcript_names_pfizer_temp.append(gene_names[gene_IDs_ensembl_order.index(x),0])
-        data_array_pfizer_temp.append(data_array_pfizer_raw[gene_IDs_ensembl_order.index(x)])
-
-data_array_pfizer = np.asarray(data_array_pfizer_temp)
-transcript_names_pfizer = np.asarray(transcript_names_pfizer_temp)
-
-transcript_names_uso_now = transcript_names_uso.tolist()
-common_genes = intersect(transcript_names_pfizer_temp, transcript_names_uso)
-
-# Combine the two datasets
-data_pfizer_uso=[]
-for x in common_genes:
-    data_pfizer_uso_temp = data_array_pfizer[transcript_names_pfizer_temp.index(x)].tolist()
-    data_pfizer_uso_temp_2 = data_array_uso[transcript_names_uso_now.index(x)].tolist()
-    data_pfizer_uso_temp.extend(data_pfizer_uso_temp_2)
-    data_pfizer_uso.append(data_pfizer_uso_temp)
-
-data_array_pfizer_uso = np.asarray(data_pfizer_uso)
+
+# Select the right genes in Pfizer data (sorted lookup table instead of a linear search per gene)
+transcript_names_pfizer, pfizer_inds = map_gene_ids(gene_IDs_pfizer, gene_names[:, 1], gene_names[:, 0])
+data_array_pfizer = data_array_pfizer_raw[pfizer_inds, :]
+
+# Combine the two datasets (aligned on the common gene names)
+data_array_pfizer_uso, transcript_names_pfizer_uso = merge_datasets(
+    [data_array_pfizer, data_array_uso], [transcript_names_pfizer, transcript_names_uso])
 cell_names_pfizer_uso = np.asarray(list(cell_names_pfizer) + list(cell_names_uso))
-transcript_names_pfizer_uso = np.asarray(common_genes)
 
 # Save data
 # Pfizer
@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 
+from scRNA.utils import compact_counts
+
 
 def load_Zeisel(path):
     frame = pd.read_table(PATH + 'GSE60361_C1-3005-Expression.txt')
@@ -11,7 +13,7 @@ def load_Zeisel(path):
     encoding = 'Read Counts'
     transcripts = table[:, 0]
     cells = frame.columns.values[1:]
-    data = np.array(table[:, 1:], dtype=np.float64)
+    data = compact_counts(np.array(table[:, 1:], dtype=np.float64))
 
     print '----------- Summary ------------'
     print 'General: ', name, encoding, data.shape, cells.shape
@@ -31,7 +33,7 @@ def load_Ting(path):
     encoding = 'Read Counts'
     transcripts = table[:, 3]
     cells = frame.columns.values[6:]
-    data = np.array(table[:, 6:], dtype=np.float64)
+    data = compact_counts(np.array(table[:, 6:], dtype=np.float64))
 
     print '----------- Summary ------------'
     print 'General: ', name, encoding, data.shape, cells.shape
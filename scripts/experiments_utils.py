@@ -103,6 +103,55 @@ def method_sc3(src, src_labels, trg, trg_labels, n_src_cluster, n_trg_cluster,
     return desc, nmf_src.cluster_labels, cp.cluster_labels, nmf_trg.reject
 
 
+def method_sc3_sweep(src, src_labels, trg, trg_labels, n_src_cluster, n_trg_cluster,
+                     mixes=None, func=np.argmax, limit_pc_range=-1, metric='euclidean', consensus_mode=0,
+                     reject_ratio=0.0, calc_transferability=True):
+    """ Same as method_hub over method_sc3 (with use_da_dists=True) for all mixes, but
+        with a single da-nmf model and both base distance matrices computed only once.
+    """
+    if mixes is None:
+        mixes = [0.0, 0.5]
+    num_cells = trg.shape[1]
+    if num_cells > limit_pc_range > 0:
+        print('Limit PC range to :'.format(limit_pc_range))
+        num_cells = limit_pc_range
+    max_pca_comp = np.ceil(num_cells * 0.07).astype(np.int)
+    min_pca_comp = np.floor(num_cells * 0.04).astype(np.int)
+    print 'Min and max PCA components: ', min_pca_comp, max_pca_comp
+
+    nmf_src = NmfClustering(src, np.arange(src.shape[0]), num_cluster=n_src_cluster)
+    nmf_trg = DaNmfClustering(nmf_src, trg, np.arange(trg.shape[0]), num_cluster=n_trg_cluster)
+    nmf_trg.get_mixed_data(mix=0.0, reject_ratio=reject_ratio, calc_transferability=calc_transferability)
+
+    cp = SC3Clustering(trg, pc_range=[min_pca_comp, max_pca_comp],
+                       consensus_mode=consensus_mode, sub_sample=True)
+    cp.add_distance_sweep(partial(sc.da_nmf_distances_sweep,
+                                  da_model=nmf_trg.intermediate_model,
+                                  metric=metric, mixtures=mixes, reject_ratio=reject_ratio))
+    cp.add_dimred_calculation(partial(sc.transformations, components=max_pca_comp, method='pca'))
+    cp.add_intermediate_clustering(partial(sc.intermediate_kmeans_clustering, k=n_trg_cluster))
+    cp.set_build_consensus_matrix(sc.build_consensus_matrix)
+    cp.set_consensus_clustering(partial(sc.consensus_clustering, n_components=n_trg_cluster))
+    trg_lbls = [lbls for _, lbls, _ in cp.apply_sweep()]
+
+    aris = np.zeros(len(mixes))
+    for i in range(len(mixes)):
+        aris[i] = metrics.adjusted_rand_score(trg_labels, trg_lbls[i])
+    ind = func(aris)
+
+    # add some description
+    desc = {}
+    desc['method'] = 'SC3'
+    desc['metric'] = metric
+    desc['reject'] = reject_ratio
+    desc['mix'] = mixes[ind]
+    desc['use_da_dists'] = True
+    desc['da_model'] = 'shared by all mixtures'
+    desc['hub'] = func
+    desc['stats'] = (np.max(aris), np.min(aris), np.mean(aris))
+    return desc, nmf_src.cluster_labels, trg_lbls[ind], nmf_trg.reject
+
+
 def get_strat_lbl_inds(src_labels, trg_labels):
     src_lbl_set = np.unique(src_labels)
     strat_lbl_inds = []
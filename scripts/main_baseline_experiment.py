@@ -3,7 +3,7 @@ from functools import partial
 
 import matplotlib.pyplot as plt
 from clustermap import process_jobs, Job
-from experiments_utils import (method_sc3, method_sc3_combined, method_hub,
+from experiments_utils import (method_sc3, method_sc3_combined, method_sc3_sweep, method_hub,
                                acc_ari, acc_reject_ari, acc_reject_auc,
                                acc_kta, acc_silhouette, acc_transferability, experiment_loop)
 from scRNA.sc3_clustering import *
@@ -120,11 +120,6 @@ if __name__ == "__main__":
             reject_list.append(partial(method_sc3, mix=m, reject_ratio=r, calc_transferability=False,
                                        metric='euclidean', use_da_dists=False))
 
-    dist_list = list()
-    for m in mixes:
-        dist_list.append(partial(method_sc3, mix=m, metric='euclidean',
-                                 calc_transferability=False, reject_ratio=0., use_da_dists=True))
-
     mixed_list = list()
     for m in mixes:
         mixed_list.append(partial(method_sc3, mix=m, metric='euclidean',
@@ -135,8 +130,10 @@ if __name__ == "__main__":
     # original
     methods.append(partial(method_sc3, mix=0.0, reject_ratio=0., metric='euclidean'))
     # transfer via distances
-    methods.append(partial(method_hub, method_list=dist_list, func=np.argmax))
-    methods.append(partial(method_hub, method_list=dist_list, func=np.argmin))
+    methods.append(partial(method_sc3_sweep, mixes=mixes, func=np.argmax, metric='euclidean',
+                           calc_transferability=False, reject_ratio=0.))
+    methods.append(partial(method_sc3_sweep, mixes=mixes, func=np.argmin, metric='euclidean',
+                           calc_transferability=False, reject_ratio=0.))
     # transfer via mixing
     methods.append(partial(method_hub, method_list=mixed_list, func=np.argmax))
     methods.append(partial(method_hub, method_list=mixed_list, func=np.argmin))
@@ -185,8 +182,10 @@ if __name__ == "__main__":
     # original
     methods.append(partial(method_sc3, mix=0.0, reject_ratio=0., metric='euclidean'))
     # transfer via distances
-    methods.append(partial(method_hub, method_list=dist_list, func=np.argmax))
-    methods.append(partial(method_hub, method_list=dist_list, func=np.argmin))
+    methods.append(partial(method_sc3_sweep, mixes=mixes, func=np.argmax, metric='euclidean',
+                           calc_transferability=False, reject_ratio=0.))
+    methods.append(partial(method_sc3_sweep, mixes=mixes, func=np.argmin, metric='euclidean',
+                           calc_transferability=False, reject_ratio=0.))
     # transfer via mixing
     methods.append(partial(method_hub, method_list=mixed_list, func=np.argmax))
     methods.append(partial(method_hub, method_list=mixed_list, func=np.argmin))
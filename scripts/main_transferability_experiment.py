@@ -2,7 +2,7 @@ from functools import partial
 
 import matplotlib.pyplot as plt
 from clustermap import process_jobs, Job
-from experiments_utils import (method_sc3, method_sc3_combined, method_hub,
+from experiments_utils import (method_sc3, method_sc3_combined, method_sc3_sweep, method_hub,
                                acc_ari, acc_reject_ari, acc_reject_auc,
                                acc_kta, acc_silhouette, acc_transferability, experiment_loop)
 from scRNA.sc3_clustering import *
@@ -67,16 +67,13 @@ if __name__ == "__main__":
     acc_funcs.append(acc_transferability)
 
     mixes = [0.1, 0.2, 0.3, 0.5]
-    dist_list = list()
-    for m in mixes:
-        dist_list.append(partial(method_sc3, mix=m, metric='euclidean', reject_ratio=0., use_da_dists=True))
 
     methods = list()
     # original
     methods.append(partial(method_sc3, mix=0.0, reject_ratio=0., metric='euclidean'))
     # transfer via distances
-    methods.append(partial(method_hub, method_list=dist_list, func=np.argmax))
-    methods.append(partial(method_hub, method_list=dist_list, func=np.argmin))
+    methods.append(partial(method_sc3_sweep, mixes=mixes, func=np.argmax, metric='euclidean', reject_ratio=0.))
+    methods.append(partial(method_sc3_sweep, mixes=mixes, func=np.argmin, metric='euclidean', reject_ratio=0.))
 
     fname = 'transf_v1'
 
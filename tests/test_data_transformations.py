@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+
+from scRNA.data_transformations import transform_cpm, transform_log2_cpm, transform_log2p1
+
+
+class DataTransformationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.counts = np.floor(np.random.RandomState(0).exponential(5., size=(40, 30))).astype(np.uint16)
+        self.counts[:, 3] = 0
+
+    def test_log2p1(self):
+        ref = np.log2(self.counts.astype(np.float64) + 1.)
+        for data in [self.counts, np.asfortranarray(self.counts), self.counts.astype(np.float64)]:
+            X = transform_log2p1(data, inplace=False, chunk_size=7)
+            np.testing.assert_allclose(X, ref)
+            self.assertEqual(X.dtype, np.float64)
+        X = transform_log2p1(sp.csc_matrix(self.counts), chunk_size=7)
+        np.testing.assert_allclose(X.toarray(), ref)
+        # floating point data is transformed in-place
+        data = np.asfortranarray(self.counts, dtype=np.float64)
+        self.assertIs(transform_log2p1(data, chunk_size=7), data)
+        np.testing.assert_allclose(data, ref)
+
+    def test_cpm(self):
+        counts = self.counts.astype(np.float64)
+        lib_sizes = counts.sum(axis=0)
+        lib_sizes[3] = 1.
+        ref = counts / lib_sizes * 1e6
+        np.testing.assert_allclose(transform_cpm(self.counts, chunk_size=7), ref)
+        np.testing.assert_allclose(transform_cpm(sp.csr_matrix(self.counts)).toarray(), ref)
+        np.testing.assert_allclose(transform_log2_cpm(self.counts, inplace=False), np.log2(ref + 1.))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.spatial.distance as dist
+import scipy.stats as stats
+
+from scRNA import distance_engine as de
+
+
+def reference(data, metric):
+    if metric == 'pearson':
+        metric = 'correlation'
+    if metric == 'spearman':
+        return 1. - stats.spearmanr(data)[0]
+    return dist.squareform(dist.pdist(data.T, metric))
+
+
+class DenseDistancesTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        # ties (for the ranks) and a zero sample
+        self.data = np.floor(rs.exponential(2., size=(40, 70)))
+        self.data[:, 5] = 0.
+
+    def test_metrics(self):
+        data = self.data.copy()
+        data[0, 5] = 1.  # zero (or constant) samples have no Pearson/Spearman distances
+        for metric in ['euclidean', 'sqeuclidean', 'pearson', 'spearman', 'cityblock', 'cosine']:
+            ref = reference(data, metric)
+            for block_size in [7, 512]:
+                res = de.pairwise_distances(data, metric=metric, block_size=block_size)
+                np.testing.assert_allclose(res, ref, rtol=1e-10, atol=1e-10, err_msg=metric)
+                np.testing.assert_array_equal(res, res.T)
+
+    def test_constant_samples(self):
+        data = self.data.copy()
+        data[:, 5] = 1.
+        for metric in ['pearson', 'spearman']:
+            res = de.pairwise_distances(data, metric=metric)
+            self.assertTrue(np.all(np.isnan(res[5, :])))
+            self.assertTrue(np.all(np.isnan(res[:, 5])))
+            self.assertFalse(np.any(np.isnan(np.delete(np.delete(res, 5, 0), 5, 1))))
+
+    def test_layouts_and_dtypes(self):
+        ref = reference(self.data, 'euclidean')
+        for data in [np.asfortranarray(self.data), self.data.astype(np.int32), self.data[:, ::2]]:
+            res = de.pairwise_distances(data, metric='euclidean')
+            np.testing.assert_allclose(res, reference(np.asarray(data, dtype=np.float64), 'euclidean'), atol=1e-10)
+        res = de.pairwise_distances(self.data, metric='pearson', dtype=np.float32)
+        self.assertEqual(res.dtype, np.float32)
+        np.testing.assert_allclose(np.delete(np.delete(res, 5, 0), 5, 1),
+                                   np.delete(np.delete(reference(self.data, 'pearson'), 5, 0), 5, 1), atol=1e-5)
+        # input is never changed
+        data = np.asfortranarray(self.data)
+        orig = data.copy()
+        de.pairwise_distances(data, metric='pearson')
+        np.testing.assert_array_equal(data, orig)
+
+    def test_output_buffer(self):
+        out = np.empty((70, 70))
+        res = de.pairwise_distances(self.data, metric='euclidean', out=out)
+        self.assertIs(res, out)
+        self.assertRaises(Exception, de.pairwise_distances, self.data, out=np.empty((70, 70), dtype=np.float32))
+
+    def test_tiled_metrics(self):
+        for metric in ['cityblock', 'chebyshev']:
+            ref = reference(self.data, metric)
+            for num_threads in [1, 3]:
+                for block_size in [7, 512]:
+                    out = np.empty((70, 70))
+                    res = de.pairwise_distances(self.data, metric=metric, out=out,
+                                                block_size=block_size, num_threads=num_threads)
+                    self.assertIs(res, out)
+                    np.testing.assert_allclose(res, ref, rtol=1e-10, atol=1e-10, err_msg=metric)
+
+    def test_low_rank(self):
+        rs = np.random.RandomState(1)
+        W = rs.rand(60, 4)
+        H = rs.rand(4, 50)
+        H2 = np.eye(4)[:, rs.randint(0, 4, 50)]
+        for coeffs in [H, H2]:
+            for metric in ['euclidean', 'pearson', 'spearman', 'cityblock']:
+                np.testing.assert_allclose(de.low_rank_distances(W, coeffs, metric=metric),
+                                           reference(W.dot(coeffs), metric), rtol=1e-10, atol=1e-10)
+
+
+class SparseDistancesTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.data = np.floor(rs.exponential(2., size=(40, 70)) * (rs.rand(40, 70) < 0.3))
+        self.data[:, 5] = 0.
+
+    def test_metrics(self):
+        data = self.data.copy()
+        data[0, 5] = 1.
+        for metric in ['euclidean', 'sqeuclidean', 'pearson', 'spearman', 'cityblock', 'cosine']:
+            ref = reference(data, metric)
+            for fmt in [sp.csc_matrix, sp.csr_matrix]:
+                for block_size in [7, 512]:
+                    res = de.pairwise_distances(fmt(data), metric=metric, block_size=block_size)
+                    np.testing.assert_allclose(res, ref, rtol=1e-10, atol=1e-10, err_msg=metric)
+                    np.testing.assert_array_equal(res, res.T)
+
+    def test_constant_samples(self):
+        # (non-integer values do not cancel exactly)
+        for value in [0., 1., 0.1, 1. / 3.]:
+            data = self.data.copy()
+            data[:, 5] = value
+            for metric in ['pearson', 'spearman']:
+                res = de.pairwise_distances(sp.csc_matrix(data), metric=metric, block_size=7)
+                dense = de.pairwise_distances(data, metric=metric, block_size=7)
+                np.testing.assert_array_equal(np.isnan(res), np.isnan(dense))
+                self.assertTrue(np.all(np.isnan(res[5, :])))
+                self.assertTrue(np.all(np.isnan(res[:, 5])))
+                self.assertFalse(np.any(np.isinf(res)))
+                np.testing.assert_allclose(res, dense, atol=1e-10)
+
+
+class RankCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        de.clear_rank_cache()
+
+    def test_cached_ranks(self):
+        data = np.asfortranarray(np.floor(np.random.RandomState(0).exponential(2., size=(30, 20))))
+        ranks = de.rank_data(data)
+        self.assertFalse(ranks.flags.writeable)
+        self.assertIs(de.rank_data(data), ranks)
+        # equal content hits, changed content does not
+        self.assertIs(de.rank_data(data.copy(order='F')), ranks)
+        changed = data.copy(order='F')
+        changed[0, 0] += 1.
+        self.assertIsNot(de.rank_data(changed), ranks)
+        np.testing.assert_array_equal(ranks, np.apply_along_axis(stats.rankdata, 0, data))
+
+    def test_data_sha1(self):
+        data = np.random.RandomState(0).rand(5, 4)
+        self.assertEqual(de.data_sha1(data), de.data_sha1(data.copy()))
+        self.assertEqual(de.data_sha1(np.asfortranarray(data)), de.data_sha1(np.asfortranarray(data)))
+        self.assertNotEqual(de.data_sha1(data), de.data_sha1(data.T))
+        changed = data.copy()
+        changed[4, 3] = 0.
+        self.assertNotEqual(de.data_sha1(data), de.data_sha1(changed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import pickle
+import unittest
+
+import numpy as np
+
+from scRNA.gene_vocabulary import GeneVocabulary, align_gene_codes
+from scRNA.nmf_clustering import NmfClustering
+
+
+class GeneVocabularyTest(unittest.TestCase):
+
+    def test_intern_and_lookup(self):
+        voc = GeneVocabulary()
+        codes1 = voc.intern(np.array(['b', 'a', 'c', 'a']))
+        codes2 = voc.intern(['c', 'd'])
+        self.assertEqual(codes1[1], codes1[3])
+        self.assertEqual(codes1[2], codes2[0])
+        np.testing.assert_array_equal(voc.lookup(codes1), ['b', 'a', 'c', 'a'])
+        np.testing.assert_array_equal(voc.lookup(codes2), ['c', 'd'])
+        self.assertEqual(len(voc), 4)
+
+    def test_arrays_are_interned_once(self):
+        voc = GeneVocabulary()
+        gene_ids = np.array(['x', 'y'])
+        codes = voc.intern(gene_ids)
+        self.assertIs(voc.intern(gene_ids), codes)
+        self.assertFalse(codes.flags.writeable)
+        # an equal, but different array is interned again (with the same codes)
+        other = voc.intern(gene_ids.copy())
+        self.assertIsNot(other, codes)
+        np.testing.assert_array_equal(other, codes)
+        self.assertEqual(len(voc.interned), 1)
+        # entries are removed together with their arrays
+        del gene_ids
+        self.assertEqual(len(voc.interned), 0)
+
+    def test_align(self):
+        common, inds1, inds2 = align_gene_codes(np.array([5, 3, 1, 3]), np.array([1, 2, 3]))
+        np.testing.assert_array_equal(common, [1, 3])
+        np.testing.assert_array_equal(inds1, [2, 1])
+        np.testing.assert_array_equal(inds2, [0, 2])
+
+
+class LegacyPickleTest(unittest.TestCase):
+
+    def test_missing_attributes(self):
+        nmf = NmfClustering(np.random.rand(10, 5), np.array(['g{0}'.format(i) for i in range(10)]), num_cluster=2)
+        # objects pickled by older versions have neither gene codes nor post-transform filters
+        del nmf.__dict__['post_gene_filter_list']
+        nmf.data_transf = None
+        nmf = pickle.loads(pickle.dumps(nmf))
+        self.assertEqual(nmf.post_gene_filter_list, list())
+        self.assertIsNone(nmf.gene_codes)
+        np.testing.assert_array_equal(nmf.get_gene_codes(), nmf.get_gene_codes())
+        nmf.pp_config()
+
+
+if __name__ == '__main__':
+    unittest.main()
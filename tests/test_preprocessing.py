@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+import unittest
+from functools import partial
+
+import numpy as np
+import scipy.sparse as sp
+
+import scRNA.sc3_clustering_impl as sc
+from scRNA.nmf_clustering import NmfClustering
+
+
+# Reference implementation of the filters and the pre-processing before
+# they were based on shared QC statistics and boolean masks.
+def ref_cell_filter(data, num_expr_genes=2000, non_zero_threshold=2):
+    data = data.copy()
+    data[np.isnan(data)] = 0
+    res = np.sum(data >= non_zero_threshold, axis=0)
+    return np.where(np.isfinite(res) & (res >= num_expr_genes))[0]
+
+
+def ref_gene_filter(data, perc_consensus_genes=0.94, non_zero_threshold=2):
+    data = data.copy()
+    data[np.isnan(data)] = 0
+    num_cells = data.shape[1]
+    res_l = np.sum(data >= non_zero_threshold, axis=1)
+    res_h = np.sum(data > 0, axis=1)
+    lower_bound = np.float(num_cells)*(1.-perc_consensus_genes)
+    upper_bound = np.float(num_cells)*perc_consensus_genes
+    return np.where((res_l >= lower_bound) & (res_h <= upper_bound))[0]
+
+
+def ref_pre_processing(data, cell_filters, gene_filters, data_transf):
+    transcripts, cells = data.shape
+    data = data.copy()
+    remain_cell_inds = np.arange(0, cells)
+    for c in cell_filters:
+        remain_cell_inds = np.intersect1d(remain_cell_inds, c(data))
+    remain_gene_inds = np.arange(0, transcripts)
+    for g in gene_filters:
+        remain_gene_inds = np.intersect1d(remain_gene_inds, g(data))
+    data[np.isnan(data)] = 0
+    X = data_transf(data[:, remain_cell_inds][remain_gene_inds, :])
+    return X, remain_gene_inds, remain_cell_inds
+
+
+def counts(num_genes=300, num_cells=200, nan=True, seed=0):
+    rs = np.random.RandomState(seed)
+    # genes (and cells) with very different fractions of zeros
+    p = np.linspace(0.05, 0.95, num_genes)[:, np.newaxis] * np.linspace(0.5, 1., num_cells)[np.newaxis, :]
+    data = np.floor(rs.exponential(2., size=(num_genes, num_cells)) * (rs.rand(num_genes, num_cells) < p))
+    if nan:
+        data[rs.randint(0, num_genes, 20), rs.randint(0, num_cells, 20)] = np.nan
+    return data
+
+
+class FilterTest(unittest.TestCase):
+
+    def test_filters(self):
+        data = counts()
+        for threshold in [1, 2, 3.5]:
+            for num_expr_genes in [0, 40, 80]:
+                np.testing.assert_array_equal(
+                    sc.cell_filter(data, num_expr_genes=num_expr_genes, non_zero_threshold=threshold),
+                    ref_cell_filter(data, num_expr_genes=num_expr_genes, non_zero_threshold=threshold))
+            for perc in [0.5, 0.8, 0.94]:
+                np.testing.assert_array_equal(
+                    sc.gene_filter(data, perc_consensus_genes=perc, non_zero_threshold=threshold),
+                    ref_gene_filter(data, perc_consensus_genes=perc, non_zero_threshold=threshold))
+
+    def test_filters_do_not_change_data(self):
+        data = counts()
+        orig = data.copy()
+        sc.cell_filter(data, num_expr_genes=40)
+        sc.gene_filter(data)
+        np.testing.assert_array_equal(np.isnan(data), np.isnan(orig))
+
+    def test_sparse_filters(self):
+        data = counts(nan=False)
+        for fmt in ['csc', 'csr', 'coo']:
+            sdata = sp.csc_matrix(data).asformat(fmt)
+            np.testing.assert_array_equal(sc.cell_filter(sdata, num_expr_genes=40),
+                                          ref_cell_filter(data, num_expr_genes=40))
+            np.testing.assert_array_equal(sc.gene_filter(sdata, perc_consensus_genes=0.8),
+                                          ref_gene_filter(data, perc_consensus_genes=0.8))
+
+
+class PreProcessingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def clustering(self, data, mask_filter=False, pp_fname=None):
+        nmf = NmfClustering(data, np.arange(data.shape[0]), num_cluster=3)
+        nmf.pp_cache = None
+        nmf.pp_chunk_size = 17
+        nmf.pp_fname = pp_fname
+        nmf.add_cell_filter(partial(sc.cell_filter, num_expr_genes=40, non_zero_threshold=1))
+        if mask_filter:
+            # filters may also return boolean masks
+            nmf.add_cell_filter(lambda x: np.arange(x.shape[1]) % 3 > 0)
+        nmf.add_gene_filter(partial(sc.gene_filter, perc_consensus_genes=0.8, non_zero_threshold=1))
+        nmf.set_data_transformation(partial(sc.data_transformation_log2, inplace=True))
+        return nmf
+
+    def reference(self, data, mask_filter=False):
+        cell_filters = [partial(ref_cell_filter, num_expr_genes=40, non_zero_threshold=1)]
+        if mask_filter:
+            cell_filters.append(lambda x: np.where(np.arange(x.shape[1]) % 3 > 0)[0])
+        gene_filters = [partial(ref_gene_filter, perc_consensus_genes=0.8, non_zero_threshold=1)]
+        return ref_pre_processing(data, cell_filters, gene_filters, lambda x: np.log2(x + 1.))
+
+    def assert_pre_processing(self, nmf, ref):
+        X = nmf.pre_processing()
+        if sp.issparse(X):
+            X = X.toarray()
+        np.testing.assert_allclose(X, ref[0])
+        np.testing.assert_array_equal(nmf.remain_gene_inds, ref[1])
+        np.testing.assert_array_equal(nmf.remain_cell_inds, ref[2])
+
+    def test_dense(self):
+        data = counts()
+        for mask_filter in [False, True]:
+            self.assert_pre_processing(self.clustering(data, mask_filter=mask_filter),
+                                       self.reference(data, mask_filter=mask_filter))
+
+    def test_compact_counts(self):
+        data = counts(nan=False)
+        self.assert_pre_processing(self.clustering(data.astype(np.uint8)), self.reference(data))
+
+    def test_fortran_order(self):
+        data = np.asfortranarray(counts())
+        self.assert_pre_processing(self.clustering(data), self.reference(data))
+
+    def test_sparse(self):
+        data = counts(nan=False)
+        self.assert_pre_processing(self.clustering(sp.csc_matrix(data)), self.reference(data))
+
+    def test_out_of_core(self):
+        data = counts()
+        fname = os.path.join(self.dir, 'pp.npy')
+        nmf = self.clustering(data, pp_fname=fname)
+        self.assert_pre_processing(nmf, self.reference(data))
+        self.assertTrue(os.path.exists(fname))
+
+    def test_out_of_core_post_transform_filter(self):
+        data = counts()
+        fname = os.path.join(self.dir, 'pp.npy')
+        hvg_filter = lambda X: np.argsort(-np.var(X, axis=1))[:20]
+        nmf = self.clustering(data, pp_fname=fname)
+        nmf.add_gene_filter(hvg_filter, post_transform=True)
+        X = nmf.pre_processing()
+        # the filtered data stays out-of-core
+        self.assertIsInstance(X, np.memmap)
+        self.assertEqual(os.path.abspath(X.filename), os.path.abspath(fname))
+        self.assertFalse(os.path.exists('{0}.tmp.npy'.format(fname)))
+        ref = self.clustering(data)
+        ref.add_gene_filter(hvg_filter, post_transform=True)
+        np.testing.assert_allclose(X, ref.pre_processing())
+        np.testing.assert_array_equal(nmf.remain_gene_inds, ref.remain_gene_inds)
+        np.testing.assert_allclose(np.load(fname), X)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from functools import partial
+
+import numpy as np
+
+import scRNA.sc3_clustering_impl as sc
+from scRNA.nmf_clustering import NmfClustering
+from scRNA.preprocessing_cache import PreprocessingCache, callable_config
+
+
+def first_genes(data, width=10):
+    return np.arange(min(width, data.shape[0]))
+
+
+class PreprocessingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = np.random.RandomState(0).rand(50, 30)
+        self.cache = PreprocessingCache()
+
+    def clustering(self, gene_filter, data=None):
+        nmf = NmfClustering(self.data if data is None else data, None, num_cluster=2)
+        nmf.pp_cache = self.cache
+        nmf.verbosity = 0
+        nmf.add_cell_filter(lambda x: np.arange(x.shape[1]))
+        nmf.add_gene_filter(gene_filter)
+        nmf.set_data_transformation(partial(sc.data_transformation_log2, inplace=True))
+        return nmf
+
+    def test_opt_in(self):
+        self.assertIsNone(NmfClustering(self.data, None, num_cluster=2).pp_cache)
+
+    def test_shared_results(self):
+        X1 = self.clustering(partial(first_genes, width=20)).pre_processing()
+        X2 = self.clustering(partial(first_genes, width=20)).pre_processing()
+        X3 = self.clustering(partial(first_genes, width=30)).pre_processing()
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertFalse(X2.flags.writeable)
+        np.testing.assert_array_equal(X1, X2)
+        self.assertEqual(X3.shape, (30, 30))
+
+    def test_closures_are_not_cached(self):
+        # ids of freed closures are reused, hence, closures must never be keys
+        for width in [10, 20, 30, 40]:
+            gene_filter = (lambda w: lambda x: np.arange(w))(width)
+            self.assertIsNone(callable_config(gene_filter))
+            X = self.clustering(gene_filter).pre_processing()
+            self.assertEqual(X.shape[0], width)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_array_arguments_are_not_cached(self):
+        # (truncated) string representations of arrays are not unique
+        inds = np.arange(1000)
+        self.assertIsNone(callable_config(partial(np.take, inds)))
+        self.assertIsNotNone(callable_config(partial(first_genes, width=3)))
+
+    def test_same_data_object_only(self):
+        self.clustering(partial(first_genes, width=20)).pre_processing()
+        # same fingerprint (address, shape, strides and samples), but a different object
+        view = self.data.view()
+        self.clustering(partial(first_genes, width=20), data=view).pre_processing()
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_invalidate(self):
+        nmf = self.clustering(partial(first_genes, width=20))
+        nmf.pre_processing()
+        nmf.invalidate_pre_processing()
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+
+import scRNA.sc3_clustering_impl as sc
+from scRNA.qc_index import build_qc_index, get_qc_index, qc_index_fname
+
+
+def expression(num_genes=200, num_cells=150, seed=0):
+    rs = np.random.RandomState(seed)
+    p = np.linspace(0.05, 0.95, num_genes)[:, np.newaxis]
+    return rs.exponential(3., size=(num_genes, num_cells)) * (rs.rand(num_genes, num_cells) < p)
+
+
+class QcIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'data.npy')
+        self.data = expression()
+        np.save(self.fname, self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assert_resolve(self, qc_index, data, min_expr_genes, threshold, perc):
+        cells, genes = qc_index.resolve(min_expr_genes, threshold, perc)
+        np.testing.assert_array_equal(cells, sc.cell_filter(data, num_expr_genes=min_expr_genes,
+                                                            non_zero_threshold=threshold))
+        np.testing.assert_array_equal(genes, sc.gene_filter(data, perc_consensus_genes=perc,
+                                                            non_zero_threshold=threshold))
+
+    def test_integer_data(self):
+        data = np.floor(self.data).astype(np.uint16)
+        qc_index = build_qc_index(sp.csc_matrix(data), chunk_size=33)
+        for threshold in [0, 1, 2, 2.5, 7]:
+            for min_expr_genes in [10, 50]:
+                self.assert_resolve(qc_index, data, min_expr_genes, threshold, 0.8)
+
+    def test_float_edges(self):
+        qc_index = build_qc_index(self.data)
+        self.assert_resolve(qc_index, self.data, 50, 2, 0.8)
+        # float data needs thresholds on the edges
+        self.assertRaises(Exception, qc_index.resolve, 50, 2.5, 0.8)
+        self.assertFalse(qc_index.covers([1, 2.5]))
+        self.assertRaises(Exception, qc_index.resolve, 50, 25, 0.8)
+
+    def test_requested_thresholds(self):
+        thresholds = [0.5, 2.5, 25]
+        qc_index = get_qc_index(self.fname, self.data, thresholds=thresholds)
+        self.assertTrue(qc_index.covers(thresholds))
+        for threshold in thresholds + [1, 3]:
+            self.assert_resolve(qc_index, self.data, 30, threshold, 0.9)
+
+    def test_lazy_loading(self):
+        calls = list()
+
+        def load():
+            calls.append(1)
+            return self.data
+        get_qc_index(self.fname, load, thresholds=[1, 2])
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(os.path.exists(qc_index_fname(self.fname)))
+        # covered thresholds do not touch the data
+        qc_index = get_qc_index(self.fname, load, thresholds=[2, 3])
+        self.assertEqual(len(calls), 1)
+        # new thresholds extend the index (and keep the old edges)
+        qc_index = get_qc_index(self.fname, load, thresholds=[1.5])
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(qc_index.covers([1, 1.5, 2]))
+        # changed data
+        os.utime(self.fname, (0, 0))
+        get_qc_index(self.fname, load, thresholds=[1.5])
+        self.assertEqual(len(calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
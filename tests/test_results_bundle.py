@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from scRNA.results_bundle import ResultsBundle, array_sha1, load_results_bundle
+
+
+class ArraySha1Test(unittest.TestCase):
+
+    def test_layouts(self):
+        X = np.random.RandomState(0).rand(50, 30)
+        F = np.asfortranarray(X)
+        self.assertEqual(array_sha1(X), array_sha1(X.copy()))
+        self.assertEqual(array_sha1(F), array_sha1(F.copy(order='F')))
+        self.assertEqual(array_sha1(X.T), array_sha1(np.asfortranarray(X.T)))
+        self.assertNotEqual(array_sha1(X), array_sha1(X.T.copy()))
+        changed = F.copy(order='F')
+        changed[49, 29] += 1.
+        self.assertNotEqual(array_sha1(F), array_sha1(changed))
+
+    def test_non_contiguous(self):
+        X = np.random.RandomState(0).rand(50, 30)
+        view = X[::2, 1::3]
+        for chunk_bytes in [1, 100, 1 << 24]:
+            self.assertEqual(array_sha1(view, chunk_bytes=chunk_bytes), array_sha1(view.copy()))
+        self.assertNotEqual(array_sha1(X[::2]), array_sha1(X[1::2]))
+        self.assertEqual(array_sha1(np.zeros((0, 3))), array_sha1(np.zeros((0, 3))))
+
+
+class ResultsBundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        fname = os.path.join(self.dir, 'results.npz')
+        X = np.asfortranarray(np.random.RandomState(0).rand(20, 10))
+        with ResultsBundle(fname) as results:
+            results.add('data', X)
+            results.add('data_again', X)
+            results.add('view', X[:, ::2])
+            results.add('labels', np.arange(10))
+            self.assertEqual(len(results.blobs), 3)
+        res = load_results_bundle(fname)
+        np.testing.assert_array_equal(res['data'], X)
+        self.assertIs(res['data_again'], res['data'])
+        np.testing.assert_array_equal(res['view'], X[:, ::2])
+        np.testing.assert_array_equal(res['labels'], np.arange(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+
+import scRNA.sc3_clustering_impl as sc
+
+
+class DistanceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = np.random.RandomState(0).rand(30, 20)
+        self.data_sha1 = sc.data_sha1
+        self.num_hashes = 0
+
+        def counting_sha1(data):
+            self.num_hashes += 1
+            return self.data_sha1(data)
+        sc.data_sha1 = counting_sha1
+        sc.DISTANCE_CACHE.clear()
+
+    def tearDown(self):
+        sc.data_sha1 = self.data_sha1
+        sc.DISTANCE_CACHE.clear()
+
+    def test_put(self):
+        cache = sc.DistanceCache(max_bytes=20*20*8)
+        X = np.zeros((20, 20))
+        self.assertIs(cache.put('a', X), X)
+        self.assertFalse(X.flags.writeable)
+        self.assertIs(cache.get('a'), X)
+        # too large: not stored, hence, not frozen either
+        Y = np.zeros((30, 30))
+        self.assertIs(cache.put('b', Y), Y)
+        self.assertTrue(Y.flags.writeable)
+        self.assertIsNone(cache.get('b'))
+
+    def test_pinned_data(self):
+        metrics = ['euclidean', 'pearson', 'spearman']
+        for metric in metrics:
+            sc.distances(self.data, [], metric=metric)
+        self.assertEqual(self.num_hashes, len(metrics))
+        self.num_hashes = 0
+        with sc.DISTANCE_CACHE.pinned_data(self.data):
+            for metric in metrics + ['cityblock']:
+                X = sc.distances(self.data, [], metric=metric)
+                np.testing.assert_allclose(X, sc.distances(self.data, [], metric=metric, use_cache=False))
+        self.assertEqual(self.num_hashes, 1)
+        self.assertEqual(len(sc.DISTANCE_CACHE.pinned), 0)
+        # equal content in a different array shares the distances
+        self.assertIs(sc.distances(self.data.copy(), [], metric='cityblock'), X)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from scRNA.tsv_parser import cache_fname, file_sha1, load_tsv_cache, read_tsv
+
+
+class TsvParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content, compress=False):
+        fname = os.path.join(self.dir, name)
+        f = gzip.open(fname, 'wb') if compress else open(fname, 'wb')
+        f.write(content)
+        f.close()
+        return fname
+
+    def test_matches_loadtxt(self):
+        X = np.random.RandomState(0).rand(57, 13)
+        X[3, 4] = 0.
+        X[5, :] = np.arange(13)
+        fname = os.path.join(self.dir, 'data.tsv')
+        np.savetxt(fname, X, delimiter='\t')
+        ref = np.loadtxt(fname, delimiter='\t')
+        for chunk_lines in [1, 7, 2000]:
+            data = read_tsv(fname, chunk_lines=chunk_lines, use_cache=False)
+            np.testing.assert_array_equal(data, ref)
+            data = read_tsv(fname, chunk_lines=chunk_lines, num_processes=1, use_cache=False)
+            np.testing.assert_array_equal(data, ref)
+
+    def test_single_row_and_column(self):
+        for content in ['1\t2\t3\n', '1\n2\n3\n']:
+            fname = self.write('data.tsv', content)
+            np.testing.assert_array_equal(read_tsv(fname, use_cache=False), np.loadtxt(fname, delimiter='\t'))
+
+    def test_gzip_and_strings(self):
+        fname = self.write('genes.tsv.gz', 'ENSG1\tA\nENSG2\tB\n', compress=True)
+        data = read_tsv(fname, dtype=np.str, use_cache=False)
+        np.testing.assert_array_equal(data, [['ENSG1', 'A'], ['ENSG2', 'B']])
+
+    def test_blank_lines_are_skipped(self):
+        fname = self.write('data.tsv', '1\t2\n\n3\t4\n\n')
+        np.testing.assert_array_equal(read_tsv(fname, chunk_lines=1, use_cache=False), [[1, 2], [3, 4]])
+
+    def test_malformed_input_raises(self):
+        contents = ['1\t2\n3\n',            # ragged rows
+                    '1\t2\nNA\t4\n',        # non-numeric token
+                    'a\tb\n1\t2\n',         # header line
+                    '1\t\t2\n3\t4\t5\n',    # empty field
+                    '1 2\t3\n4\t5\n']       # space inside a field
+        for content in contents:
+            for chunk_lines in [1, 2000]:
+                fname = self.write('data.tsv', content)
+                self.assertRaises(StandardError, read_tsv, fname, chunk_lines=chunk_lines)
+                # invalid data never ends up in the sidecar cache
+                self.assertFalse(os.path.exists(cache_fname(fname)))
+
+    def test_sidecar_cache(self):
+        fname = self.write('data.tsv', '1\t2\n3\t4\n')
+        data = read_tsv(fname)
+        self.assertTrue(os.path.exists(cache_fname(fname)))
+        np.testing.assert_array_equal(read_tsv(fname), data)
+        # changed content (and size) invalidates the cache
+        fname = self.write('data.tsv', '1\t2\n3\t5.5\n')
+        np.testing.assert_array_equal(read_tsv(fname), [[1, 2], [3, 5.5]])
+
+    def test_sidecar_cache_content_hash(self):
+        fname = self.write('data.tsv.gz', '1\t2\n3\t4\n' * 10, compress=True)
+        data = read_tsv(fname, chunk_lines=3)
+        self.assertEqual(str(np.load(cache_fname(fname))['sha1']), file_sha1(fname))
+        # only the modification time differs: the content hash keeps the cache valid
+        os.utime(fname, (0, 0))
+        self.assertIsNotNone(load_tsv_cache(fname, data.dtype))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+
+from scRNA.utils import compact_counts
+
+
+class CompactCountsTest(unittest.TestCase):
+
+    def test_smallest_unsigned_dtype(self):
+        for max_value, dtype in [(255, np.uint8), (256, np.uint16), (70000, np.uint32)]:
+            data = np.array([[0., 1.], [2., max_value]])
+            res = compact_counts(data, chunk_size=1)
+            self.assertEqual(res.dtype, dtype)
+            np.testing.assert_array_equal(res, data)
+
+    def test_non_counts_unchanged(self):
+        for data in [np.array([[0., 1.5], [2., 3.]]), np.array([[0., -1.], [2., 3.]]),
+                     np.array([[0., np.nan], [2., 3.]]), np.array([[0., np.inf], [2., 3.]])]:
+            self.assertIs(compact_counts(data), data)
+
+    def test_1d(self):
+        res = compact_counts(np.array([0., 3., 300.]))
+        self.assertEqual(res.dtype, np.uint16)
+        self.assertEqual(res.shape, (3,))
+        data = np.array([0., 0.5])
+        self.assertIs(compact_counts(data), data)
+
+    def test_sparse(self):
+        data = sp.csc_matrix(np.array([[0., 1.], [2., 0.]]))
+        res = compact_counts(data)
+        self.assertTrue(sp.issparse(res))
+        self.assertEqual(res.dtype, np.uint8)
+        np.testing.assert_array_equal(res.toarray(), data.toarray())
+
+
+if __name__ == '__main__':
+    unittest.main()